@@ -6,10 +6,10 @@ from time import sleep as tsleep
 from datetime import datetime
 
 import neurobooth_os.main_control_rec as ctr_rec
-from neurobooth_os.netcomm import get_messages_to_ctr, node_info, NewStdout
+from neurobooth_os.netcomm import get_messages_to_ctr, node_info, NewStdout, HealthMonitor
 import neurobooth_os.iout.metadator as meta
 from neurobooth_os.iout import marker_stream
-from neurobooth_os.gui import _process_received_data, ctr_event_handler
+from neurobooth_os.gui import _make_dispatcher, ctr_event_handler
 from neurobooth_os.layouts import _main_layout, _win_gen
 import neurobooth_os.iout.metadator as meta
 
@@ -59,9 +59,9 @@ conn = meta.get_conn(remote=remote, database=database_name)
 window = _win_gen(_main_layout, sess_info, True)
 event, values = window.read(.1)
 ctr_host, ctr_port = node_info(ctr_node)   
-callback, callback_args = _process_received_data, window    
+dispatcher = _make_dispatcher(window, HealthMonitor(["STM", "ACQ"]))
 server_thread = threading.Thread(target=get_messages_to_ctr,
-                                    args=(callback, remote, ctr_host, ctr_port, callback_args,),
+                                    args=(dispatcher.dispatch, remote, ctr_host, ctr_port),
                                     daemon=True)
 server_thread.start()
 tsleep(.3)
@@ -89,8 +89,8 @@ statecolors = {"-init_servs-": ["green", "yellow"],
 
 # Prepare devices and streams
 vidf_mrkr = marker_stream('videofiles')
-window.write_event_value('-OUTLETID-', f"['{vidf_mrkr.name}', '{vidf_mrkr.outlet_id}']")
-ctr_rec.prepare_devices(f"{collection_id}:{str(tech_obs_log)}", nodes=nodes)
+window.write_event_value('-OUTLETID-', {"name": vidf_mrkr.name, "outlet_id": vidf_mrkr.outlet_id})
+ctr_rec.prepare_devices(collection_id, nodes=nodes, tech_obs_log=tech_obs_log)
 out["vidf_mrkr"] = vidf_mrkr
 
 out['exit_flag'] ='prepared'
@@ -103,16 +103,13 @@ for event, values in event_listener(window, timeout=1):
         
 # Get tasks
 tasks_obs = meta.get_tasks(collection_id, conn)
-tasks = []
-for task in tasks_obs:
-    task_id, *_ = meta._get_task_param(task, conn)
-    tasks.append(task_id)
+task_params = meta.get_task_params(tasks_obs, conn)
+tasks = [task_params[task][0] for task in tasks_obs]
 print(tasks)
 # tasks = ['intro_occulo_task_1', 'pursuit_task_1', 'intro_cog_task_1', 'sit_to_stand_task_1']
 
 if len(tasks):
-    running_task = "-".join(tasks)  # task_name can be list of task1-task2-task3
-    ctr_rec.task_presentation(running_task, subj_id, node=nodes[1])
+    ctr_rec.task_presentation(tasks, subj_id, node=nodes[1])
 else:
     print('No task selected')
 
@@ -0,0 +1,58 @@
+"""
+Compare messages/sec sent to a loopback CTR server when opening one
+connection per message (previous socket_message) and when reusing the
+persistent pooled connection.
+"""
+
+import socket
+import threading
+import time
+
+from neurobooth_os.netcomm import socket_message, node_info, get_messages_to_ctr, encode_message
+from neurobooth_os.netcomm.framing import send_frame
+
+node_name = "dummy_ctr"
+host, port = node_info(node_name)
+
+received = []
+done = threading.Event()
+n_expected = [0]
+
+
+def callback(data):
+    received.append(data)
+    if len(received) == n_expected[0]:
+        done.set()
+
+
+def one_connection_per_message(message):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.connect((host, port))
+    send_frame(s, message)
+    s.close()
+
+
+def run(send, label, n_messages):
+    received.clear()
+    done.clear()
+    n_expected[0] = n_messages
+    t0 = time.perf_counter()
+    for i in range(n_messages):
+        send(encode_message("log", node="STM", text=f"benchmark message {i}"))
+    done.wait(60)
+    elapsed = time.perf_counter() - t0
+    print(f"{label}: {len(received) / elapsed:.0f} messages/sec "
+          f"({len(received)} messages in {elapsed:.3f} s)")
+
+
+server_thread = threading.Thread(target=get_messages_to_ctr,
+                                 args=(callback, True, host, port), daemon=True)
+server_thread.start()
+time.sleep(.5)
+
+# New connections stall once the listen backlog fills up, keep this one short
+run(one_connection_per_message, "one connection per message", 200)
+run(lambda msg: socket_message(msg, node_name), "pooled connection", 20000)
+
+socket_message(encode_message("close"), node_name)
+server_thread.join(2)
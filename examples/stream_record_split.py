@@ -14,10 +14,10 @@ Only works in Windows or Linux using Wine
 import time
 import liesl
 from pathlib import Path
-from h5io import read_hdf5
 import neurobooth_os.mock.mock_device_streamer as mocker
 from neurobooth_os.iout.marker import marker_stream
 from neurobooth_os.iout.split_xdf import split_sens_files
+from neurobooth_os.iout.sensor_file import read_sensor_file
 
 print(__doc__)
 
@@ -83,6 +83,7 @@ files = split_sens_files(final_fname)
 
 # %%
 # read first split h5 file
-marker, stream = read_hdf5(files[0])
+data = read_sensor_file(files[0])
+marker, stream = data['marker'], data['device_data']
 
 
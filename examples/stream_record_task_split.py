@@ -15,10 +15,10 @@ import time
 import liesl
 import warnings
 from pathlib import Path
-from h5io import read_hdf5
 import neurobooth_os.mock.mock_device_streamer as mocker
 from neurobooth_os.iout.marker import marker_stream
 from neurobooth_os.iout.split_xdf import split
+from neurobooth_os.iout.sensor_file import read_sensor_file
 from neurobooth_os.tasks import SitToStand
 from neurobooth_os.tasks import utils
 
@@ -100,6 +100,7 @@ files = split(final_fname)
 
 # %%
 # read first split h5 file
-marker, stream = read_hdf5(files[0])
+data = read_sensor_file(files[0])
+marker, stream = data['marker'], data['device_data']
 
 
@@ -6,6 +6,7 @@ Created on Fri Apr  2 08:01:51 2021
 """
 
 import sys
+import os.path as op
 import time
 import threading
 from optparse import OptionParser
@@ -16,55 +17,82 @@ import liesl
 
 import neurobooth_os.main_control_rec as ctr_rec
 from neurobooth_os.realtime.lsl_plotter import create_lsl_inlets, stream_plotter
-from neurobooth_os.netcomm import get_messages_to_ctr, node_info, NewStdout
+from neurobooth_os.netcomm import (get_messages_to_ctr, node_info, NewStdout, ClockSync,
+                                   HealthMonitor, MessageDispatcher)
 from neurobooth_os.layouts import _main_layout, _win_gen, _init_layout, write_task_notes
 import neurobooth_os.iout.metadator as meta
 from neurobooth_os.iout.split_xdf import split_sens_files, get_xdf_name
+from neurobooth_os.iout.split_queue import SplitQueue
+from neurobooth_os.iout.lsl_recorder import LslRecorder
 from neurobooth_os.iout import marker_stream
 import neurobooth_os.config as cfg
 
-def _process_received_data(serv_data, window):
-    """ Gets string data from other servers and create PySimpleGui window events.
+def _make_dispatcher(window, health):
+    """Make the dispatcher of the typed messages sent to the CTR server.
+
+    Handlers turn messages into PySimpleGui window events whose values are
+    the message data dicts.
 
     Parameters
     ----------
-    serv_data : str
-        Data sent by other servers
     window : object
         PySimpleGui window object
-    """
-    
-    # Split server name and data
-    serv_data = serv_data.split(":::")[-1]
-    for data_row in serv_data.split("\n"):
-
-        if "-OUTLETID-" in data_row:
-            # -OUTLETID-:outlet_name:uuid
-            evnt, outlet_name, outlet_id = data_row.split(":")
-            window.write_event_value('-OUTLETID-', f"['{outlet_name}', '{outlet_id}']")
-
-        elif "UPDATOR:" in data_row:
-            # UPDATOR:-elem_key-
-            elem = data_row.split(":")[1]
-            window.write_event_value('-update_butt-', elem)
-
-        elif "Initiating task:" in data_row:
-            # Initiating task:task_id:obs_id:tech_obs_log_id:tsk_strt_time
-            _, task_id, obs_id, obs_log_id, tsk_strt_time = data_row.split(":")
-            window.write_event_value('task_initiated', f"['{task_id}', '{obs_id}', '{obs_log_id}', '{tsk_strt_time}']")
-
-        elif "Finished task:" in data_row:
-            # Finished task: task_id
-            _, task_id = data_row.split(":")
-            window.write_event_value('task_finished', task_id)
-
-        elif "-new_filename-" in data_row:
-            # new file created, data_row = "-new_filename-:stream_name:video_filename"
-            event, stream_name, filename = data_row.split(":")
-            window.write_event_value(event, f"{stream_name}, {filename}]")
-            
+    health : instance of HealthMonitor
+        Monitor updated with the heartbeats
 
-def gui(remote=False, database='neurobooth'):
+    Returns
+    -------
+    dispatcher : instance of MessageDispatcher
+        Dispatcher to use as get_messages_to_ctr callback.
+    """
+    dispatcher = MessageDispatcher()
+
+    def post(event):
+        # Post the message data as window event
+        return lambda msg: window.write_event_value(event, msg.data)
+
+    dispatcher.register("heartbeat", health.update)
+    dispatcher.register("outlet_id", post('-OUTLETID-'))
+    dispatcher.register("task_initiated", post('task_initiated'))
+    dispatcher.register("task_finished", post('task_finished'))
+    dispatcher.register("new_filename", post('-new_filename-'))
+
+    @dispatcher.register("update_button")
+    def update_button(msg):
+        window.write_event_value('-update_butt-', msg.data["key"])
+
+    return dispatcher
+
+
+def _node_health_text(health):
+    lines = []
+    for node in health.nodes:
+        healthy, beat = health.status(node)
+        if beat is None:
+            lines.append(f"{node}: no heartbeat")
+            continue
+        state = "ok" if healthy else "NOT RESPONDING"
+        lines.append(f"{node}: {state}, cpu {beat['cpu_percent']:.0f}%, "
+                     f"mem {beat['mem_percent']:.0f}%, {len(beat['streams'])} streams")
+    return "\n".join(lines)
+
+
+def _split_jobs_text(split_queue, n_jobs=5):
+    lines = []
+    for job in split_queue.status()[-n_jobs:]:
+        name = op.basename(job["xdf_fname"])
+        state = job["status"]
+        if state == "running" and job["progress"] is not None:
+            state += " {}/{} streams".format(*job["progress"])
+        if state == "done" and job.get("report"):
+            state += f" in {job['report']['total_s']} s, db {job['report']['db_s']} s"
+        if job["attempts"] > 1:
+            state += f", attempt {job['attempts']}"
+        lines.append(f"{name}: {state}")
+    return "\n".join(lines)
+
+
+def gui(remote=False, database='neurobooth', record_hdf5=False):
     """Start the Graphical User Interface.
 
     Parameters
@@ -74,6 +102,9 @@ def gui(remote=False, database='neurobooth'):
         to the database. Use False if on site.
     database : str
         The database name
+    record_hdf5 : bool
+        If True, the streams are recorded directly to the HDF5 files of the
+        devices instead of an xdf file split after each task, by default False
     """
     
     if remote:
@@ -101,7 +132,12 @@ def gui(remote=False, database='neurobooth'):
     task_id = None
     rec_fname = None, # lsl file name
     session = None    
+    recorder = None  # direct recording to HDF5 if record_hdf5
     vidf_mrkr = None
+    clock_sync = None  # clock offsets of the nodes during the session
+    health = None  # heartbeats of STM and ACQ
+    health_text = None
+    split_queue = None  # split of the xdf files after the tasks
             
     statecolors = {"-init_servs-": ["green", "yellow"],
                    "-Connect-": ["green", "yellow"],
@@ -137,11 +173,9 @@ def gui(remote=False, database='neurobooth'):
         elif event == "collection_id":
             collection_id = values[event]
             tech_obs_log["collection_id"] = collection_id
-            tasks_obs = meta.get_tasks(collection_id, conn)
-            task_list = []
-            for task in tasks_obs:
-                task_id, *_ = meta._get_task_param(task, conn)
-                task_list.append(task_id)
+            # Read again in case the collection changed, from the snapshot while fresh
+            collection = meta.load_collection(collection_id, conn, use_cache=False)
+            task_list = [task["stimulus_id"] for task in collection["tasks"].values()]
             window["_tasks_"].update(value=", ".join(task_list))
 
         elif event == "_init_sess_save_":
@@ -161,14 +195,26 @@ def gui(remote=False, database='neurobooth'):
                 # Open new layout with main window
                 window = _win_gen(_main_layout, sess_info, remote)
 
+                # Nodes are unhealthy after 3 s without heartbeat
+                health = HealthMonitor(["STM", "ACQ"], window=3,
+                                       on_change=lambda *change: window.write_event_value(
+                                           '-node_health-', change))
+
                 # Start a threaded socket CTR server once main window generated
-                callback_args = window    
+                dispatcher = _make_dispatcher(window, health)
                 server_thread = threading.Thread(target=get_messages_to_ctr,
-                                                args=(_process_received_data, remote, host_ctr, port_ctr,
-                                                callback_args,),
+                                                args=(dispatcher.dispatch, remote, host_ctr, port_ctr),
                                                 daemon=True)
                 server_thread.start()
 
+                # Split the task files in background, resuming the splits of previous sessions
+                # Workers take connections from the pool, not the one of the GUI thread
+                split_queue = SplitQueue(op.join(cfg.paths["data_out"], "split_jobs.json"),
+                                         meta.get_pool(remote=remote, database=database),
+                                         on_update=lambda job: window.write_event_value(
+                                             '-split_job-', job))
+                split_queue.start()
+
                 # Rerout print for ctr server to capture data in remote case
                 if remote:
                     time.sleep(.1)
@@ -182,8 +228,29 @@ def gui(remote=False, database='neurobooth'):
         elif event == "-init_servs-":
             window['-init_servs-'].Update(button_color=('black', 'red'))
             event, values = window.read(.1)
-            ctr_rec.start_servers(nodes=nodes, remote=remote, conn=conn)
+            _, errors = ctr_rec.start_servers(nodes=nodes, remote=remote, conn=conn)
+            if len(errors):
+                sg.PopupError("\n".join(f"{node}: {e}" for node, e in errors.items()),
+                              title="Servers not started")
             time.sleep(1)
+            if clock_sync is None:
+                clock_sync = ClockSync(nodes)
+                clock_sync.start()
+            health.start()
+
+        # A node started or stopped sending heartbeats
+        elif event == '-node_health-':
+            node, healthy, beat = values[event]
+            if not healthy:
+                print(f"{node} stopped sending heartbeats, restart the servers")
+                window['-init_servs-'].Update(button_color=('black', 'red'))
+
+        # A split job changed status or progress
+        elif event == '-split_job-':
+            job = values[event]
+            if job["status"] == "failed":
+                print(f"Split of {job['xdf_fname']} failed: {job['error']}")
+            window['split_jobs'].update(_split_jobs_text(split_queue))
 
         # Turn on devices and start LSL outlet stream
         elif event == '-Connect-':
@@ -192,9 +259,11 @@ def gui(remote=False, database='neurobooth'):
 
             vidf_mrkr = marker_stream('videofiles')
             # Create event to capture outlet_id
-            window.write_event_value('-OUTLETID-', f"['{vidf_mrkr.name}', '{vidf_mrkr.outlet_id}']")
+            window.write_event_value('-OUTLETID-', {"name": vidf_mrkr.name,
+                                                    "outlet_id": vidf_mrkr.outlet_id})
 
-            ctr_rec.prepare_devices(f"{collection_id}:{str(tech_obs_log)}", nodes=nodes)
+            ctr_rec.prepare_devices(collection_id, nodes=nodes, tech_obs_log=tech_obs_log,
+                                    snapshot_stamp=meta.snapshot_stamp())
             print('Connecting devices')
 
         # Real-time plotting of inlet data.
@@ -212,11 +281,14 @@ def gui(remote=False, database='neurobooth'):
         # Start task presentation.
         elif event == 'Start':
             tasks = [k for k, v in values.items() if "task" in k and v == True]
+            unhealthy = health.unhealthy()
+            if len(unhealthy):
+                sg.PopupError(f"No heartbeat from {', '.join(unhealthy)}, restart the servers")
+                continue
                     
             window['Start'].Update(button_color=('black', 'yellow'))
             if len(tasks):
-                running_task = "-".join(tasks)  # task_name can be list of task1-task2-task3
-                ctr_rec.task_presentation(running_task, sess_info['subject_id'], node=nodes[1])
+                ctr_rec.task_presentation(tasks, sess_info['subject_id'], node=nodes[1])
                 steps.append("task_started")
             else:
                 sg.PopupError('No task selected')
@@ -225,12 +297,12 @@ def gui(remote=False, database='neurobooth'):
             if "task_started" not in steps:
                 sg.PopupError('Tasks not started')
             else:
-                ctr_rec.message_presentation("pause tasks", nodes)
+                ctr_rec.message_presentation("pause_tasks", nodes)
                 resp = sg.Popup('The next task will be paused', custom_text=('Continue tasks', 'Stop tasks'))
                 if resp == 'Continue tasks':
-                    ctr_rec.message_presentation("unpause tasks", nodes)
+                    ctr_rec.message_presentation("unpause_tasks", nodes)
                 elif resp == 'Stop tasks':
-                    ctr_rec.message_presentation("stop tasks", nodes)
+                    ctr_rec.message_presentation("stop_tasks", nodes)
 
         # Save notes to a txt
         elif event == "_save_notes_":
@@ -244,7 +316,16 @@ def gui(remote=False, database='neurobooth'):
         # Shut down the other servers and stops plotting
         elif event == 'Shut Down' or event == sg.WINDOW_CLOSED:
             plttr.stop()
+            if health is not None:
+                health.stop()
+                print(f"CTR messages handled: {dispatcher.stats()}")
+            if clock_sync is not None:
+                clock_sync.stop()
+                clock_sync.save(op.join(cfg.paths["data_out"], f"{subject_id_date}_clock_sync.json"))
             ctr_rec.shut_all(nodes=nodes)
+            if split_queue is not None:
+                print("Waiting for the running split jobs")
+                split_queue.stop()
             break
         
 
@@ -259,15 +340,17 @@ def gui(remote=False, database='neurobooth'):
             task_id = task_id,
             rec_fname = rec_fname, # lsl file name
             session = session,                   
+            recorder = recorder,
             vidf_mrkr = vidf_mrkr,
             )
         out = ctr_event_handler(window, event, values, conn, subject_id_date, statecolors=statecolors, stream_ids=stream_ids,
-                     inlets=inlets, out=out)
+                     inlets=inlets, out=out, split_queue=split_queue, record_hdf5=record_hdf5)
         obs_log_id = out['obs_log_id']
         t_obs_id = out['t_obs_id']
         task_id = out['task_id']
         rec_fname = out['rec_fname']
         session = out['session']
+        recorder = out['recorder']
         vidf_mrkr = out['vidf_mrkr']
         
     ##################################################################################
@@ -279,7 +362,15 @@ def gui(remote=False, database='neurobooth'):
             inlet_keys = list(inlets)
             window['inlet_State'].update("\n".join(inlet_keys))
 
+        # Print the health and load of the nodes in GUI
+        if health is not None:
+            text = _node_health_text(health)
+            if text != health_text:
+                health_text = text
+                window['node_health'].update(health_text)
+
     window.close()
+    meta.get_pool(remote=remote, database=database).closeall()
     if remote:
         sys.stdout = sys.stdout.terminal
     else:
@@ -288,7 +379,7 @@ def gui(remote=False, database='neurobooth'):
 
 
 def ctr_event_handler(window, event, values, conn, subject_id, statecolors=None, stream_ids={},
-                     inlets={}, out=None):
+                     inlets={}, out=None, split_queue=None, record_hdf5=False):
     """Handles events from ctr server thread
 
     Parameters
@@ -311,6 +402,12 @@ def ctr_event_handler(window, event, values, conn, subject_id, statecolors=None,
         Lsl inlets, by default {}
     out : dict, optional
         Dictionary with variables, by default None
+    split_queue : instance of SplitQueue | None
+        Queue splitting the xdf files of the tasks in background, if None
+        files are split before returning, by default None
+    record_hdf5 : bool
+        If True, the streams are recorded directly to the HDF5 files of the
+        devices with an LslRecorder instead of an xdf file, by default False
 
     Returns
     -------
@@ -326,6 +423,7 @@ def ctr_event_handler(window, event, values, conn, subject_id, statecolors=None,
                    task_id = None,
                    rec_fname = None, # lsl file name
                    session = liesl.Session(),                   
+                   recorder = None,
                    vidf_mrkr = marker_stream('videofiles'),
                    )
 
@@ -342,8 +440,11 @@ def ctr_event_handler(window, event, values, conn, subject_id, statecolors=None,
                     window.write_event_value('start_lsl_session', 'none')
                     
                     # Create LSL session
-                    streamargs = [{'name': n} for n in list(inlets)]
-                    out["session"] = liesl.Session(prefix='', streamargs=streamargs, mainfolder=cfg.paths["data_out"] )
+                    if record_hdf5:
+                        out["recorder"] = LslRecorder(inlets, cfg.paths["data_out"], conn)
+                    else:
+                        streamargs = [{'name': n} for n in list(inlets)]
+                        out["session"] = liesl.Session(prefix='', streamargs=streamargs, mainfolder=cfg.paths["data_out"] )
                     print("LSL session with: ", list(inlets))
 
                     if out['exit_flag'] =='prepared':
@@ -351,8 +452,8 @@ def ctr_event_handler(window, event, values, conn, subject_id, statecolors=None,
                     
     # Create LSL inlet stream
     elif event == "-OUTLETID-":
-        # event values -> f"['{outlet_name}', '{outlet_id}']
-        outlet_name, outlet_id = eval(values[event])
+        # event values -> {"name": outlet_name, "outlet_id": outlet_id}
+        outlet_name, outlet_id = values[event]["name"], values[event]["outlet_id"]
         
         # update the inlet if new or different source_id
         if stream_ids.get(outlet_name) is None or outlet_id != stream_ids[outlet_name]:
@@ -362,8 +463,9 @@ def ctr_event_handler(window, event, values, conn, subject_id, statecolors=None,
 
     # Signal a task started: record LSL data and update gui
     elif event == 'task_initiated':
-        # event values -> f"['{task_id}', '{t_obs_id}', '{tech_obs_log_id}, '{tsk_strt_time}']
-        task_id, t_obs_id, obs_log_id, tsk_strt_time = eval(values[event])
+        # event values -> {"task_id", "t_obs_id", "tech_obs_log_id", "tsk_strt_time"}
+        task_id, t_obs_id = values[event]["task_id"], values[event]["t_obs_id"]
+        obs_log_id, tsk_strt_time = values[event]["tech_obs_log_id"], values[event]["tsk_strt_time"]
         out["obs_log_id"] = obs_log_id
         out["t_obs_id"] = t_obs_id
         out["task_id"] = task_id
@@ -374,7 +476,10 @@ def ctr_event_handler(window, event, values, conn, subject_id, statecolors=None,
 
         # Start LSL recording
         out["rec_fname"] = rec_fname
-        out['session'].start_recording(out["rec_fname"])
+        if out.get("recorder") is not None:
+            out["recorder"].start(rec_fname, obs_log_id, t_obs_id)
+        else:
+            out['session'].start_recording(out["rec_fname"])
 
         window["task_title"].update("Running Task:")
         window["task_running"].update(task_id, background_color="red")
@@ -382,24 +487,33 @@ def ctr_event_handler(window, event, values, conn, subject_id, statecolors=None,
 
     # Signal a task ended: stop LSL recording and update gui
     elif event == 'task_finished':
-        task_id = values[event]
+        task_id = values[event]["task_id"]
         
-        # Stop LSL recording
-        out['session'].stop_recording()
+        # Stop LSL recording, the files of the direct recording are ready
+        if out.get("recorder") is not None:
+            out["recorder"].stop()
+        else:
+            out['session'].stop_recording()
 
         window["task_running"].update(task_id, background_color="green")
         window['Start'].Update(button_color=('black', 'green'))
 
-        xdf_fname = get_xdf_name(out['session'], out["rec_fname"])
-        split_sens_files(xdf_fname, out["obs_log_id"], out["t_obs_id"], conn)
+        if out.get("recorder") is None:
+            xdf_fname = get_xdf_name(out['session'], out["rec_fname"])
+            if split_queue is not None:
+                split_queue.submit(xdf_fname, out["obs_log_id"], out["t_obs_id"])
+            else:
+                split_sens_files(xdf_fname, out["obs_log_id"], out["t_obs_id"], conn)
         
         if out['exit_flag'] =='task_end':
             out['break_'] = True
 
     # Send a marker string with the name of the new video file created
-    elif event == "-new_filename-":            
-        out["vidf_mrkr"].push_sample([values[event]])
-        print(f"pushed videfilename mark {values[event]}")
+    elif event == "-new_filename-":
+        # marker format is "stream_name, video_filename"
+        mrkr = f"{values[event]['stream_name']}, {values[event]['filename']}"
+        out["vidf_mrkr"].push_sample([mrkr])
+        print(f"pushed videfilename mark {mrkr}")
 
     return out
 
@@ -409,8 +523,10 @@ def main():
     parser = OptionParser()
     parser.add_option("-r", "--remote", dest="remote", action="store_true",
                       default=False, help="Access database using remote connection")
+    parser.add_option("--hdf5", dest="record_hdf5", action="store_true", default=False,
+                      help="Record the streams directly to HDF5 files instead of xdf")
     (options, args) = parser.parse_args()
-    gui(remote=options.remote)
+    gui(remote=options.remote, record_hdf5=options.record_hdf5)
 
 if __name__ == '__main__':
     main()
@@ -9,6 +9,7 @@ import cv2
 from pylsl import StreamInfo, StreamOutlet
 
 from neurobooth_os.iout import dshowcapture
+from neurobooth_os.netcomm import send_event
 
 import warnings
 warnings.filterwarnings('ignore')
@@ -68,7 +69,7 @@ class VidRec_Brio():
                 'int32',
                 self.preview_outlet_id)
             self.outlet_preview = StreamOutlet(self.info_stream)
-            print(f"-OUTLETID-:Webcam:{self.preview_outlet_id}")
+            send_event("outlet_id", name="Webcam", outlet_id=self.preview_outlet_id)
             self.preview_start()
             self.preview_relFps = round(fps / self.preview_fps)
 
@@ -93,7 +94,7 @@ class VidRec_Brio():
         # info.desc().append_child_value("serial_number", self.serial_num)
         info.desc().append_child_value("fps_rgb", str(self.fps))
         info.desc().append_child_value("device_name", self.device_name)
-        print(f"-OUTLETID-:{streamName}:{self.oulet_id}")
+        send_event("outlet_id", name=streamName, outlet_id=self.oulet_id)
         return StreamOutlet(info)
 
     @catch_exception
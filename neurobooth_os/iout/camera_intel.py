@@ -15,6 +15,8 @@ import warnings
 import pyrealsense2 as rs
 from pylsl import StreamInfo, StreamOutlet
 
+from neurobooth_os.netcomm import send_event
+
 warnings.filterwarnings('ignore')
 
 def catch_exception(f):
@@ -62,7 +64,8 @@ class VidRec_Intel():
         self.name = name
         self.video_filename = "{}_intel{}.bag".format(name, self.device_index)
         self.config.enable_record_to_file(self.video_filename)
-        print(f"-new_filename-:{self.streamName}:{op.split(self.video_filename)[-1]}")
+        send_event("new_filename", stream_name=self.streamName,
+                   filename=op.split(self.video_filename)[-1])
 
     @catch_exception
     def createOutlet(self):
@@ -78,7 +81,7 @@ class VidRec_Intel():
         info.desc().append_child_value("serial_number", self.serial_num)
         info.desc().append_child_value("fps_rgb", str(self.fps[0]))
         info.desc().append_child_value("fps_depth", str(self.fps[1]))
-        print(f"-OUTLETID-:{self.streamName}:{self.outlet_id}")
+        send_event("outlet_id", name=self.streamName, outlet_id=self.outlet_id)
         return StreamOutlet(info)
 
     @catch_exception
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+# License: BSD-3-Clause
+# Offline snapshot of the configuration tables of the database
+
+"""Snapshot of the configuration tables of the database in a SQLite file.
+
+The tables read by metadator to prepare a session (study, collection,
+tech_obs_data, stimulus, instruction, device and sensor) are dumped as json
+rows with a version stamp, the sha256 of their content. metadator reads the
+snapshot instead of the database while it is fresh, and whatever its age
+when the database can not be reached, so the nodes start without the
+database. Export it with::
+
+    python -m neurobooth_os.iout.config_snapshot --remote --database mock_neurobooth
+
+The file has two tables::
+
+    rows (table_name, id, data)   json of each row by primary key
+    info (key, value)             format, created, created_ts, database, stamp
+"""
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+import os.path as op
+from datetime import datetime
+
+FORMAT_VERSION = 1
+DEFAULT_FNAME = op.join(op.expanduser("~"), ".neurobooth_os_snapshot.sqlite")
+
+# Tables of the snapshot and their primary key
+TABLES = {"study": "study_id",
+          "collection": "collection_id",
+          "tech_obs_data": "tech_obs_id",
+          "stimulus": "stimulus_id",
+          "instruction": "instruction_id",
+          "device": "device_id",
+          "sensor": "sensor_id"}
+
+
+def export_snapshot(conn, fname=DEFAULT_FNAME):
+    """Dump the configuration tables of the database to a snapshot file.
+
+    The file is written next to fname and then renamed, readers never see
+    a partial snapshot.
+
+    Parameters
+    ----------
+    conn : callable
+        Connector to the database.
+    fname : str
+        Path of the snapshot, by default ~/.neurobooth_os_snapshot.sqlite
+
+    Returns
+    -------
+    info : dict
+        "format", "created", "created_ts", "database", "stamp" and the
+        number of rows of each table "n_<table>".
+    """
+    tables = {}
+    with conn.cursor() as cursor:
+        for table, key in TABLES.items():
+            cursor.execute(f"SELECT row_to_json(t) FROM {table} t ORDER BY {key}")
+            tables[table] = [row for row, in cursor.fetchall()]
+    conn.rollback()
+
+    rows = [(table, str(row[TABLES[table]]), json.dumps(row, sort_keys=True))
+            for table, table_rows in tables.items() for row in table_rows]
+    stamp = hashlib.sha256()
+    for row in rows:
+        stamp.update("\t".join(row).encode() + b"\n")
+    now = time.time()
+    info = {"format": FORMAT_VERSION,
+            "created": datetime.fromtimestamp(now).isoformat(timespec="seconds"),
+            "created_ts": now,
+            "database": conn.info.dbname if hasattr(conn, "info") else None,
+            "stamp": stamp.hexdigest()}
+
+    tmp_fname = fname + ".tmp"
+    if op.exists(tmp_fname):
+        os.remove(tmp_fname)
+    db = sqlite3.connect(tmp_fname)
+    try:
+        with db:
+            db.execute("CREATE TABLE rows (table_name TEXT, id TEXT, data TEXT, "
+                       "PRIMARY KEY (table_name, id))")
+            db.execute("CREATE TABLE info (key TEXT PRIMARY KEY, value TEXT)")
+            db.executemany("INSERT INTO rows VALUES (?, ?, ?)", rows)
+            db.executemany("INSERT INTO info VALUES (?, ?)",
+                           [(k, json.dumps(v)) for k, v in info.items()])
+    finally:
+        db.close()
+    os.replace(tmp_fname, fname)
+    info.update({f"n_{table}": len(table_rows) for table, table_rows in tables.items()})
+    return info
+
+
+class ConfigSnapshot():
+    def __init__(self, fname, info, tables):
+        """Rows of a snapshot, read in memory, see ConfigSnapshot.load.
+
+        Parameters
+        ----------
+        fname : str
+            Path of the snapshot.
+        info : dict
+            "format", "created", "created_ts", "database" and "stamp".
+        tables : dict
+            Rows of each table, dicts by primary key.
+        """
+        self.fname = fname
+        self.info = info
+        self.tables = tables
+
+    @classmethod
+    def load(cls, fname=DEFAULT_FNAME, max_age=None):
+        """Read a snapshot.
+
+        Parameters
+        ----------
+        fname : str
+            Path of the snapshot, by default ~/.neurobooth_os_snapshot.sqlite
+        max_age : float | None
+            Seconds after which the snapshot is stale, None reads it
+            whatever its age, by default None
+
+        Returns
+        -------
+        snapshot : instance of ConfigSnapshot | None
+            The snapshot, None if the file is missing, of another format or
+            stale.
+        """
+        if not op.exists(fname):
+            return None
+        db = sqlite3.connect(f"file:{fname}?mode=ro", uri=True)
+        try:
+            info = {k: json.loads(v) for k, v in db.execute("SELECT key, value FROM info")}
+            if info.get("format") != FORMAT_VERSION:
+                return None
+            if max_age is not None and time.time() - info["created_ts"] > max_age:
+                return None
+            tables = {table: {} for table in TABLES}
+            for table, row_id, data in db.execute("SELECT table_name, id, data FROM rows"):
+                tables.setdefault(table, {})[row_id] = json.loads(data)
+        except sqlite3.DatabaseError as e:
+            print(f"Can not read the configuration snapshot {fname}: {e}")
+            return None
+        finally:
+            db.close()
+        return cls(fname, info, tables)
+
+    @property
+    def age(self):
+        """Seconds since the snapshot was exported."""
+        return time.time() - self.info["created_ts"]
+
+    def get(self, table, row_id):
+        """Row of a table as a dict, None if missing."""
+        return self.tables[table].get(str(row_id))
+
+    def row(self, table, row_id):
+        """Row of a table as a dict, raises KeyError if missing."""
+        row = self.get(table, row_id)
+        if row is None:
+            raise KeyError(f"{row_id} not in table {table} of the configuration snapshot "
+                           f"{self.fname}")
+        return row
+
+    def rows(self, table):
+        """Rows of a table, dicts by primary key."""
+        return self.tables[table]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--out", default=DEFAULT_FNAME, help="Path of the snapshot")
+    parser.add_argument("--remote", action="store_true", help="Connect with SSH tunneling")
+    parser.add_argument("--database", default="neurobooth")
+    args = parser.parse_args(argv)
+
+    from neurobooth_os.iout import metadator as meta
+    conn = meta.get_conn(remote=args.remote, database=args.database)
+    try:
+        info = export_snapshot(conn, args.out)
+    finally:
+        conn.close()
+    print(json.dumps(info, indent=1))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
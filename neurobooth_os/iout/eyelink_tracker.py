@@ -9,6 +9,7 @@ from pylsl import StreamInfo, StreamOutlet
 
 import neurobooth_os.config as config
 from neurobooth_os.tasks.smooth_pursuit.EyeLinkCoreGraphicsPsychoPy import EyeLinkCoreGraphicsPsychoPy
+from neurobooth_os.netcomm import send_event
 
 
 class EyeTracker():
@@ -53,7 +54,7 @@ class EyeTracker():
         self.stream_info.desc().append_child_value("sensor_ids", str(self.sensor_ids))
         self.outlet = StreamOutlet(self.stream_info)
         
-        print(f"-OUTLETID-:{self.streamName}:{self.oulet_id}")
+        send_event("outlet_id", name=self.streamName, outlet_id=self.oulet_id)
         self.streaming = False
         self.calibrated = True
         self.recording = False
@@ -107,7 +108,8 @@ class EyeTracker():
 
     def start(self, filename="TEST.EDF"):
         self.filename = filename        
-        print(f"-new_filename-:{self.streamName}:{op.split(filename)[-1]}")
+        send_event("new_filename", stream_name=self.streamName,
+                   filename=op.split(filename)[-1])
         self.fname_temp = "name8chr.edf"
         self.tk.openDataFile(self.fname_temp)
         # self.outlet = StreamOutlet(self.stream_info)
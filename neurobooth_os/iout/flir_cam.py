@@ -20,6 +20,8 @@ import skvideo
 import skvideo.io
 import h5py
 
+from neurobooth_os.netcomm import send_event
+
 os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
 
 
@@ -84,7 +86,7 @@ class VidRec_Flir():
         info.desc().append_child_value("gamma", str(self.gamma))
 
         # info.desc().append_child_value("device_model_id", self.cam.get_device_name().decode())
-        print(f"-OUTLETID-:{self.streamName}:{self.oulet_id}")
+        send_event("outlet_id", name=self.streamName, outlet_id=self.oulet_id)
         return StreamOutlet(info)
 
     # function to capture images, convert to numpy, send to queue, and release
@@ -117,7 +119,8 @@ class VidRec_Flir():
         self.FRAME_RATE_OUT = self.cam.AcquisitionResultingFrameRate()
         self.video_out = cv2.VideoWriter(self.video_filename, fourcc,
                                           self.FRAME_RATE_OUT, self.frameSize)
-        print(f"-new_filename-:{self.streamName}:{op.split(self.video_filename)[-1]}")
+        send_event("new_filename", stream_name=self.streamName,
+                   filename=op.split(self.video_filename)[-1])
 
         self.streaming = True
 
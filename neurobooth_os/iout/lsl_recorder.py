@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+# License: BSD-3-Clause
+# Record LSL streams to HDF5 files
+
+"""Record the LSL streams of a task directly to the split HDF5 files.
+
+Instead of recording an xdf file and splitting it once the task is done,
+the recorder pulls the samples of each stream in a background thread and
+appends them to the file of its device, see sensor_file for the layout. The
+clock offsets of the streams are measured during the recording and the time
+stamps are synchronized and dejittered when the recording stops, as
+split_sens_files does, so the files are ready when the task finishes.
+"""
+
+import ast
+import os.path as op
+import threading
+from time import perf_counter
+
+import numpy as np
+import pylsl
+
+from neurobooth_os.iout import metadator as meta
+from neurobooth_os.iout.xdf_reader import XdfStreamInfo, _parse_xml
+from neurobooth_os.iout.split_xdf import (_SensorFileWriter, _MemoryStream, _write_marker_file,
+                                          _parse_videofiles, _insert_sensor_file_rows)
+
+
+class _StreamRecorder():
+    def __init__(self, inlet, stream, writer, max_samples=1024):
+        """Pull the samples of an inlet into a writer.
+
+        Parameters
+        ----------
+        inlet : instance of pylsl.StreamInlet
+            The inlet, opened.
+        stream : instance of XdfStreamInfo
+            The stream.
+        writer : instance of _SensorFileWriter | _MemoryStream
+            Where the samples are appended.
+        max_samples : int
+            Samples pulled at most at a time, by default 1024
+        """
+        self.inlet = inlet
+        self.stream = stream
+        self.writer = writer
+        self.clock_offsets = []
+        self.buffered = 0
+        self.n_samples = 0
+        self.max_samples = max(max_samples, int(stream.srate))
+        self._buffer = None
+        if stream.dtype is not None:
+            self._buffer = np.empty((self.max_samples, stream.n_channels), stream.dtype)
+
+    def pull(self):
+        """Append the samples available, returns the number of samples pulled."""
+        if self._buffer is not None:
+            _, time_stamps = self.inlet.pull_chunk(timeout=0., max_samples=self.max_samples,
+                                                   dest_obj=self._buffer)
+            values = self._buffer[:len(time_stamps)].copy()
+        else:
+            values, time_stamps = self.inlet.pull_chunk(timeout=0.,
+                                                        max_samples=self.max_samples)
+        if not len(time_stamps):
+            return 0
+        n_bytes = self.writer.append(np.array(time_stamps), values)
+        self.buffered += n_bytes or 0
+        self.n_samples += len(time_stamps)
+        return len(time_stamps)
+
+    def time_correction(self, timeout=1.):
+        """Measure the clock offset of the stream, as LabRecorder does."""
+        try:
+            offset = self.inlet.time_correction(timeout)
+        except pylsl.TimeoutError:
+            return
+        self.clock_offsets.append((pylsl.local_clock(), offset))
+
+
+class LslRecorder():
+    def __init__(self, inlets, folder, conn=None, buffer_size=32e6, poll_interval=.05,
+                 clock_interval=5., compression="gzip", compression_opts=4, chunk_size=1e6):
+        """Record LSL streams directly to the HDF5 files of split_sens_files.
+
+        The recorder opens its own inlets, the inlets given can still be
+        pulled by the plotter::
+
+            recorder = LslRecorder(inlets, cfg.paths["data_out"], conn)
+            recorder.start(rec_fname, tech_obs_log_id, tech_obs_id)
+            ...
+            files = recorder.stop()
+
+        Parameters
+        ----------
+        inlets : dict
+            Inlets of the streams to record, by stream name.
+        folder : str
+            Folder of the files.
+        conn : callable | instance of ConnectionPool | None
+            Connector to the database, or pool whose connections are taken
+            only while querying, if None does not insert rows, by default None
+        buffer_size : float
+            Bytes of samples of a stream held in memory before they are
+            written to its file, by default 32e6
+        poll_interval : float
+            Seconds between two pulls of the inlets, by default .05
+        clock_interval : float
+            Seconds between two measures of the clock offsets, by default 5.
+        compression : str | None
+            Compression of the datasets, see split_sens_files, by default "gzip"
+        compression_opts : int | None
+            Level of the gzip compression, by default 4
+        chunk_size : float
+            Bytes per chunk of the datasets, the datasets grow as samples are
+            recorded so they can not be contiguous. By default 1e6
+        """
+        if chunk_size is None:
+            raise ValueError("Recorded datasets are resized, chunk_size can not be None")
+        self.infos = {name: inlet.info() for name, inlet in inlets.items()}
+        self.folder = folder
+        self.conn = conn
+        self.buffer_size = buffer_size
+        self.poll_interval = poll_interval
+        self.clock_interval = clock_interval
+        self.kwargs = dict(compression=compression, compression_opts=compression_opts,
+                           chunk_size=chunk_size)
+        self.recording = False
+        self._recorders = []
+        self._files = []
+        self._marker = None
+        self._videofiles = None
+        self._thread = None
+        self._stop_event = threading.Event()
+        self._error = None
+
+    def start(self, rec_fname, tech_obs_log_id=None, tech_obs_id=None):
+        """Open the inlets and the files and start recording.
+
+        Parameters
+        ----------
+        rec_fname : str
+            Name of the recording, files are named
+            ``{rec_fname}-{device_id}-{sensors}.hdf5`` as split_sens_files
+            names them after the xdf file.
+        tech_obs_log_id : str, optional
+            task log id for the database, by default None
+        tech_obs_id : str, optional
+            task id, only the devices of the task are recorded if not None,
+            by default None
+        """
+        if self.recording:
+            raise RuntimeError("Already recording, stop the recording first")
+        devices_ids = None
+        if self.conn is not None and tech_obs_id is not None:
+            with meta.checkout(self.conn) as conn:
+                _, devices_ids, _, _ = meta._get_task_param(tech_obs_id, conn)
+
+        self.rec_fname = rec_fname
+        self.tech_obs_log_id = tech_obs_log_id
+        self._recorders, self._files = [], []
+        self._marker, self._videofiles = None, None
+        self._error = None
+        head = op.join(self.folder, rec_fname)
+        for stream_id, (name, info) in enumerate(self.infos.items(), 1):
+            stream = XdfStreamInfo(stream_id, _parse_xml(info.as_xml().encode()))
+            if name in ["Marker", "videofiles"]:
+                writer = _MemoryStream(stream)
+            else:
+                desc = stream.info.get("desc", [None])[0] or {}
+                if "device_id" not in desc or "sensor_ids" not in desc:
+                    print(f"Skipping {name}, no device_id and sensor_ids in its description")
+                    continue
+                device_id = desc["device_id"][0]
+                sensors_id = ast.literal_eval(desc["sensor_ids"][0])
+                if devices_ids is not None and device_id not in devices_ids:
+                    print(f"Skipping {name} not in tech obs device list: {devices_ids}")
+                    continue
+
+            # The info of an inlet can not open another one, resolve the outlet again
+            resolved = pylsl.resolve_byprop("source_id", info.source_id(), timeout=1)
+            if not resolved:
+                print(f"Skipping {name}, its outlet was not found")
+                continue
+            inlet = pylsl.StreamInlet(resolved[0], max_buflen=360, recover=True)
+            inlet.open_stream(timeout=5)
+
+            if name not in ["Marker", "videofiles"]:
+                fname_full = f"{head}-{device_id}-{'-'.join(sensors_id)}.hdf5"
+                print(f"Recording stream {name} to {fname_full}")
+                writer = _SensorFileWriter(fname_full, stream, device_id, sensors_id,
+                                           **self.kwargs)
+                self._files.append((fname_full, name, device_id, sensors_id))
+            self._recorders.append(_StreamRecorder(inlet, stream, writer))
+            if name == "Marker":
+                self._marker = self._recorders[-1]
+            elif name == "videofiles":
+                self._videofiles = self._recorders[-1]
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._record, daemon=True)
+        self._thread.start()
+        self.recording = True
+
+    def _pull(self):
+        for recorder in self._recorders:
+            while recorder.pull() == recorder.max_samples:
+                pass
+            if recorder.buffered > self.buffer_size:
+                recorder.writer.flush()
+                recorder.buffered = 0
+
+    def _record(self):
+        try:
+            last_correction = None
+            while not self._stop_event.wait(self.poll_interval):
+                self._pull()
+                now = perf_counter()
+                if last_correction is None or now - last_correction > self.clock_interval:
+                    for recorder in self._recorders:
+                        recorder.time_correction()
+                    last_correction = now
+            self._pull()
+        except Exception as e:
+            self._error = e
+            print(f"Recording {self.rec_fname} stopped: {type(e).__name__}: {e}")
+
+    def stop(self, return_report=False):
+        """Stop recording, finish the files and insert their rows in the database.
+
+        Parameters
+        ----------
+        return_report : bool
+            If True, also return the recording report, by default False
+
+        Returns
+        -------
+        files : list
+            list of files for each device stream
+        report : dict
+            Only if return_report. "n_streams", "n_samples", the seconds
+            spent finishing the files "close_s", in the database "db_s" and
+            in total "total_s", and the time stamp "quality" of each file
+            by file name.
+        """
+        if not self.recording:
+            raise RuntimeError("Not recording")
+        t_start = perf_counter()
+        self._stop_event.set()
+        self._thread.join()
+        self.recording = False
+        for recorder in self._recorders:
+            recorder.time_correction()
+            recorder.inlet.close_stream()
+
+        marker_file = None
+        if self._marker is not None:
+            marker_file = op.join(self.folder, f"{self.rec_fname}-marker.hdf5")
+            marker = self._marker.writer.close(self._marker.clock_offsets)
+            _write_marker_file(marker_file, dict(marker, stream=self._marker.stream),
+                               **self.kwargs)
+        videofiles = {}
+        if self._videofiles is not None:
+            data = self._videofiles.writer.close(self._videofiles.clock_offsets)
+            videofiles = _parse_videofiles(data["time_series"])
+
+        summaries = [recorder.writer.close(recorder.clock_offsets, marker_file)
+                     for recorder in self._recorders
+                     if isinstance(recorder.writer, _SensorFileWriter)]
+        close_time = perf_counter() - t_start
+        db_time = 0
+        if self.conn is not None:
+            with meta.checkout(self.conn) as conn:
+                db_time = _insert_sensor_file_rows(self.tech_obs_log_id, self._files, summaries,
+                                                   videofiles, conn)
+        if self._error is not None:
+            raise RuntimeError(f"Recording {self.rec_fname} failed") from self._error
+
+        files = [fname_full for fname_full, *_ in self._files]
+        report = {"n_streams": len(files),
+                  "n_samples": sum(summary["n_samples"] for summary in summaries),
+                  "close_s": round(close_time, 3),
+                  "db_s": round(db_time, 3),
+                  "total_s": round(perf_counter() - t_start, 3)}
+        print(f"Recording report of {self.rec_fname}: {report}")
+        report["quality"] = {op.basename(fname_full): summary["quality"]
+                             for fname_full, summary in zip(files, summaries)}
+        if return_report:
+            return files, report
+        return files
@@ -8,6 +8,7 @@ import time
 
 from neurobooth_os import config
 from neurobooth_os.iout import metadator as meta
+from neurobooth_os.netcomm import send_event
 
 
 def start_lsl_threads(node_name, collection_id="mvp_025", win=None, conn=None):
@@ -22,7 +23,8 @@ def start_lsl_threads(node_name, collection_id="mvp_025", win=None, conn=None):
     win : object, optional
         Pycharm window, by default None
     conn : object, optional
-        Connector to the database, by default None
+        Connector to the database, or pool, by default None uses the
+        connection pool of the process
 
     Returns
     -------
@@ -31,10 +33,9 @@ def start_lsl_threads(node_name, collection_id="mvp_025", win=None, conn=None):
     """
 
     if conn is None:
-        print("getting conn")
-        conn = meta.get_conn()
+        conn = meta.get_pool()
 
-    # Get params from all tasks
+    # Get params from all tasks, the collection cached by the prepare for conn
     kwarg_devs = meta._get_coll_dev_kwarg_tasks(collection_id, conn)
     # Get all device params from session
     kwarg_alldevs = {}
@@ -131,6 +132,6 @@ def reconnect_streams(streams):
         if not streams[k].streaming:
             print(f"Re-streaming {k} stream")
             streams[k].start()
-        print(f"-OUTLETID-:{k}:{streams[k].oulet_id}")
+        send_event("outlet_id", name=k, outlet_id=streams[k].oulet_id)
 
     return streams
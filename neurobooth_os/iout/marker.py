@@ -3,6 +3,8 @@ import uuid
 
 from pylsl import StreamInfo, StreamOutlet
 
+from neurobooth_os.netcomm import send_event
+
 
 def marker_stream(name='Marker', outlet_id=None):
     """Create marker stream to be pushed when needed with a string format:
@@ -34,7 +36,7 @@ def marker_stream(name='Marker', outlet_id=None):
     outlet_marker.outlet_id = outlet_id
     outlet_marker.name = name
     outlet_marker.push_sample([f"Stream-created_0_{time.time()}"])
-    print(f"-OUTLETID-:{name}:{outlet_id}")
+    send_event("outlet_id", name=name, outlet_id=outlet_id)
     outlet_marker.stop = outlet_marker.__del__
     outlet_marker.streaming = True
 
@@ -9,6 +9,8 @@ from sys import argv
 from mbientlab.metawear import MetaWear, libmetawear, parse_value, cbindings
 from pylsl import StreamInfo, StreamOutlet, local_clock
 
+from neurobooth_os.netcomm import send_event
+
 
 states = []
 
@@ -40,7 +42,7 @@ class Sensor:
         self.stream_mbient.desc().append_child_value("sensor_ids", str(sensor_ids))
 
         self.setup()
-        print(f"-OUTLETID-:mbient_{self.dev_name}:{self.oulet_id}")
+        send_event("outlet_id", name=f"mbient_{self.dev_name}", outlet_id=self.oulet_id)
 
     def createOutlet(self, filename):
         streamName = 'XimeaFrameIndex'
@@ -57,7 +59,7 @@ class Sensor:
         info.desc().append_child_value("serial_number", self.serial_num)
         info.desc().append_child_value("fps_rgb", str(self.fps))
         info.desc().append_child_value("device_model_id", self.cam.get_device_name().decode())
-        print(f"-OUTLETID-:{streamName}:{self.oulet_id}")
+        send_event("outlet_id", name=streamName, outlet_id=self.oulet_id)
         return StreamOutlet(info)
 
     def connect(self):
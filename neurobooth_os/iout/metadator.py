@@ -6,15 +6,86 @@ Created on Fri Jul 30 09:08:53 2021
 """
 import os.path as op
 import json
+import time
+import threading
+from contextlib import contextmanager
 from collections import OrderedDict
 from datetime import datetime
 
-from sshtunnel import SSHTunnelForwarder
+from sshtunnel import SSHTunnelForwarder, BaseSSHTunnelForwarderError
 import psycopg2
+from psycopg2 import sql
+from psycopg2.pool import ThreadedConnectionPool
+from psycopg2.extras import execute_values
 from neurobooth_terra import  Table
 
 import neurobooth_os
 from neurobooth_os.secrets_info import secrets
+from neurobooth_os.iout.config_snapshot import ConfigSnapshot, export_snapshot, DEFAULT_FNAME
+
+# Collections loaded by load_collection, by (dsn, collection_id)
+_collection_cache = {}
+_collection_cache_lock = threading.Lock()
+
+# SSH tunnel to the database shared by the connections of the process
+_tunnel = None
+_tunnel_lock = threading.Lock()
+
+# Seconds before a connection attempt fails, the snapshot is read then
+_connect_timeout = 10
+
+# Connection pools of the process, by (remote, database)
+_pools = {}
+_pools_lock = threading.Lock()
+
+# Configuration snapshot read instead of the database while fresh, see use_snapshot
+_snapshot_fname = DEFAULT_FNAME
+_snapshot_max_age = 24 * 3600.
+_snapshot_cache = {}
+_snapshot_lock = threading.Lock()
+
+# Errors of an unreachable database
+DB_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError, BaseSSHTunnelForwarderError)
+
+
+def _get_tunnel():
+    """Start the SSH tunnel of the process, or restart it if it stopped."""
+    global _tunnel
+    with _tunnel_lock:
+        if _tunnel is not None and _tunnel.is_active:
+            return _tunnel
+        # A free local port the first time, the same one when restarted so
+        # that the connections opened later reach the database
+        port = 0 if _tunnel is None else _tunnel.local_bind_port
+        if _tunnel is not None:
+            print("SSH tunnel to the database stopped, restarting it")
+            _tunnel.stop()
+        _tunnel = SSHTunnelForwarder(
+            secrets['database']['remote_address'],
+            ssh_username=secrets['database']['remote_username'],
+            ssh_config_file='~/.ssh/config',
+            ssh_pkey='~/.ssh/id_rsa',
+            remote_bind_address=(secrets['database']['host'], 5432),
+            local_bind_address=('localhost', port))
+        _tunnel.start()
+        return _tunnel
+
+
+def _connect_kwargs(remote, database):
+    if remote:
+        tunnel = _get_tunnel()
+        host = tunnel.local_bind_host
+        port = tunnel.local_bind_port
+    else:
+        host = secrets['database']['host']
+        port = 5432
+    return dict(database=database,
+                user=secrets['database']['user'],
+                password=secrets['database']['pass'],
+                host=host,
+                port=port,
+                connect_timeout=_connect_timeout)
+
 
 def get_conn(remote=False, database='neurobooth'):
     """ Gets connector to the database
@@ -22,7 +93,8 @@ def get_conn(remote=False, database='neurobooth'):
     Parameters
     ----------
     remote : bool, optional
-        Flag to use SSH tunneling to connect, by default False
+        Flag to use SSH tunneling to connect, the tunnel is shared by the
+        connections of the process, by default False
     database : str, optional
         Name of the database, by default 'neurobooth'
 
@@ -31,35 +103,282 @@ def get_conn(remote=False, database='neurobooth'):
     conn : object
         connector to psycopg database
     """
-    if remote:
-        tunnel = SSHTunnelForwarder(
-            secrets['database']['remote_address'],
-            ssh_username=secrets['database']['remote_username'],
-            ssh_config_file='~/.ssh/config',
-            ssh_pkey='~/.ssh/id_rsa',
-            remote_bind_address=(secrets['database']['host'], 5432),
-            local_bind_address=('localhost', 6543))
-        tunnel.start()
-        host = tunnel.local_bind_host
-        port = tunnel.local_bind_port
+    return psycopg2.connect(**_connect_kwargs(remote, database))
+
+
+class ConnectionPool():
+    def __init__(self, remote=False, database='neurobooth', minconn=1, maxconn=8,
+                 health_interval=30.):
+        """Connections to the database shared by the threads of a process.
+
+        Use a connection from a thread and give it back with::
+
+            with pool.connection() as conn:
+                meta._insert_rows("sensor_file_log", rows, cols, conn)
+
+        Parameters
+        ----------
+        remote : bool
+            Flag to use SSH tunneling to connect, by default False
+        database : str
+            Name of the database, by default 'neurobooth'
+        minconn : int
+            Connections opened when the pool is created, by default 1
+        maxconn : int
+            Connections open at most, threads wait for one to be given back
+            when all are used, by default 8
+        health_interval : float
+            Seconds a connection can stay unused before it is checked with
+            a query when taken, by default 30.
+        """
+        self.remote = remote
+        self.database = database
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.health_interval = health_interval
+        self._pool = None
+        self._lock = threading.Lock()
+        self._available = threading.BoundedSemaphore(maxconn)
+        self._last_used = {}
+
+    def _open(self):
+        # Must hold self._lock
+        if self._pool is None or self._pool.closed:
+            self._pool = ThreadedConnectionPool(self.minconn, self.maxconn,
+                                                **_connect_kwargs(self.remote, self.database))
+
+    def _healthy(self, conn):
+        if conn.closed:
+            return False
+        if time.time() - self._last_used.get(id(conn), 0) < self.health_interval:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            return False
+        return True
+
+    def getconn(self, timeout=None):
+        """Take a healthy connection, reconnecting if needed.
+
+        Parameters
+        ----------
+        timeout : float | None
+            Seconds to wait for a connection when all are used, None waits
+            until one is given back, by default None
+
+        Returns
+        -------
+        conn : object
+            connector to psycopg database, give it back with putconn.
+        """
+        if not self._available.acquire(timeout=-1 if timeout is None else timeout):
+            raise TimeoutError(f"No connection to {self.database} given back in {timeout} s")
+        try:
+            with self._lock:
+                self._open()
+                conn = self._pool.getconn()
+            if not self._healthy(conn):
+                print(f"Connection to {self.database} lost, reconnecting")
+                with self._lock:
+                    self._pool.putconn(conn, close=True)
+                    if self.remote:
+                        _get_tunnel()
+                    conn = self._pool.getconn()
+        except Exception:
+            self._available.release()
+            raise
+        return conn
+
+    def putconn(self, conn, close=False):
+        """Give back a connection, closed if close or broken."""
+        self._last_used[id(conn)] = time.time()
+        with self._lock:
+            if self._pool is not None and not self._pool.closed:
+                self._pool.putconn(conn, close=close or bool(conn.closed))
+        self._available.release()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """Context manager taking a connection and giving it back.
+
+        The transaction left open is rolled back when the connection is
+        given back, a connection that failed is closed and replaced.
+        """
+        conn = self.getconn(timeout)
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            self.putconn(conn, close=True)
+            raise
+        except BaseException:
+            self.putconn(conn)
+            raise
+        else:
+            self.putconn(conn)
+
+    def closeall(self):
+        """Close all the connections of the pool."""
+        with self._lock:
+            if self._pool is not None and not self._pool.closed:
+                self._pool.closeall()
+
+
+def get_pool(remote=False, database='neurobooth', **kwargs):
+    """Connection pool of the process to a database, created once.
+
+    Parameters
+    ----------
+    remote : bool, optional
+        Flag to use SSH tunneling to connect, by default False
+    database : str, optional
+        Name of the database, by default 'neurobooth'
+    **kwargs : dict
+        minconn, maxconn and health_interval of the pool when it is created,
+        see ConnectionPool.
+
+    Returns
+    -------
+    pool : instance of ConnectionPool
+        The pool.
+    """
+    with _pools_lock:
+        if (remote, database) not in _pools:
+            _pools[(remote, database)] = ConnectionPool(remote, database, **kwargs)
+        return _pools[(remote, database)]
+
+
+@contextmanager
+def checkout(conn):
+    """Connection of a pool, or conn itself if it is a connection.
+
+    Functions run in threads accept either::
+
+        with meta.checkout(conn) as conn:
+            ...
+    """
+    if isinstance(conn, ConnectionPool):
+        with conn.connection() as pooled_conn:
+            yield pooled_conn
     else:
-        host = secrets['database']['host']
-        port = 5432
-    conn = psycopg2.connect(database=database, 
-                            user=secrets['database']['user'],
-                            password=secrets['database']['pass'],
-                            host=host,
-                            port=port)
-    return conn
+        yield conn
 
 
-def get_study_ids(conn):
+def use_snapshot(fname=DEFAULT_FNAME, max_age=24 * 3600.):
+    """Set the configuration snapshot read instead of the database.
+
+    Parameters
+    ----------
+    fname : str | None
+        Path of the snapshot, see config_snapshot. If None the database is
+        always read. By default ~/.neurobooth_os_snapshot.sqlite
+    max_age : float
+        Seconds during which the snapshot is read instead of the database,
+        by default one day. Older snapshots are only read when the database
+        can not be reached.
+    """
+    global _snapshot_fname, _snapshot_max_age
+    _snapshot_fname, _snapshot_max_age = fname, max_age
+
+
+def get_snapshot(fresh=True):
+    """Configuration snapshot set with use_snapshot.
+
+    Parameters
+    ----------
+    fresh : bool
+        If True, return None when the snapshot is older than its max_age,
+        by default True
+
+    Returns
+    -------
+    snapshot : instance of ConfigSnapshot | None
+        The snapshot, None if there is none.
+    """
+    fname = _snapshot_fname
+    if fname is None or not op.exists(fname):
+        return None
+    mtime = op.getmtime(fname)
+    with _snapshot_lock:
+        # Read again only when the file changed
+        if _snapshot_cache.get(fname, (None,))[0] != mtime:
+            _snapshot_cache[fname] = (mtime, ConfigSnapshot.load(fname))
+        snapshot = _snapshot_cache[fname][1]
+    if snapshot is None or (fresh and snapshot.age > _snapshot_max_age):
+        return None
+    return snapshot
+
+
+def snapshot_stamp():
+    """Stamp of the fresh snapshot, None if there is none."""
+    snapshot = get_snapshot()
+    return None if snapshot is None else snapshot.info["stamp"]
+
+
+def refresh_snapshot(conn):
+    """Export the snapshot from the database if it is not fresh.
+
+    Database errors are printed, the snapshot is kept as it is.
+
+    Parameters
+    ----------
+    conn : callable | instance of ConnectionPool
+        Connector to the database.
+
+    Returns
+    -------
+    snapshot : instance of ConfigSnapshot | None
+        The snapshot, None if it was not fresh and could not be exported.
+    """
+    if _snapshot_fname is None:
+        return None
+    snapshot = get_snapshot()
+    if snapshot is not None:
+        return snapshot
+    try:
+        with checkout(conn) as db_conn:
+            info = export_snapshot(db_conn, _snapshot_fname)
+    except DB_ERRORS as e:
+        print(f"Configuration snapshot not exported, database unreachable: {e}")
+        return None
+    print(f"Configuration snapshot {info['stamp'][:12]} exported to {_snapshot_fname}")
+    return get_snapshot(fresh=False)
+
+
+def _read_config(from_snapshot, from_db, conn, use_snapshot=True):
+    # Configuration read from the fresh snapshot, else from the database, else
+    # from the snapshot whatever its age if the database can not be reached
+    snapshot = get_snapshot() if use_snapshot else None
+    if snapshot is not None:
+        try:
+            return from_snapshot(snapshot)
+        except KeyError:
+            pass  # Row added to the database after the snapshot
+    try:
+        with checkout(conn) as db_conn:
+            return from_db(db_conn)
+    except DB_ERRORS as e:
+        snapshot = get_snapshot(fresh=False)
+        if snapshot is None:
+            raise
+        print(f"Database unreachable, reading the configuration snapshot of "
+              f"{snapshot.info['created']}: {e}")
+        return from_snapshot(snapshot)
+
+
+def _get_study_ids(conn):
     table_study = Table('study', conn=conn)
     studies_df = table_study.query()
     study_ids = studies_df.index.values.tolist()
     return study_ids
 
 
+def get_study_ids(conn):
+    return _read_config(lambda snapshot: list(snapshot.rows("study")), _get_study_ids, conn)
+
+
 def get_subject_ids(conn, first_name, last_name):
     table_subject = Table('subject', conn=conn)
     subject_df = table_subject.query(
@@ -67,20 +386,31 @@ def get_subject_ids(conn, first_name, last_name):
     return subject_df
 
 
-def get_collection_ids(study_id, conn):
+def _get_collection_ids(study_id, conn):
     table_study = Table('study', conn=conn)
     studies_df = table_study.query()
     collection_ids = studies_df.loc[study_id, "collection_ids"]
     return collection_ids
 
 
-def get_tasks(collection_id, conn):
+def get_collection_ids(study_id, conn):
+    return _read_config(lambda snapshot: snapshot.row("study", study_id)["collection_ids"],
+                        lambda conn: _get_collection_ids(study_id, conn), conn)
+
+
+def _get_tasks(collection_id, conn):
     table_collection = Table('collection', conn=conn)
     collection_df = table_collection.query(where=f"collection_id = '{collection_id}'")
     tasks_ids, = collection_df["tech_obs_array"]
     return tasks_ids
 
 
+def get_tasks(collection_id, conn):
+    return _read_config(
+        lambda snapshot: snapshot.row("collection", collection_id)["tech_obs_array"],
+        lambda conn: _get_tasks(collection_id, conn), conn)
+
+
 def _new_tech_log_dict(application_id="neurobooth_os"):
     tech_obs_log = OrderedDict()
     tech_obs_log["subject_id"] = ""
@@ -107,42 +437,151 @@ def _fill_tech_obs_row(tech_obs_id, dict_vals, conn):
     table.update_row(tech_obs_id, tuple(vals), cols=list(dict_vals))
 
 
-def _get_task_param(obs_id, conn):
-    table_tech_obs = Table('tech_obs_data', conn=conn)
-    tech_obs_df = table_tech_obs.query(where=f"tech_obs_id = '{obs_id}'")
-    devices_ids, = tech_obs_df["device_id_array"]
-    sens_ids, = tech_obs_df["sensor_id_array"]
-    stimulus_id, = tech_obs_df["stimulus_id"]
-    instr_id,  =  tech_obs_df["instruction_id"]
-    instr_kwargs = _get_instruct_dic_param(instr_id, conn)
-    return stimulus_id, devices_ids, sens_ids, instr_kwargs
-
-
-def _get_instruct_dic_param(instruction_id, conn):
-    if instruction_id is None:
+def _allocate_tech_obs_rows(subject_id, n_rows, conn):
+    """Insert empty tech_obs_log rows of a subject with one query.
+
+    Parameters
+    ----------
+    subject_id : str
+        The subject of the rows.
+    n_rows : int
+        Number of rows.
+    conn : callable
+        Connector to the database.
+
+    Returns
+    -------
+    tech_obs_log_ids : list of str
+        The ids of the rows, filled later with _write_tech_obs_ops.
+    """
+    with conn:
+        with conn.cursor() as cursor:
+            cursor.execute("INSERT INTO tech_obs_log (subject_id) "
+                           "SELECT %s FROM generate_series(1, %s) "
+                           "RETURNING tech_obs_log_id", (subject_id, n_rows))
+            return [row_id for row_id, in cursor.fetchall()]
+
+
+def _write_tech_obs_ops(ops, conn):
+    """Apply tech_obs_log writes in order, in one transaction.
+
+    Parameters
+    ----------
+    ops : list of dict
+        {"op": "insert", "id": str, "subject_id": str} inserts a row with
+        its id, {"op": "fill", "id": str, "values": dict} sets the columns
+        of a row as _fill_tech_obs_row and {"op": "delete", "ids": list}
+        deletes rows.
+    conn : callable
+        Connector to the database, rolled back if a write fails.
+    """
+    with conn:
+        with conn.cursor() as cursor:
+            for write in ops:
+                if write["op"] == "insert":
+                    cursor.execute("INSERT INTO tech_obs_log (tech_obs_log_id, subject_id) "
+                                   "VALUES (%s, %s)", (write["id"], write["subject_id"]))
+                elif write["op"] == "fill":
+                    cols = list(write["values"])
+                    query = sql.SQL("UPDATE tech_obs_log SET ({}) = ROW({}) "
+                                    "WHERE tech_obs_log_id = %s").format(
+                        sql.SQL(", ").join(map(sql.Identifier, cols)),
+                        sql.SQL(", ").join(sql.Placeholder() * len(cols)))
+                    cursor.execute(query, [write["values"][col] for col in cols] + [write["id"]])
+                elif write["op"] == "delete":
+                    cursor.execute("DELETE FROM tech_obs_log WHERE tech_obs_log_id = ANY(%s)",
+                                   (write["ids"],))
+                else:
+                    raise ValueError(f"Unknown tech_obs_log write {write['op']}")
+
+
+def _insert_rows(table_name, rows, cols, conn):
+    """Insert rows with one multi-row INSERT in a single transaction.
+
+    Parameters
+    ----------
+    table_name : str
+        Name of the table.
+    rows : list of tuple
+        Values of the rows, in the order of cols.
+    cols : list of str
+        Names of the columns.
+    conn : callable
+        Connector to the database, rolled back if the insert fails.
+    """
+    if not len(rows):
+        return
+    query = sql.SQL("INSERT INTO {} ({}) VALUES %s").format(
+        sql.Identifier(table_name), sql.SQL(", ").join(map(sql.Identifier, cols)))
+    with conn:
+        with conn.cursor() as cursor:
+            execute_values(cursor, query, rows, page_size=len(rows))
+
+
+def get_task_params(obs_ids, conn):
+    """Parameters of tasks, read with one query.
+
+    Parameters
+    ----------
+    obs_ids : list of str
+        The tech_obs_id of the tasks.
+    conn : callable | instance of ConnectionPool
+        Connector to the database.
+
+    Returns
+    -------
+    params : dict
+        (stimulus_id, device_ids, sensor_ids, instr_kwargs) of each task by
+        tech_obs_id, tasks not in the database are missing.
+    """
+    return _read_config(lambda snapshot: _get_task_params_snapshot(obs_ids, snapshot),
+                        lambda conn: _get_task_params_db(obs_ids, conn), conn)
+
+
+def _task_params(task, instruction):
+    return task["stimulus_id"], task["device_id_array"], task["sensor_id_array"], \
+        _instr_kwargs(instruction)
+
+
+def _get_task_params_snapshot(obs_ids, snapshot):
+    params = {}
+    for obs_id in obs_ids:
+        task = snapshot.row("tech_obs_data", obs_id)
+        instruction = None
+        if task["instruction_id"] is not None:
+            instruction = snapshot.get("instruction", task["instruction_id"])
+        params[obs_id] = _task_params(task, instruction)
+    return params
+
+
+def _get_task_params_db(obs_ids, conn):
+    if not len(obs_ids):
         return {}
-    table = Table('instruction', conn=conn)
-    instr = table.query(where=f"instruction_id = '{instruction_id}'")
-    dict_instr = instr.iloc[0].to_dict()
-    #remove unnecessary fields
-    _ = [dict_instr.pop(l) for l in ['is_active', 'date_created', 'version', 'assigned_tech_obs']]
-    return dict_instr
+    rows = _fetch_json_rows(
+        """SELECT row_to_json(t), row_to_json(i)
+           FROM tech_obs_data t
+           LEFT JOIN instruction i ON i.instruction_id = t.instruction_id
+           WHERE t.tech_obs_id = ANY(%s)""", (list(obs_ids),), conn)
+    return {task["tech_obs_id"]: _task_params(task, instruction) for task, instruction in rows}
 
 
-def _get_task_stim(stimulus_id, conn):
-    table_stimulus = Table('stimulus', conn)
-    stimulus_df = table_stimulus.query(where=f"stimulus_id = '{stimulus_id}'")
-    stim_file, = stimulus_df["stimulus_file"]
+def _get_task_param(obs_id, conn):
+    return get_task_params([obs_id], conn)[obs_id]
 
-    taks_kwargs = {"duration": stimulus_df['duration'][0],
-                    'num_iterations':stimulus_df['num_iterations'][0]}
 
-    if not stimulus_df['parameters'].isnull().all():
-        params = stimulus_df['parameters'].values[0]
+def _stim_kwargs(stimulus):
+    # stimulus file and task kwargs from a stimulus row
+    stim_file = stimulus["stimulus_file"]
+
+    taks_kwargs = {"duration": stimulus['duration'],
+                    'num_iterations':stimulus['num_iterations']}
+
+    params = stimulus['parameters']
+    if params is not None and not (isinstance(params, float) and params != params):
         taks_kwargs.update(params)
 
     # Load args from jason if any
-    stim_fparam, = stimulus_df["parameters_file"]
+    stim_fparam = stimulus["parameters_file"]
     if stim_fparam is not None:
         dirpath =  op.split(neurobooth_os.__file__)[0]
         with open(op.join(dirpath, stim_fparam.replace('./', '')), 'rb') as f:
@@ -152,20 +591,78 @@ def _get_task_stim(stimulus_id, conn):
     return stim_file, taks_kwargs
 
 
+def get_sens_params(sens_ids, conn):
+    """Parameters of sensors, read with one query.
+
+    Parameters
+    ----------
+    sens_ids : list of str
+        The sensor_id of the sensors.
+    conn : callable | instance of ConnectionPool
+        Connector to the database.
+
+    Returns
+    -------
+    params : dict
+        The sensor row without sensor_id of each sensor by sensor_id,
+        sensors not in the database are missing.
+    """
+    def from_snapshot(snapshot):
+        return {sens_id: {k: v for k, v in snapshot.row("sensor", sens_id).items()
+                          if k != "sensor_id"} for sens_id in sens_ids}
+    return _read_config(from_snapshot, lambda conn: _get_sens_params_db(sens_ids, conn), conn)
+
+
+def _get_sens_params_db(sens_ids, conn):
+    if not len(sens_ids):
+        return {}
+    params = {}
+    for sensor, in _fetch_json_rows("SELECT row_to_json(s) FROM sensor s "
+                                    "WHERE s.sensor_id = ANY(%s)", (list(sens_ids),), conn):
+        params[sensor.pop("sensor_id")] = sensor
+    return params
+
+
 def get_sens_param(sens_id, conn):
-    table_sens = Table('sensor', conn=conn)
-    tech_obs_df = table_sens.query(where=f"sensor_id = '{sens_id}'")
-    param = tech_obs_df.iloc[0].to_dict()
-    return param
+    return get_sens_params([sens_id], conn)[sens_id]
+
+
+def get_dev_sns(dev_ids, conn):
+    """Serial numbers of devices, read with one query.
+
+    Parameters
+    ----------
+    dev_ids : list of str
+        The device_id of the devices.
+    conn : callable | instance of ConnectionPool
+        Connector to the database.
+
+    Returns
+    -------
+    sns : dict
+        The device_sn of each device by device_id, None for the devices
+        not in the database.
+    """
+    def from_snapshot(snapshot):
+        return {dev_id: snapshot.row("device", dev_id)["device_sn"] for dev_id in dev_ids}
+
+    def from_db(conn):
+        devices = _get_devices_db(dev_ids, conn)
+        return {dev_id: devices.get(dev_id, {}).get("device_sn") for dev_id in dev_ids}
+    return _read_config(from_snapshot, from_db, conn)
+
+
+def _get_devices_db(dev_ids, conn):
+    # Device rows by device_id
+    if not len(dev_ids):
+        return {}
+    return {device["device_id"]: device for device, in
+            _fetch_json_rows("SELECT row_to_json(d) FROM device d "
+                             "WHERE d.device_id = ANY(%s)", (list(dev_ids),), conn)}
 
 
 def get_dev_sn(dev_id, conn):
-    table_sens = Table('device', conn=conn)
-    device_df = table_sens.query(where=f"device_id = '{dev_id}'")
-    sn = device_df["device_sn"]
-    if len(sn) == 0:
-        return None
-    return sn[0]
+    return get_dev_sns([dev_id], conn)[dev_id]
 
 
 def meta_devinfo_tofunct(dev_id_param, dev_id):
@@ -248,19 +745,28 @@ def meta_devinfo_tofunct(dev_id_param, dev_id):
 def get_kwarg_task(task_id, conn):
 
     stim_id, dev_ids, sens_ids, _ = _get_task_param(task_id, conn)
+    sns = get_dev_sns(dev_ids, conn)
+    params = get_sens_params([sens_id for ids in sens_ids for sens_id in ids if sens_id != ""],
+                             conn)
+    return _dev_kwargs(dev_ids, sens_ids, sns.get, lambda sens_id: dict(params[sens_id]))
+
+
+def _dev_kwargs(dev_ids, sens_ids, get_sn, get_sens):
+    # kwargs of the device functions of a task, get_sn and get_sens return the
+    # serial number of a device and the parameters of a sensor
     dev_kwarg = {}
     for dev_id, dev_sens_ids in zip(dev_ids, sens_ids):
         # TODO test that dev_sens_ids are from correct dev_id, eg. dev_sens_ids =
         # {Intel_D455_rgb_1,Intel_D455_depth_1} dev_id= Intel_D455_x
         dev_id_param = {}
-        dev_id_param["SN"] = get_dev_sn(dev_id, conn)
+        dev_id_param["SN"] = get_sn(dev_id)
 
         dev_id_param["sensors"] = {}
 
         for sens_id in dev_sens_ids:
             if sens_id == "":
                 continue
-            dev_id_param["sensors"][sens_id] = get_sens_param(sens_id, conn)
+            dev_id_param["sensors"][sens_id] = get_sens(sens_id)
 
         kwarg = meta_devinfo_tofunct(dev_id_param, dev_id)
 
@@ -268,17 +774,170 @@ def get_kwarg_task(task_id, conn):
     return dev_kwarg
 
 
+def _fetch_json_rows(query, params, conn):
+    # Rows of a query selecting row_to_json columns, parsed as dicts
+    with conn.cursor() as cursor:
+        cursor.execute(query, params)
+        return cursor.fetchall()
+
+
+def _load_collection(collection_id, conn):
+    tasks = OrderedDict()
+    rows = _fetch_json_rows(
+        """SELECT row_to_json(t), row_to_json(s), row_to_json(i)
+           FROM collection c
+           JOIN tech_obs_data t ON t.tech_obs_id = ANY(c.tech_obs_array)
+           LEFT JOIN stimulus s ON s.stimulus_id = t.stimulus_id
+           LEFT JOIN instruction i ON i.instruction_id = t.instruction_id
+           WHERE c.collection_id = %s
+           ORDER BY array_position(c.tech_obs_array, t.tech_obs_id)""", (collection_id,), conn)
+    for task, stimulus, instruction in rows:
+        tasks[task["tech_obs_id"]] = _collection_task(task, stimulus, instruction)
+
+    dev_ids, sens_ids = _collection_dev_sens_ids(tasks)
+    return {"collection_id": collection_id, "tasks": tasks,
+            "devices": _get_devices_db(dev_ids, conn),
+            "sensors": _get_sens_params_db(sens_ids, conn)}
+
+
+def _instr_kwargs(instruction):
+    # Instruction kwargs of a task from its instruction row, without the
+    # fields of the database
+    if instruction is None:
+        return {}
+    return {k: v for k, v in instruction.items() if k not in
+            ['instruction_id', 'is_active', 'date_created', 'version', 'assigned_tech_obs']}
+
+
+def _collection_task(task, stimulus, instruction):
+    # Task of load_collection from its tech_obs_data, stimulus and instruction rows
+    return {"stimulus_id": task["stimulus_id"],
+            "device_ids": task["device_id_array"] or [],
+            "sensor_ids": task["sensor_id_array"] or [],
+            "instr_kwargs": _instr_kwargs(instruction),
+            "stimulus": stimulus}
+
+
+def _collection_dev_sens_ids(tasks):
+    dev_ids = sorted({dev_id for task in tasks.values() for dev_id in task["device_ids"]})
+    sens_ids = sorted({sens_id for task in tasks.values() for sens_ids in task["sensor_ids"]
+                       for sens_id in sens_ids if sens_id != ""})
+    return dev_ids, sens_ids
+
+
+def _load_collection_snapshot(collection_id, snapshot):
+    collection = snapshot.row("collection", collection_id)
+    tasks = OrderedDict()
+    for tech_obs_id in collection["tech_obs_array"] or []:
+        task = snapshot.get("tech_obs_data", tech_obs_id)
+        if task is None:
+            continue
+        stimulus = snapshot.get("stimulus", task["stimulus_id"]) \
+            if task["stimulus_id"] is not None else None
+        instruction = snapshot.get("instruction", task["instruction_id"]) \
+            if task["instruction_id"] is not None else None
+        tasks[tech_obs_id] = _collection_task(task, stimulus, instruction)
+
+    dev_ids, sens_ids = _collection_dev_sens_ids(tasks)
+    devices = {dev_id: snapshot.get("device", dev_id) for dev_id in dev_ids
+               if snapshot.get("device", dev_id) is not None}
+    sensors = {}
+    for sens_id in sens_ids:
+        sensor = snapshot.get("sensor", sens_id)
+        if sensor is not None:
+            sensors[sens_id] = {k: v for k, v in sensor.items() if k != "sensor_id"}
+    return {"collection_id": collection_id, "tasks": tasks, "devices": devices,
+            "sensors": sensors}
+
+
+def load_collection(collection_id, conn, use_cache=True, use_snapshot=True):
+    """Load the tasks, devices, sensors, stimuli and instructions of a collection.
+
+    The collection is read from the configuration snapshot while it is
+    fresh, see use_snapshot, else with three queries, and kept in memory
+    until invalidate_collection_cache is called.
+
+    Parameters
+    ----------
+    collection_id : str
+        The collection.
+    conn : callable | instance of ConnectionPool
+        Connector to the database.
+    use_cache : bool
+        If False, the collection is read again and the cache updated, by
+        default True
+    use_snapshot : bool
+        If False, the collection is read from the database even if the
+        snapshot is fresh, the snapshot is only read if the database can
+        not be reached, by default True
+
+    Returns
+    -------
+    collection : dict
+        "tasks", dict by tech_obs_id, in the order of the collection, of
+        dicts with "stimulus_id", "device_ids", "sensor_ids", "instr_kwargs"
+        (as returned by _get_task_param) and "stimulus" (the stimulus row),
+        "devices", the device rows by device_id, and "sensors", the sensor
+        parameters by sensor_id (as returned by get_sens_param). Do not
+        modify it, it is shared by the callers.
+    """
+    key = (getattr(conn, "dsn", None) or getattr(conn, "database", None), collection_id)
+    with _collection_cache_lock:
+        if use_cache and key in _collection_cache:
+            return _collection_cache[key]
+    collection = _read_config(lambda snapshot: _load_collection_snapshot(collection_id, snapshot),
+                              lambda conn: _load_collection(collection_id, conn), conn,
+                              use_snapshot=use_snapshot)
+    with _collection_cache_lock:
+        _collection_cache[key] = collection
+    return collection
+
+
+def reload_collection(collection_id, conn, stamp=None):
+    """Read a collection again when preparing a session.
+
+    The collection is read from the fresh snapshot if it is the one CTR
+    listed the tasks from, else from the database, and the cache updated.
+
+    Parameters
+    ----------
+    collection_id : str
+        The collection.
+    conn : callable | instance of ConnectionPool
+        Connector to the database.
+    stamp : str | None
+        Stamp of the snapshot of CTR, see snapshot_stamp, by default None
+
+    Returns
+    -------
+    collection : dict
+        The collection, see load_collection.
+    """
+    same_snapshot = stamp is not None and stamp == snapshot_stamp()
+    return load_collection(collection_id, conn, use_cache=False, use_snapshot=same_snapshot)
+
+
+def invalidate_collection_cache(collection_id=None):
+    """Forget the collections loaded, or only collection_id if not None."""
+    with _collection_cache_lock:
+        for key in list(_collection_cache):
+            if collection_id is None or key[1] == collection_id:
+                del _collection_cache[key]
+
+
 def _get_coll_dev_kwarg_tasks(collection_id, conn):
     # Get devices kwargs for all the tasks
     # outputs dict with keys = stimulus_id, vals = dict with dev parameters
+    collection = load_collection(collection_id, conn)
+    devices, sensors = collection["devices"], collection["sensors"]
 
-    tech_obs = get_tasks(collection_id, conn)
+    def get_sn(dev_id):
+        return devices.get(dev_id, {}).get("device_sn")
 
     tasks_kwarg = OrderedDict()
-    for task in tech_obs:
-        stim_id, *_ = _get_task_param(task, conn)
-        task_kwarg = get_kwarg_task(task, conn)
-        tasks_kwarg[stim_id] = task_kwarg
+    for task in collection["tasks"].values():
+        tasks_kwarg[task["stimulus_id"]] = _dev_kwargs(
+            task["device_ids"], task["sensor_ids"], get_sn, lambda sens_id: dict(sensors[sens_id]))
 
     return tasks_kwarg
 
@@ -6,6 +6,8 @@ import time
 import uuid
 import wave
 
+from neurobooth_os.netcomm import send_event
+
 
 class MicStream():
     def __init__(self, CHANNELS=1, RATE=44100, CHUNK=1024, device_id="Mic_Yeti_1",
@@ -49,7 +51,7 @@ class MicStream():
         self.stream_info_audio.desc().append_child_value("device_name", self.device_name)
         self.stream_info_audio.desc().append_child_value("device_id", device_id)
         self.stream_info_audio.desc().append_child_value("sensor_ids", str(sensor_ids))
-        print(f"-OUTLETID-:Audio:{self.oulet_id}")
+        send_event("outlet_id", name="Audio", outlet_id=self.oulet_id)
 
         self.streaming = False
         self.stream_on = False
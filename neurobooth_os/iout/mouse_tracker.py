@@ -3,6 +3,8 @@ import uuid
 from pynput import mouse
 from pylsl import StreamInfo, StreamOutlet
 
+from neurobooth_os.netcomm import send_event
+
 
 class MouseStream():
     def __init__(self, device_id="Mouse", sensor_ids=["Mouse"]):
@@ -17,7 +19,7 @@ class MouseStream():
         self.info_stream.desc().append_child_value("sensor_ids", str(sensor_ids))
         
         self.outlet = StreamOutlet(info_stream)
-        print(f"-OUTLETID-:Mouse:{self.oulet_id}")
+        send_event("outlet_id", name="Mouse", outlet_id=self.oulet_id)
         self.streaming = False
 
     def start(self):
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+# License: BSD-3-Clause
+# Split again the xdf files of a data folder
+
+"""Split again the xdf files of a data folder, in parallel processes.
+
+The folder is walked for xdf files whose HDF5 files are missing or older
+than the xdf file, or whose xdf file changed since it was last split.
+Checksums of the split files are saved in the manifest
+``resplit_manifest.json`` of the folder, a file whose size or modification
+time changed but whose checksum did not, e.g. copied to the NAS, is not
+split again. Run with::
+
+    python -m neurobooth_os.iout.resplit --folder data_out --n-jobs 4 --out resplit.json
+
+``--dry-run`` reports what would be split without splitting. Rows are not
+inserted in the database, the files of the past recordings are already
+logged.
+"""
+
+import os
+import sys
+import glob
+import json
+import hashlib
+import argparse
+import os.path as op
+from time import perf_counter
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from neurobooth_os.iout.split_xdf import split_sens_files
+
+MANIFEST_FNAME = "resplit_manifest.json"
+
+
+def file_checksum(fname, block_size=2 ** 23):
+    """sha256 of a file, read by blocks of block_size bytes."""
+    sha = hashlib.sha256()
+    with open(fname, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def find_xdf_files(folder):
+    """Paths of the xdf files in folder and its subfolders, sorted."""
+    fnames = []
+    for root, _, files in os.walk(folder):
+        fnames.extend(op.join(root, fname) for fname in files
+                      if fname.endswith(".xdf") or fname.endswith(".xdfz"))
+    return sorted(fnames)
+
+
+def split_outputs(fname):
+    """HDF5 files written by split_sens_files for an xdf file."""
+    head, _ = op.splitext(fname)
+    return sorted(glob.glob(glob.escape(head) + "-*.hdf5"))
+
+
+def load_manifest(folder):
+    """Manifest of the files split in folder, by path relative to folder."""
+    fname = op.join(folder, MANIFEST_FNAME)
+    if not op.exists(fname):
+        return {}
+    with open(fname) as f:
+        return json.load(f)
+
+
+def save_manifest(folder, manifest):
+    fname = op.join(folder, MANIFEST_FNAME)
+    with open(fname + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(fname + ".tmp", fname)
+
+
+def plan(folder, manifest, force=False):
+    """Decide which xdf files of folder must be split.
+
+    Parameters
+    ----------
+    folder : str
+        The data folder.
+    manifest : dict
+        Manifest of the folder, see load_manifest. Entries of the files
+        whose checksum is computed are updated.
+    force : bool
+        If True, all the files are split, by default False
+
+    Returns
+    -------
+    jobs : list of dict
+        "fname", "key" (path relative to folder), "size", "status" and
+        "reason". Status is "split" or "skip", reason is "forced", "missing"
+        (no HDF5 files), "stale" (HDF5 files older than the xdf file),
+        "changed" (checksum differs from the manifest) or "unchanged".
+    """
+    jobs = []
+    for fname in find_xdf_files(folder):
+        key = op.relpath(fname, folder)
+        stat = os.stat(fname)
+        entry = manifest.get(key)
+        outputs = split_outputs(fname)
+        job = {"fname": fname, "key": key, "size": stat.st_size, "status": "split"}
+        if force:
+            job["reason"] = "forced"
+        elif not outputs:
+            job["reason"] = "missing"
+        elif entry is None and min(op.getmtime(o) for o in outputs) < stat.st_mtime:
+            job["reason"] = "stale"
+        elif entry is not None and any(not op.exists(op.join(folder, o))
+                                       for o in entry["files"]):
+            job["reason"] = "missing"
+        elif (entry is not None and entry["size"] == stat.st_size
+              and entry["mtime"] == stat.st_mtime):
+            job.update(status="skip", reason="unchanged")
+        else:
+            # Size or time changed, or split before the manifest: compare the content
+            checksum = file_checksum(fname)
+            if entry is not None and entry["sha256"] != checksum:
+                job["reason"] = "changed"
+            else:
+                job.update(status="skip", reason="unchanged")
+                manifest[key] = {"sha256": checksum, "size": stat.st_size,
+                                 "mtime": stat.st_mtime,
+                                 "files": [op.relpath(o, folder) for o in outputs],
+                                 "split": (entry or {}).get("split")}
+        jobs.append(job)
+    return jobs
+
+
+def _split(fname, **kwargs):
+    """Split a file in a worker, returns its manifest entry, report and seconds."""
+    t_start = perf_counter()
+    stat = os.stat(fname)
+    checksum = file_checksum(fname)
+    _, report = split_sens_files(fname, return_report=True, **kwargs)
+    entry = {"sha256": checksum, "size": stat.st_size, "mtime": stat.st_mtime,
+             "files": split_outputs(fname),
+             "split": datetime.now().isoformat(timespec="seconds")}
+    return entry, report, round(perf_counter() - t_start, 3)
+
+
+def resplit(folder, n_jobs=1, force=False, dry_run=False, **kwargs):
+    """Split the xdf files of folder that are new, stale or changed.
+
+    Parameters
+    ----------
+    folder : str
+        The data folder, walked recursively.
+    n_jobs : int
+        Number of files split in parallel processes, -1 uses all the cores,
+        by default 1
+    force : bool
+        If True, split all the files, by default False
+    dry_run : bool
+        If True, only report what would be split, by default False
+    **kwargs : dict
+        compression, compression_opts and chunk_size, see split_sens_files.
+
+    Returns
+    -------
+    summary : dict
+        "folder", "dry_run", "n_files", "n_split", "n_skipped", "n_failed",
+        "bytes" (of the xdf files split), "seconds", "mb_per_s",
+        "files_per_s" and "jobs", the plan with the "report", "seconds" or
+        "error" of each file split.
+    """
+    t_start = perf_counter()
+    manifest = load_manifest(folder)
+    jobs = plan(folder, manifest, force)
+    to_split = [job for job in jobs if job["status"] == "split"]
+
+    if not dry_run and to_split:
+        n_jobs = min(os.cpu_count() if n_jobs == -1 else n_jobs, len(to_split))
+        with ProcessPoolExecutor(n_jobs) as pool:
+            futures = {pool.submit(_split, job["fname"], **kwargs): job for job in to_split}
+            for n_done, future in enumerate(as_completed(futures), 1):
+                job = futures[future]
+                try:
+                    entry, job["report"], job["seconds"] = future.result()
+                except Exception as e:
+                    job.update(status="failed", error=f"{type(e).__name__}: {e}")
+                else:
+                    entry["files"] = [op.relpath(o, folder) for o in entry["files"]]
+                    manifest[job["key"]] = entry
+                    job["status"] = "done"
+                print(f"[{n_done}/{len(to_split)}] {job['key']}: {job['status']}")
+                # Saved after each file to keep the work done if interrupted
+                save_manifest(folder, manifest)
+    elif not dry_run:
+        save_manifest(folder, manifest)
+
+    seconds = perf_counter() - t_start
+    done = [job for job in jobs if job["status"] == "done"]
+    n_bytes = sum(job["size"] for job in done)
+    return {"folder": folder, "dry_run": dry_run, "n_files": len(jobs),
+            "n_split": len(done) if not dry_run else len(to_split),
+            "n_skipped": len(jobs) - len(to_split),
+            "n_failed": sum(job["status"] == "failed" for job in jobs),
+            "bytes": n_bytes if not dry_run else sum(job["size"] for job in to_split),
+            "seconds": round(seconds, 3),
+            "mb_per_s": round(n_bytes / 1e6 / seconds, 3) if done else None,
+            "files_per_s": round(len(done) / seconds, 3) if done else None,
+            "jobs": jobs}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--folder", help="Data folder, by default data_out of the config")
+    parser.add_argument("--nas", action="store_true", help="Use the nas folder of the config")
+    parser.add_argument("--n-jobs", type=int, default=1)
+    parser.add_argument("--force", action="store_true", help="Split all the files")
+    parser.add_argument("--dry-run", action="store_true", help="Only report what would be split")
+    parser.add_argument("--compression", default="gzip")
+    parser.add_argument("--out", help="Path of the json summary")
+    args = parser.parse_args(argv)
+
+    folder = args.folder
+    if folder is None:
+        # The config is only read when needed, it is created at import if missing
+        from neurobooth_os import config
+        folder = config.paths["nas" if args.nas else "data_out"]
+
+    compression = None if args.compression == "none" else args.compression
+    summary = resplit(folder, args.n_jobs, args.force, args.dry_run, compression=compression)
+    for job in summary["jobs"]:
+        print(f"{job['status']:>7} {job['reason']:>9} {job['key']}")
+    print(json.dumps({k: v for k, v in summary.items() if k != "jobs"}, indent=1))
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(summary, f, indent=1)
+    return 1 if summary["n_failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -14,6 +14,8 @@ import cv2
 import win32gui
 from pylsl import StreamInfo, StreamOutlet
 
+from neurobooth_os.netcomm import send_event
+
 
 class ScreenMirror():
     def __init__(self, Fps=1, res=(320, 240), options=None, RGB=False, local_plot=False):
@@ -59,7 +61,7 @@ class ScreenMirror():
                                  )
         self.info_stream = info_stream
         self.outlet_screen = StreamOutlet(info_stream)
-        print(f"-OUTLETID-:Screen:{self.oulet_id}")
+        send_event("outlet_id", name="Screen", outlet_id=self.oulet_id)
 
     def start(self):
         self.streaming = True
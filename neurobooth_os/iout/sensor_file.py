@@ -0,0 +1,402 @@
+# -*- coding: utf-8 -*-
+# License: BSD-3-Clause
+# HDF5 files of the sensor streams
+
+"""Layout and reader of the HDF5 files written by split_sens_files.
+
+Each device file has a stream group::
+
+    device_data/
+        time_series    (n_samples, n_channels), channel format of the stream
+        time_stamps    (n_samples,), float64 LSL time
+        attrs          name, type, source_id, nominal_srate, channel_count,
+                       channel_format, device_id, sensor_ids, effective_srate,
+                       info and footer (json of the xdf stream header and footer),
+                       quality (json of the time stamp quality metrics, see
+                       stream_quality)
+    attrs              marker_file, name of the marker file of the task
+
+The marker file of the task, in the same folder, has the Marker stream and
+the time range of each marker name::
+
+    marker/            same layout as device_data
+    index/
+        names          (n_names,), marker names, e.g. "Trial-start"
+        first, last    (n_names,), time stamps of the first and last markers
+        count          (n_names,), number of markers with the name
+
+Datasets are chunked and compressed, or contiguous and uncompressed so that
+they can be memory mapped. SensorFile reads time windows of the datasets
+without loading the whole file.
+"""
+
+import re
+import json
+import os.path as op
+
+import h5py
+import numpy as np
+
+try:
+    # Registers the lz4 filter to read files compressed with it
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+
+def _compression_kwargs(compression, compression_opts=None):
+    if compression is None:
+        return {}
+    if compression == "lz4":
+        if hdf5plugin is None:
+            raise ImportError("lz4 compression needs hdf5plugin, pip install hdf5plugin")
+        return dict(hdf5plugin.LZ4(), shuffle=True)
+    if compression == "gzip":
+        return {"compression": "gzip", "compression_opts": compression_opts, "shuffle": True}
+    if compression == "lzf":
+        return {"compression": "lzf", "shuffle": True}
+    raise ValueError(f"compression must be None, 'gzip', 'lzf' or 'lz4', got {compression}")
+
+
+def create_stream_group(h5, name, stream, info, n_samples=None, compression="gzip",
+                        compression_opts=4, chunk_size=1e6):
+    """Create the group and the empty datasets of a stream.
+
+    Parameters
+    ----------
+    h5 : instance of h5py.File
+        The file opened for writing.
+    name : str
+        Name of the group, "device_data" or "marker".
+    stream : instance of XdfStreamInfo
+        The stream.
+    info : dict
+        Stream header saved in the attributes.
+    n_samples : int | None
+        Number of samples of the stream. If None, the datasets are resized
+        as samples are appended, which needs chunk_size. By default None
+    compression : str | None
+        "gzip", "lzf", "lz4" (needs hdf5plugin) or None, by default "gzip"
+    compression_opts : int | None
+        Level of the gzip compression, by default 4
+    chunk_size : float | None
+        Bytes per chunk of the datasets, None stores them contiguously, which
+        needs n_samples and no compression. By default 1e6
+
+    Returns
+    -------
+    group : instance of h5py.Group
+        The group of the stream.
+    """
+    if chunk_size is None and (n_samples is None or compression is not None):
+        raise ValueError("Contiguous datasets need n_samples and no compression")
+
+    group = h5.create_group(name)
+    group.attrs["info"] = json.dumps(info)
+    for key in ["name", "type", "source_id", "channel_format"]:
+        if info.get(key, [None])[0] is not None:
+            group.attrs[key] = info[key][0]
+    group.attrs["nominal_srate"] = stream.srate
+    group.attrs["channel_count"] = stream.n_channels
+    desc = info.get("desc", [None])[0] or {}
+    if "device_id" in desc:
+        group.attrs["device_id"] = desc["device_id"][0]
+    if "sensor_ids" in desc:
+        group.attrs["sensor_ids"] = desc["sensor_ids"][0]
+
+    n_ch = stream.n_channels
+    if stream.dtype is None:
+        dtype, itemsize = h5py.string_dtype(), 16
+    else:
+        dtype, itemsize = stream.dtype, stream.dtype.itemsize
+    kwargs = _compression_kwargs(compression, compression_opts)
+    if chunk_size is None:
+        ts_kwargs, series_kwargs = dict(kwargs), dict(kwargs)
+    else:
+        ts_kwargs = dict(kwargs, chunks=(max(1, int(chunk_size // 8)),))
+        series_kwargs = dict(kwargs, chunks=(max(1, int(chunk_size // (itemsize * n_ch))), n_ch))
+    if n_samples is None:
+        # Resizable datasets
+        n_samples = 0
+        ts_kwargs["maxshape"] = (None,)
+        series_kwargs["maxshape"] = (None, n_ch)
+
+    group.create_dataset("time_series", (n_samples, n_ch), dtype, **series_kwargs)
+    group.create_dataset("time_stamps", (n_samples,), "f8", **ts_kwargs)
+    return group
+
+
+def write_samples(dataset, values, start):
+    """Write values at start in dataset, resizing it if needed."""
+    if not len(values):
+        return
+    stop = start + len(values)
+    if dataset.shape[0] < stop:
+        dataset.resize(stop, axis=0)
+    dataset[start:stop] = values
+
+
+def marker_name(marker):
+    """Name of a marker, without the time the task appended to it.
+
+    Parameters
+    ----------
+    marker : str
+        The marker, e.g. "Trial-res_0_1623456789.123".
+
+    Returns
+    -------
+    name : str
+        The marker name, e.g. "Trial-res_0".
+    """
+    return re.sub(r"_\d+\.\d+$", "", marker)
+
+
+def write_marker_index(h5, markers, time_stamps):
+    """Write the time range of each marker name in the index group.
+
+    Parameters
+    ----------
+    h5 : instance of h5py.File
+        The marker file opened for writing.
+    markers : list of str
+        The markers.
+    time_stamps : ndarray, shape (n_markers,)
+        Time stamps of the markers.
+    """
+    index = {}
+    for marker, time_stamp in zip(markers, time_stamps):
+        name = marker_name(marker)
+        first, last, count = index.get(name, (time_stamp, time_stamp, 0))
+        index[name] = (min(first, time_stamp), max(last, time_stamp), count + 1)
+
+    group = h5.create_group("index")
+    group.create_dataset("names", data=list(index), dtype=h5py.string_dtype())
+    ranges = np.array(list(index.values()), dtype=float).reshape(-1, 3)
+    group.create_dataset("first", data=ranges[:, 0])
+    group.create_dataset("last", data=ranges[:, 1])
+    group.create_dataset("count", data=ranges[:, 2].astype(int))
+
+
+def _searchsorted(dataset, value, side="left"):
+    # Binary search reading one element per step
+    lo, hi = 0, dataset.shape[0]
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if dataset[mid] < value or (side == "right" and dataset[mid] == value):
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+class SensorFile():
+    def __init__(self, fname, stream="device_data"):
+        """Read a stream of a file written by split_sens_files.
+
+        Datasets are read when sliced, use as a context manager to close
+        the file::
+
+            with SensorFile(fname) as f:
+                time_stamps, time_series = f.window(tmin, tmax)
+
+        Parameters
+        ----------
+        fname : str
+            Path of the HDF5 file.
+        stream : str
+            Group of the stream, "device_data" or "marker", by default
+            "device_data"
+
+        Attributes
+        ----------
+        time_stamps : instance of h5py.Dataset
+            Time stamps of the samples.
+        time_series : instance of h5py.Dataset
+            Samples of the stream.
+        attrs : dict
+            Attributes of the stream.
+        info : dict
+            The xdf stream header.
+        quality : dict | None
+            Quality of the time stamps, see stream_quality.timestamp_quality.
+        marker_file : str | None
+            Path of the marker file of the task.
+        """
+        self.fname = fname
+        self.h5 = h5py.File(fname, "r")
+        group = self.h5[stream]
+        self.time_stamps = group["time_stamps"]
+        self.time_series = group["time_series"]
+        self.attrs = dict(group.attrs)
+        self.info = json.loads(self.attrs["info"])
+        self.quality = json.loads(self.attrs["quality"]) if "quality" in self.attrs else None
+        self.marker_file = None
+        if "marker_file" in self.h5.attrs:
+            self.marker_file = op.join(op.dirname(fname), self.h5.attrs["marker_file"])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.time_stamps.shape[0]
+
+    def close(self):
+        self.h5.close()
+
+    def markers(self):
+        """Open the marker file of the task.
+
+        Returns
+        -------
+        markers : instance of MarkerFile
+            The marker file, to close after use.
+        """
+        if self.marker_file is None:
+            raise ValueError(f"{self.fname} has no marker file")
+        return MarkerFile(self.marker_file)
+
+    def index(self, time, side="left"):
+        """Index of the first sample at or after time, or after if side is "right"."""
+        return _searchsorted(self.time_stamps, time, side)
+
+    def window(self, tmin=None, tmax=None):
+        """Read the samples with time stamps between tmin and tmax included.
+
+        Parameters
+        ----------
+        tmin : float | None
+            LSL time of the start of the window, None starts at the first
+            sample, by default None
+        tmax : float | None
+            LSL time of the end of the window, None ends at the last sample,
+            by default None
+
+        Returns
+        -------
+        time_stamps : ndarray, shape (n_samples,)
+            Time stamps of the samples in the window.
+        time_series : ndarray, shape (n_samples, n_channels)
+            Samples in the window.
+        """
+        start = 0 if tmin is None else self.index(tmin)
+        stop = len(self) if tmax is None else self.index(tmax, "right")
+        time_series = self.time_series
+        if h5py.check_string_dtype(time_series.dtype) is not None:
+            time_series = time_series.asstr()
+        return self.time_stamps[start:stop], time_series[start:stop]
+
+    def memmap(self, name="time_series"):
+        """Memory map a dataset written contiguously, without compression.
+
+        Parameters
+        ----------
+        name : str
+            "time_series" or "time_stamps", by default "time_series"
+
+        Returns
+        -------
+        data : instance of numpy.memmap
+            Read only view of the dataset in the file.
+        """
+        dataset = self.time_series if name == "time_series" else self.time_stamps
+        offset = dataset.id.get_offset()
+        if dataset.chunks is not None or offset is None or dataset.dtype.kind == "O":
+            raise ValueError(f"{name} of {self.fname} is not contiguous, write it with "
+                             f"chunk_size=None and compression=None to memory map it")
+        return np.memmap(self.fname, dataset.dtype, "r", offset, dataset.shape)
+
+
+class MarkerFile(SensorFile):
+    def __init__(self, fname):
+        """Read the marker file of a task.
+
+        Event locked windows of the device files are read with the time
+        range of a marker name::
+
+            with MarkerFile(marker_fname) as markers, SensorFile(fname) as f:
+                time_stamps, time_series = f.window(*markers.range("Task_start"))
+
+        Parameters
+        ----------
+        fname : str
+            Path of the marker file.
+
+        Attributes
+        ----------
+        ranges : dict
+            (first, last, count) of the markers of each name, see
+            write_marker_index.
+        """
+        super().__init__(fname, "marker")
+        index = self.h5["index"]
+        self.ranges = {name: (first, last, count) for name, first, last, count in
+                       zip(index["names"].asstr()[()], index["first"][()], index["last"][()],
+                           index["count"][()])}
+
+    @property
+    def names(self):
+        """The marker names, in order of first occurrence."""
+        return list(self.ranges)
+
+    def range(self, name):
+        """Time stamps of the first and last markers called name.
+
+        Parameters
+        ----------
+        name : str
+            The marker name, e.g. "Task_start".
+
+        Returns
+        -------
+        first, last : float
+            The time stamps.
+        """
+        first, last, _ = self.ranges[name]
+        return first, last
+
+    def events(self, name):
+        """Time stamps of all the markers called name."""
+        time_stamps, time_series = self.window(*self.range(name))
+        return np.array([time_stamp for time_stamp, marker in zip(time_stamps, time_series[:, 0])
+                         if marker_name(marker) == name])
+
+
+def _read_stream(group):
+    time_series = group["time_series"]
+    if h5py.check_string_dtype(time_series.dtype) is not None:
+        time_series = time_series.asstr()[()].tolist()
+    else:
+        time_series = time_series[()]
+    return {"info": json.loads(group.attrs["info"]),
+            "footer": json.loads(group.attrs["footer"]),
+            "time_series": time_series,
+            "time_stamps": group["time_stamps"][()]}
+
+
+def read_sensor_file(fname):
+    """Read a file written by split_sens_files.
+
+    Parameters
+    ----------
+    fname : str
+        Path of the HDF5 file.
+
+    Returns
+    -------
+    data : dict
+        "device_data" and "marker" streams, the marker is read from the
+        marker file of the task and is None if the task had none. Streams are
+        dicts with "info", "footer", "time_series" and "time_stamps", as
+        returned by pyxdf.load_xdf.
+    """
+    with h5py.File(fname, "r") as f:
+        data = {"device_data": _read_stream(f["device_data"]), "marker": None}
+        marker_file = f.attrs.get("marker_file")
+    if marker_file is not None:
+        with h5py.File(op.join(op.dirname(fname), marker_file), "r") as f:
+            data["marker"] = _read_stream(f["marker"])
+    return data
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+# License: BSD-3-Clause
+# Split xdf files in the background
+
+"""Queue splitting the xdf files of the tasks in background threads.
+
+Jobs are saved in a json journal each time their status changes, jobs that
+were pending or running when CTR stopped are run again at the next start::
+
+    [{"id": "3f2a9c1e", "xdf_fname": "...", "tech_obs_log_id": "...",
+      "tech_obs_id": "...", "status": "running", "attempts": 1,
+      "progress": [2, 5], "error": null, "files": [], "report": null,
+      "created": "...", "updated": "..."}]
+
+Status is one of "pending", "running", "done" or "failed".
+"""
+
+import os
+import json
+import uuid
+import queue
+import threading
+from datetime import datetime
+
+from neurobooth_os.iout.split_xdf import split_sens_files
+
+
+class SplitQueue():
+    def __init__(self, journal_fname, conn=None, n_workers=1, n_jobs=1, max_retries=2,
+                 retry_delay=5., on_update=None):
+        """Run split_sens_files jobs in background threads.
+
+        Parameters
+        ----------
+        journal_fname : str
+            Path of the json journal of the jobs.
+        conn : callable | instance of ConnectionPool | None
+            Connector to the database, a pool lets the workers query at the
+            same time, if None does not insert rows, by default None
+        n_workers : int
+            Number of jobs run at the same time, by default 1
+        n_jobs : int
+            Number of processes splitting the streams of a job, see
+            split_sens_files, by default 1
+        max_retries : int
+            Times a failed job is run again before it is marked failed, by
+            default 2
+        retry_delay : float
+            Seconds to wait before running a failed job again, by default 5.
+        on_update : callable | None
+            Called with a copy of the job dict each time its status or
+            progress changes, from the worker threads, by default None
+        """
+        self.journal_fname = journal_fname
+        self.conn = conn
+        self.n_workers = n_workers
+        self.n_jobs = n_jobs
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.on_update = on_update
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._stop_event = threading.Event()
+        self._threads = []
+
+        # Jobs done in previous sessions are dropped from the journal
+        if os.path.exists(journal_fname):
+            with open(journal_fname) as f:
+                for job in json.load(f):
+                    if job["status"] != "done":
+                        self.jobs[job["id"]] = job
+
+    def _save(self):
+        # Must hold self.lock, replace the journal at once to never leave it half written
+        tmp_fname = self.journal_fname + ".tmp"
+        with open(tmp_fname, "w") as f:
+            json.dump(list(self.jobs.values()), f, indent=1)
+        os.replace(tmp_fname, self.journal_fname)
+
+    def _update(self, job_id, **fields):
+        with self.lock:
+            job = self.jobs[job_id]
+            job.update(fields, updated=datetime.now().isoformat(timespec="seconds"))
+            self._save()
+            job = dict(job)
+        if self.on_update is not None:
+            self.on_update(job)
+
+    def submit(self, xdf_fname, tech_obs_log_id=None, tech_obs_id=None):
+        """Add a split job to the queue.
+
+        Parameters
+        ----------
+        xdf_fname : str
+            The xdf file to split.
+        tech_obs_log_id : str, optional
+            task log id for the database, by default None
+        tech_obs_id : str, optional
+            task id for the database, by default None
+
+        Returns
+        -------
+        job_id : str
+            Id of the job.
+        """
+        job_id = uuid.uuid4().hex[:8]
+        now = datetime.now().isoformat(timespec="seconds")
+        with self.lock:
+            self.jobs[job_id] = {"id": job_id, "xdf_fname": xdf_fname,
+                                 "tech_obs_log_id": tech_obs_log_id, "tech_obs_id": tech_obs_id,
+                                 "status": "pending", "attempts": 0, "progress": None,
+                                 "error": None, "files": [], "report": None, "created": now,
+                                 "updated": now}
+            self._save()
+            job = dict(self.jobs[job_id])
+        if self.on_update is not None:
+            self.on_update(job)
+        self._queue.put(job_id)
+        return job_id
+
+    def retry(self, job_id):
+        """Queue a failed job again."""
+        self._update(job_id, status="pending", attempts=0, error=None)
+        self._queue.put(job_id)
+
+    def _run(self, job_id):
+        job = self.jobs[job_id]
+        self._update(job_id, status="running", attempts=job["attempts"] + 1, progress=None)
+
+        def progress(n_done, n_streams):
+            self._update(job_id, progress=[n_done, n_streams])
+
+        try:
+            files, report = split_sens_files(job["xdf_fname"], job["tech_obs_log_id"],
+                                             job["tech_obs_id"], self.conn, n_jobs=self.n_jobs,
+                                             callback=progress, return_report=True)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            print(f"Splitting {job['xdf_fname']} failed, attempt {job['attempts']}: {error}")
+            if job["attempts"] > self.max_retries:
+                self._update(job_id, status="failed", error=error)
+            else:
+                self._update(job_id, status="pending", error=error)
+                if not self._stop_event.wait(self.retry_delay):
+                    self._queue.put(job_id)
+            return
+        self._update(job_id, status="done", error=None, files=files, report=report)
+
+    def _work(self):
+        while not self._stop_event.is_set():
+            try:
+                job_id = self._queue.get(timeout=.5)
+            except queue.Empty:
+                continue
+            self._run(job_id)
+
+    def start(self):
+        """Start the workers, jobs pending or running in the journal are run first."""
+        if self._threads:
+            return
+        with self.lock:
+            resumed = sorted((job for job in self.jobs.values()
+                              if job["status"] in ["pending", "running"]),
+                             key=lambda job: job["created"])
+        for job in resumed:
+            print(f"Resuming split of {job['xdf_fname']}")
+            self._update(job["id"], status="pending")
+            self._queue.put(job["id"])
+
+        self._stop_event.clear()
+        for _ in range(self.n_workers):
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        """Stop the workers once their running job is done.
+
+        Pending jobs stay in the journal and are run at the next start.
+
+        Parameters
+        ----------
+        timeout : float | None
+            Seconds to wait for each worker, None waits until its job is
+            done, by default None
+        """
+        self._stop_event.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def status(self):
+        """Copy of the jobs, oldest first.
+
+        Returns
+        -------
+        jobs : list of dict
+            The jobs, see the journal format.
+        """
+        with self.lock:
+            return [dict(job) for job in sorted(self.jobs.values(),
+                                                key=lambda job: job["created"])]
@@ -5,18 +5,38 @@
 # Split xdf file per sensor
 
 
-import pyxdf
-import pylsl
+"""Split xdf file per sensor.
+
+Each device stream is written to its own HDF5 file, see sensor_file for the
+layout. The xdf file is read chunk by chunk and the samples are appended to the
+files as they are read, memory use is bounded by the buffer size and not by
+the length of the recording. Each stream is split by its own pass over the
+file, skipping the chunks of the other streams, so streams can be split in
+parallel processes.
+"""
+
+import os
+import ast
+import json
 import time
-import numpy as np
+from time import perf_counter
 import os.path as op
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
 from pathlib import Path
 
-from h5io import write_hdf5
+import h5py
+import numpy as np
+import pylsl
 
 from neurobooth_os.iout import metadator as meta
-from neurobooth_terra import Table
+from neurobooth_os.iout.xdf_reader import (XdfReader, XdfIndex, XdfStreamInfo, fit_clock_offsets,
+                                           STREAM_HEADER, SAMPLES, CLOCK_OFFSET, STREAM_FOOTER)
+from neurobooth_os.iout.sensor_file import create_stream_group, write_samples, write_marker_index
+from neurobooth_os.iout.stream_quality import timestamp_quality, FRAME_COUNTER_TYPES
+
+# Samples per block when rewriting the time stamps of a file
+_BLOCK_SIZE = 2 ** 20
 
 
 def compute_clocks_diff():
@@ -34,9 +54,454 @@ def compute_clocks_diff():
     return time_offset
 
 
-def split_sens_files(fname, tech_obs_log_id=None, tech_obs_id=None, conn=None):
+class _Segment():
+    def __init__(self, start, t0):
+        """Running least squares of time stamps on sample index.
+
+        Statistics of each appended block are merged with the ones of the
+        previous blocks, so the fit never needs all the time stamps.
+
+        Parameters
+        ----------
+        start : int
+            Index of the first sample of the segment in the stream.
+        t0 : float
+            Time stamp of the first sample, the fit is relative to it.
+        """
+        self.start = start
+        self.t0 = t0
+        self.n = 0
+        self.mean_i = 0.
+        self.mean_t = 0.
+        self.m2_i = 0.
+        self.c_it = 0.
+
+    def add(self, time_stamps, first):
+        """Add time_stamps of the samples starting at index first."""
+        index = np.arange(first - self.start, first - self.start + len(time_stamps), dtype=float)
+        t = time_stamps - self.t0
+        n_b, mean_i, mean_t = len(t), index.mean(), t.mean()
+        m2_i = ((index - mean_i) ** 2).sum()
+        c_it = ((index - mean_i) * (t - mean_t)).sum()
+
+        n = self.n + n_b
+        d_i, d_t = mean_i - self.mean_i, mean_t - self.mean_t
+        weight = self.n * n_b / n
+        self.mean_i += d_i * n_b / n
+        self.mean_t += d_t * n_b / n
+        self.m2_i += m2_i + d_i ** 2 * weight
+        self.c_it += c_it + d_i * d_t * weight
+        self.n = n
+
+    @property
+    def slope(self):
+        return self.c_it / self.m2_i if self.m2_i > 0 else 0.
+
+    def fit(self, index):
+        """Dejittered time stamps of the samples at index in the stream."""
+        return self.t0 + self.mean_t + self.slope * (index - self.start - self.mean_i)
+
+
+class _Segments():
+    def __init__(self, srate, threshold_seconds=1, threshold_samples=500):
+        """Split the time stamps at gaps, with the pyxdf dejitter thresholds.
+
+        Parameters
+        ----------
+        srate : float
+            Nominal sampling rate of the stream, 0 if irregular.
+        threshold_seconds : float
+            Gap in seconds starting a new segment, by default 1
+        threshold_samples : int
+            Gap in samples starting a new segment, by default 500
+        """
+        self.threshold = threshold_seconds
+        if srate > 0:
+            self.threshold = max(threshold_seconds, threshold_samples / srate)
+        self.segments = []
+        self.n_samples = 0
+        self.last = None
+
+    def update(self, time_stamps):
+        """Add the time stamps of the next samples of the stream."""
+        if not len(time_stamps):
+            return
+        previous = time_stamps[0] if self.last is None else self.last
+        diffs = np.diff(time_stamps, prepend=previous)
+        breaks = np.flatnonzero(np.abs(diffs) > self.threshold)
+        if self.last is None:
+            breaks = np.r_[0, breaks]
+        bounds = np.unique(np.r_[0, breaks, len(time_stamps)])
+
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            if start in breaks:
+                self.segments.append(_Segment(self.n_samples + start, time_stamps[start]))
+            self.segments[-1].add(time_stamps[start:stop], self.n_samples + start)
+        self.n_samples += len(time_stamps)
+        self.last = time_stamps[-1]
+
+
+class _MemoryStream():
+    def __init__(self, stream):
+        """Stream kept in memory, for the small marker streams.
+
+        Parameters
+        ----------
+        stream : instance of XdfStreamInfo
+            The stream.
+        """
+        self.stream = stream
+        self.time_stamps = []
+        self.time_series = []
+        self.footer = None
+
+    def append(self, time_stamps, values):
+        self.time_stamps.append(time_stamps)
+        self.time_series.extend(values)
+
+    def close(self, clock_offsets):
+        """Synchronize the time stamps, returns the stream as a dict."""
+        a, b = fit_clock_offsets(clock_offsets)
+        time_stamps = np.concatenate(self.time_stamps) if self.time_stamps else np.zeros(0)
+        time_stamps += a + b * time_stamps
+        return {"info": self.stream.info, "footer": self.footer,
+                "time_series": self.time_series, "time_stamps": time_stamps}
+
+
+class _SensorFileWriter():
+    def __init__(self, fname, stream, device_id, sensors_id, n_samples=None, **kwargs):
+        """Append the samples of a device stream to its HDF5 file.
+
+        Parameters
+        ----------
+        fname : str
+            Path of the HDF5 file, overwritten.
+        stream : instance of XdfStreamInfo
+            The device stream.
+        device_id : str
+            Id of the device in the database.
+        sensors_id : list of str
+            Ids of the sensors of the device in the database.
+        n_samples : int | None
+            Number of samples of the stream, needed for contiguous datasets,
+            by default None
+        **kwargs : dict
+            compression, compression_opts and chunk_size of the datasets,
+            see sensor_file.create_stream_group
+        """
+        self.fname = fname
+        self.stream = stream
+        self.device_id = device_id
+        self.sensors_id = sensors_id
+        self.kwargs = kwargs
+        self.footer = None
+        self.h5 = h5py.File(fname, "w")
+        self.group = create_stream_group(self.h5, "device_data", stream, stream.info, n_samples,
+                                         **kwargs)
+        self.n_written = 0
+        self.segments = _Segments(stream.srate)
+        self._time_stamps = []
+        self._values = []
+
+    def append(self, time_stamps, values):
+        """Buffer samples, returns the number of bytes buffered."""
+        self._time_stamps.append(time_stamps)
+        self._values.append(values)
+        self.segments.update(time_stamps)
+        if self.stream.dtype is None:
+            return time_stamps.nbytes + sum(len(v) for sample in values for v in sample)
+        return time_stamps.nbytes + values.nbytes
+
+    def flush(self):
+        """Write the buffered samples to the file."""
+        if not self._time_stamps:
+            return
+        time_stamps = np.concatenate(self._time_stamps)
+        if self.stream.dtype is None:
+            values = np.array([sample for values in self._values for sample in values], dtype=object)
+        else:
+            values = np.concatenate(self._values)
+        write_samples(self.group["time_stamps"], time_stamps, self.n_written)
+        write_samples(self.group["time_series"], values, self.n_written)
+        self.n_written += len(time_stamps)
+        self._time_stamps, self._values = [], []
+
+    def _sync_time_stamps(self, clock_offsets):
+        """Rewrite the time stamps block by block, synchronized and dejittered."""
+        a, b = fit_clock_offsets(clock_offsets)
+        dataset = self.group["time_stamps"]
+        dejitter = self.stream.srate > 0
+        for segment in self.segments.segments:
+            stop = segment.start + segment.n
+            for first in range(segment.start, stop, _BLOCK_SIZE):
+                last = min(first + _BLOCK_SIZE, stop)
+                if dejitter:
+                    time_stamps = segment.fit(np.arange(first, last))
+                else:
+                    time_stamps = dataset[first:last]
+                dataset[first:last] = time_stamps + a + b * time_stamps
+        return b
+
+    def close(self, clock_offsets=None, marker_file=None):
+        """Finish the file.
+
+        Parameters
+        ----------
+        clock_offsets : list of tuple | None
+            The (collection_time, offset) ClockOffset chunks of the stream.
+        marker_file : str | None
+            Path of the marker file of the task, referenced by the file, by
+            default None
+
+        Returns
+        -------
+        summary : dict
+            "n_samples", "first_time_stamp", "last_time_stamp",
+            "temporal_resolution" (Hz, None if less than 2 samples) and
+            "quality", see stream_quality.timestamp_quality.
+        """
+        self.flush()
+        # Quality of the time stamps as recorded, before they are rewritten
+        frame_counter = None
+        if (self.stream.info.get("type", [None])[0] in FRAME_COUNTER_TYPES
+                and self.stream.dtype is not None):
+            frame_counter = self.group["time_series"][:, 0]
+        quality = timestamp_quality(self.group["time_stamps"][()], self.stream.srate,
+                                    frame_counter)
+        self.group.attrs["quality"] = json.dumps(quality)
+
+        b = self._sync_time_stamps(clock_offsets or [])
+        time_stamps = self.group["time_stamps"]
+        n_samples = time_stamps.shape[0]
+
+        summary = {"n_samples": n_samples, "first_time_stamp": None,
+                   "last_time_stamp": None, "temporal_resolution": None, "quality": quality}
+        if n_samples:
+            summary["first_time_stamp"] = float(time_stamps[0])
+            summary["last_time_stamp"] = float(time_stamps[-1])
+        if n_samples > 1:
+            self.group.attrs["effective_srate"] = \
+                (n_samples - 1) / (time_stamps[-1] - time_stamps[0])
+            if self.stream.srate > 0:
+                # Dejittered, the median difference is the slope of the main segment
+                segment = max(self.segments.segments, key=lambda s: s.n)
+                period = segment.slope * (1 + b)
+            else:
+                # Irregular streams have few samples
+                period = np.median(np.diff(time_stamps[()]))
+            summary["temporal_resolution"] = 1 / period if period > 0 else None
+
+        self.group.attrs["footer"] = json.dumps(self.footer)
+        if marker_file is not None:
+            self.h5.attrs["marker_file"] = op.basename(marker_file)
+        self.h5.close()
+        return summary
+
+
+def _write_marker_file(fname, marker, **kwargs):
+    """Write the Marker stream of a task and its index by marker name.
+
+    Parameters
+    ----------
+    fname : str
+        Path of the marker file.
+    marker : dict
+        The Marker stream, as returned by _scan_xdf.
+    **kwargs : dict
+        compression, compression_opts and chunk_size of the datasets.
+    """
+    # Markers are few, always chunked
+    kwargs = dict(kwargs, chunk_size=kwargs.get("chunk_size") or 1e6)
+    with h5py.File(fname, "w") as h5:
+        group = create_stream_group(h5, "marker", marker["stream"], marker["info"], **kwargs)
+        group.attrs["footer"] = json.dumps(marker["footer"])
+        write_samples(group["time_stamps"], marker["time_stamps"], 0)
+        write_samples(group["time_series"], np.array(marker["time_series"], dtype=object), 0)
+        write_marker_index(h5, [sample[0] for sample in marker["time_series"]],
+                           marker["time_stamps"])
+
+
+def _parse_videofiles(time_series):
+    """Video file name by stream name, from the samples of the videofiles stream."""
+    # video file marker format is ["streamName, fname.mov"]
+    return {d[0].split(",")[0]: d[0].split(",")[1] for d in time_series if d[0] != ''}
+
+
+def _insert_sensor_file_rows(tech_obs_log_id, files, summaries, videofiles, conn):
+    """Insert the sensor_file_log rows of the files of a task in one transaction.
+
+    Parameters
+    ----------
+    tech_obs_log_id : str
+        task log id of the files.
+    files : list of tuple
+        (fname, stream_name, device_id, sensors_id) of each file.
+    summaries : list of dict
+        Summary of each file, see _SensorFileWriter.close
+    videofiles : dict
+        Video file name by stream name, see _parse_videofiles.
+    conn : callable
+        Connector to the database.
+
+    Returns
+    -------
+    db_time : float
+        Seconds spent inserting the rows.
+    """
+    rows = []
+    time_offset = compute_clocks_diff()
+    for (fname_full, name, device_id, sensors_id), summary in zip(files, summaries):
+        if not summary["n_samples"]:
+            print(f"No samples in stream {name}")
+            continue
+        _, head = op.split(fname_full)
+
+        start_time = summary["first_time_stamp"] + time_offset
+        end_time = summary["last_time_stamp"] + time_offset
+        start_time = datetime.fromtimestamp(start_time).strftime("%Y-%m-%d %H:%M:%S")
+        end_time = datetime.fromtimestamp(end_time).strftime("%Y-%m-%d %H:%M:%S")
+        temp_res = summary["temporal_resolution"]
+
+        if videofiles.get(name): 
+            head = f"{head}, {videofiles.get(name)}"
+            print(f"Videofile name: {head}")
+
+        for sens_id in sensors_id:
+            rows.append((tech_obs_log_id, temp_res, None, start_time, end_time, device_id,
+                         sens_id, "{" + head + "}"))
+
+    if tech_obs_log_id is None or not rows:
+        return 0
+    t_insert = perf_counter()
+    cols = ["tech_obs_log_id", "true_temporal_resolution", "true_spatial_resolution",
+            "file_start_time", "file_end_time", "device_id", "sensor_id", 'sensor_file_path']
+    meta._insert_rows("sensor_file_log", rows, cols, conn)
+    return perf_counter() - t_insert
+
+
+def _scan_xdf(fname, index=None):
+    """Read the stream headers and the marker streams of an xdf file.
+
+    Parameters
+    ----------
+    fname : str
+        Path of the xdf file.
+    index : instance of XdfIndex | None
+        Index of the file, if not None the marker streams are read by
+        seeking to their chunks, by default None
+
+    Returns
+    -------
+    streams : list of XdfStreamInfo
+        All the streams of the file.
+    marker : dict | None
+        The Marker stream, as returned by _MemoryStream.close with its
+        XdfStreamInfo in "stream".
+    videofiles : dict
+        Video file name by stream name, from the videofiles stream.
+    """
+    def select(stream):
+        return stream.name in ["Marker", "videofiles"]
+
+    if index is not None:
+        streams = [XdfStreamInfo(stream_id, stream["info"])
+                   for stream_id, stream in index.streams.items()]
+        chunks = (chunk for stream in streams if select(stream)
+                  for chunk in index.iter_chunks(stream.stream_id))
+        selected = {stream.stream_id: stream for stream in streams if select(stream)}
+    else:
+        reader = XdfReader(fname, select=select)
+        chunks = iter(reader)
+        selected = reader.streams
+
+    memory_streams = {}
+    clock_offsets = {}
+    for chunk in chunks:
+        stream_id = chunk.stream_id
+        if chunk.tag == STREAM_HEADER and select(selected[stream_id]):
+            memory_streams[stream_id] = _MemoryStream(selected[stream_id])
+            clock_offsets[stream_id] = []
+        elif chunk.tag == SAMPLES and stream_id in memory_streams and chunk.content is not None:
+            memory_streams[stream_id].append(*chunk.content)
+        elif chunk.tag == CLOCK_OFFSET and stream_id in clock_offsets:
+            clock_offsets[stream_id].append(chunk.content)
+        elif chunk.tag == STREAM_FOOTER and stream_id in memory_streams:
+            memory_streams[stream_id].footer = chunk.content
+
+    marker, videofiles = None, {}
+    for stream_id, memory_stream in memory_streams.items():
+        data = memory_stream.close(clock_offsets[stream_id])
+        if memory_stream.stream.name == "Marker" and marker is None:
+            marker = dict(data, stream=memory_stream.stream)
+        elif memory_stream.stream.name == "videofiles":
+            videofiles = _parse_videofiles(data["time_series"])
+    if index is None:
+        streams = list(reader.streams.values())
+    return streams, marker, videofiles
+
+
+def _split_stream(fname, stream_id, fname_full, device_id, sensors_id, marker_file=None,
+                  buffer_size=32e6, **kwargs):
+    """Write one device stream of an xdf file to its HDF5 file.
+
+    Runs in the workers of split_sens_files, only the chunks of the stream
+    are parsed, and only them are read if the file has an XdfIndex. kwargs
+    are the compression and chunk_size of the datasets.
+
+    Returns
+    -------
+    summary : dict
+        Summary of the stream, see _SensorFileWriter.close
+    """
+    # Contiguous datasets are created with their final size
+    contiguous = kwargs.get("chunk_size", 1) is None
+    index = XdfIndex.load(fname)
+    n_samples = None
+    if index is not None:
+        chunks = index.iter_chunks(stream_id)
+        if contiguous:
+            n_samples = index.streams[stream_id]["n_samples"]
+    else:
+        chunks = XdfReader(fname, select=lambda stream: stream.stream_id == stream_id)
+        if contiguous:
+            n_samples = chunks.sample_counts().get(stream_id, 0)
+    writer = None
+    clock_offsets = []
+    buffered = 0
+    for chunk in chunks:
+        if chunk.stream_id != stream_id:
+            continue
+        if chunk.tag == STREAM_HEADER:
+            writer = _SensorFileWriter(fname_full, XdfStreamInfo(stream_id, chunk.content),
+                                       device_id, sensors_id, n_samples, **kwargs)
+            continue
+        if writer is None:
+            raise ValueError(f"no header for stream {stream_id} in {fname}")
+        if chunk.tag == SAMPLES and chunk.content is not None:
+            buffered += writer.append(*chunk.content)
+            if buffered > buffer_size:
+                writer.flush()
+                buffered = 0
+        elif chunk.tag == CLOCK_OFFSET:
+            clock_offsets.append(chunk.content)
+        elif chunk.tag == STREAM_FOOTER:
+            writer.footer = chunk.content
+    if writer is None:
+        raise ValueError(f"no header for stream {stream_id} in {fname}")
+    return writer.close(clock_offsets, marker_file)
+
+
+def split_sens_files(fname, tech_obs_log_id=None, tech_obs_id=None, conn=None,
+                     buffer_size=32e6, n_jobs=1, callback=None, compression="gzip",
+                     compression_opts=4, chunk_size=1e6, return_report=False):
     """Split xdf file per sensor
 
+    The xdf file is indexed once, its XdfIndex saved next to it, and each
+    stream is read by seeking to its chunks. Time stamps are synchronized with a
+    linear fit of the clock offsets and regularly sampled streams are
+    dejittered, as pyxdf.load_xdf does by default. The database rows of all
+    the streams are inserted once the files are written.
+
     Parameters
     ----------
     fname : str
@@ -45,77 +510,125 @@ def split_sens_files(fname, tech_obs_log_id=None, tech_obs_id=None, conn=None):
         task log id for the database, by default None. If conn not None, it can not be None. 
     tech_obs_id : str, optional
         task id for the database, by default None. If conn not None, it can not be None. 
-    conn : callable
-        Connector to the database, if None does not insert rows, by default None
+    conn : callable | instance of ConnectionPool
+        Connector to the database, or pool whose connections are taken only
+        while querying, if None does not insert rows, by default None
+    buffer_size : float
+        Bytes of samples of a stream held in memory before they are written
+        to its file, by default 32e6
+    n_jobs : int
+        Number of processes splitting the streams in parallel, -1 uses all
+        the cores, by default 1
+    callback : callable | None
+        Called with (n_done, n_streams) each time a stream is split, by
+        default None
+    compression : str | None
+        Compression of the datasets, "gzip", "lzf", "lz4" (needs hdf5plugin)
+        or None, by default "gzip"
+    compression_opts : int | None
+        Level of the gzip compression, by default 4
+    chunk_size : float | None
+        Bytes per chunk of the datasets. None writes them contiguously so
+        that they can be memory mapped, which needs compression=None. By
+        default 1e6
+    return_report : bool
+        If True, also return the split report, by default False
 
     Returns
     -------
     files : list
         list of files for each stream
+    report : dict
+        Only if return_report. "n_streams", "n_samples", the seconds
+        spent reading the headers and markers "scan_s", writing the files
+        "split_s", in the database "db_s" and in total "total_s", and the
+        time stamp "quality" of each file by file name.
     """
+    t_start = perf_counter()
+    db_time = 0
+    if conn is not None:
+        with meta.checkout(conn) as db_conn:
+            _, devices_ids, _, _ = meta._get_task_param(tech_obs_id, db_conn)
+        db_time += perf_counter() - t_start
 
-    # Read xdf file
-    data, header = pyxdf.load_xdf(fname)
+    t_scan = perf_counter()
+    head, ext = op.splitext(fname)
+    # Indexed once, the streams and the later resplits seek to their chunks
+    streams, marker, videofiles = _scan_xdf(fname, XdfIndex.open(fname))
+    kwargs = dict(compression=compression, compression_opts=compression_opts,
+                  chunk_size=chunk_size)
 
-    # Find marker stream to add in to each h5 file
-    marker = [d for d in data if d['info']['name'] == ["Marker"]]
+    # Markers are written once in the marker file referenced by each h5 file
+    marker_file = None
+    if marker is not None:
+        marker_file = f"{head}-marker.hdf5"
+        _write_marker_file(marker_file, marker, **kwargs)
+        print(f"Saving markers to {marker_file}")
 
-    if conn is not None:
-        table_sens_log = Table("sensor_file_log", conn=conn)
-        _, devices_ids, _, _ = meta._get_task_param(tech_obs_id, conn)
-    # get video filenames if videofiles marker present
-    videofiles = {}
-    if 'videofiles' in [d['info']['name'][0] for d in data]:
-        vid_data = [v for v in data if v['info']['name'] == ['videofiles']]
-        # video file marker format is ["streamName, fname.mov"]
-        videofiles = {d[0].split(",")[0] : d[0].split(",")[1] for d in vid_data[0]['time_series'] 
-                        if d[0]!= ''}
-
-    files = []
-    # Loop over each sensor
-    for dev_data in data:
-        name = dev_data['info']['name'][0]
-        if name in ["Marker", "videofiles"]:
+    jobs = []
+    for stream in streams:
+        if stream.name in ["Marker", "videofiles"]:
             continue
 
-        device_id = dev_data['info']['desc'][0]["device_id"][0]
-        sensors_id = eval(dev_data['info']['desc'][0]["sensor_ids"][0])
+        desc = stream.info['desc'][0]
+        device_id = desc["device_id"][0]
+        sensors_id = ast.literal_eval(desc["sensor_ids"][0])
 
         # Only log and split devices in tech_obs DB
         if tech_obs_id is not None and device_id not in devices_ids:
-            print(f"Skipping {name} not in tech obs device list: {devices_ids}")
+            print(f"Skipping {stream.name} not in tech obs device list: {devices_ids}")
             continue
-        
+
         sensors = "-".join(sensors_id)
-        data_sens = {'marker': marker, 'device_data': dev_data}
-        head, ext = op.splitext(fname)
         fname_full = f"{head}-{device_id}-{sensors}.hdf5"
-        write_hdf5(fname_full, data_sens, overwrite=True)
-        print(f"Saving stream {name} to {fname_full}")
-        files.append(fname_full)
-        _, head = op.split(fname_full)
+        print(f"Saving stream {stream.name} to {fname_full}")
+        jobs.append((stream.stream_id, fname_full, device_id, sensors_id))
 
-        time_offset = compute_clocks_diff()
-        start_time = dev_data['time_stamps'][0] + time_offset
-        end_time = dev_data['time_stamps'][-1] + time_offset
-        start_time = datetime.fromtimestamp(start_time).strftime("%Y-%m-%d %H:%M:%S")
-        end_time = datetime.fromtimestamp(end_time).strftime("%Y-%m-%d %H:%M:%S")
-        temp_res = 1 / np.median(np.diff(dev_data['time_stamps']))
+    def done(n_done):
+        if callback is not None:
+            callback(n_done, len(jobs))
 
-        if videofiles.get(name): 
-            head = f"{head}, {videofiles.get(name)}"
-            print(f"Videofile name: {head}")
+    t_split = perf_counter()
+    scan_time = t_split - t_scan
+
+    n_jobs = min(os.cpu_count() if n_jobs == -1 else n_jobs, len(jobs))
+    if n_jobs > 1:
+        with ProcessPoolExecutor(n_jobs) as pool:
+            futures = [pool.submit(_split_stream, fname, *job, marker_file, buffer_size,
+                                   **kwargs)
+                       for job in jobs]
+            for n_done, _ in enumerate(as_completed(futures), 1):
+                done(n_done)
+            summaries = [future.result() for future in futures]
+    else:
+        summaries = []
+        for job in jobs:
+            summaries.append(_split_stream(fname, *job, marker_file, buffer_size, **kwargs))
+            done(len(summaries))
+    split_time = perf_counter() - t_split
 
-        if tech_obs_log_id is not None:
-            for sens_id in sensors_id:
-                cols = ["tech_obs_log_id", "true_temporal_resolution", "true_spatial_resolution",
-                 "file_start_time", "file_end_time", "device_id", "sensor_id", 'sensor_file_path']
-                vals = [(tech_obs_log_id, temp_res, None, start_time, end_time, device_id, sens_id,
-                 "{" + head + "}")]
-                table_sens_log.insert_rows(vals, cols)
+    streams = {stream.stream_id: stream for stream in streams}
+    files = [(fname_full, streams[stream_id].name, device_id, sensors_id)
+             for stream_id, fname_full, device_id, sensors_id in jobs]
+    with meta.checkout(conn) as db_conn:
+        db_time += _insert_sensor_file_rows(tech_obs_log_id, files, summaries, videofiles,
+                                            db_conn)
 
+    report = {"n_streams": len(jobs),
+              "n_samples": sum(summary["n_samples"] for summary in summaries),
+              "scan_s": round(scan_time, 3),
+              "split_s": round(split_time, 3),
+              "db_s": round(db_time, 3),
+              "total_s": round(perf_counter() - t_start, 3)}
+    print(f"Split report of {fname}: {report}")
+    report["quality"] = {op.basename(fname_full): summary["quality"]
+                         for (fname_full, *_), summary in zip(files, summaries)}
+    files = [fname_full for fname_full, *_ in files]
+    if return_report:
+        return files, report
     return files
 
+
 def get_xdf_name(session, fname_prefix):
     """Get with most recent session xdf file name.
 
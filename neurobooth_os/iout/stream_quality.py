@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+# License: BSD-3-Clause
+# Quality of the time stamps of a stream
+
+"""Quality of the time stamps of a recorded stream.
+
+The metrics are computed with numpy on the whole stream, in time linear in
+the number of samples. They are saved in the "quality" attribute of the
+stream group of the HDF5 files, see sensor_file.
+"""
+
+import numpy as np
+
+# Streams whose first channel is the index of the video frame
+FRAME_COUNTER_TYPES = ["videostream"]
+
+
+def timestamp_quality(time_stamps, srate=0., frame_counter=None, gap_factor=2.,
+                      percentiles=(50, 95, 99)):
+    """Compute the quality metrics of the time stamps of a stream.
+
+    Parameters
+    ----------
+    time_stamps : ndarray, shape (n_samples,)
+        Time stamps of the samples, before dejittering.
+    srate : float
+        Nominal rate of the stream, 0 if irregular, by default 0.
+    frame_counter : ndarray, shape (n_samples,) | None
+        Index of the video frame of each sample, for camera streams, by
+        default None
+    gap_factor : float
+        Intervals longer than gap_factor periods are gaps. The period is
+        1 / srate, or the median interval of irregular streams. By default 2.
+    percentiles : tuple of float
+        Percentiles of the jitter, by default (50, 95, 99)
+
+    Returns
+    -------
+    quality : dict
+        "n_samples", "duration" (s), "effective_srate" (Hz), "median_interval"
+        (s), "jitter_p<percentile>" (s, absolute deviation of the intervals
+        from the median interval, gaps excluded), "n_gaps", "max_gap" (s),
+        "gap_duration" (s), "n_dropouts" (samples missing in the gaps),
+        "n_duplicates" (equal time stamps) and "n_non_monotonic" (time
+        stamps before the previous one). With a frame counter, also
+        "n_frame_jumps" (frames not following the previous one),
+        "n_dropped_frames" and "n_repeated_frames". Values are None when the
+        stream has too few samples.
+    """
+    time_stamps = np.asarray(time_stamps, dtype=float)
+    n_samples = len(time_stamps)
+    quality = dict.fromkeys(["duration", "effective_srate", "median_interval"]
+                            + [f"jitter_p{p:g}" for p in percentiles]
+                            + ["n_gaps", "max_gap", "gap_duration", "n_dropouts",
+                               "n_duplicates", "n_non_monotonic"])
+    quality["n_samples"] = n_samples
+    if frame_counter is not None:
+        quality.update(dict.fromkeys(["n_frame_jumps", "n_dropped_frames", "n_repeated_frames"]))
+        if n_samples > 1:
+            steps = np.diff(np.asarray(frame_counter, dtype=np.int64))
+            skipped = steps > 1
+            quality["n_frame_jumps"] = int(np.count_nonzero(steps != 1))
+            quality["n_dropped_frames"] = int(steps[skipped].sum() - np.count_nonzero(skipped))
+            quality["n_repeated_frames"] = int(np.count_nonzero(steps <= 0))
+    if n_samples < 2:
+        return quality
+
+    intervals = np.diff(time_stamps)
+    duration = time_stamps[-1] - time_stamps[0]
+    median = np.median(intervals)
+    quality["duration"] = float(duration)
+    quality["effective_srate"] = float((n_samples - 1) / duration) if duration > 0 else None
+    quality["median_interval"] = float(median)
+    quality["n_duplicates"] = int(np.count_nonzero(intervals == 0))
+    quality["n_non_monotonic"] = int(np.count_nonzero(intervals < 0))
+
+    period = 1 / srate if srate > 0 else median
+    gaps = intervals > gap_factor * period if period > 0 else np.zeros(len(intervals), bool)
+    quality["n_gaps"] = int(np.count_nonzero(gaps))
+    quality["max_gap"] = float(intervals[gaps].max()) if quality["n_gaps"] else 0.
+    quality["gap_duration"] = float(intervals[gaps].sum())
+    quality["n_dropouts"] = 0
+    if quality["n_gaps"]:
+        quality["n_dropouts"] = int(np.rint(intervals[gaps] / period).sum()) - quality["n_gaps"]
+
+    jitter = np.abs(intervals[~gaps] - median)
+    if len(jitter):
+        for p, value in zip(percentiles, np.percentile(jitter, percentiles)):
+            quality[f"jitter_p{p:g}"] = float(value)
+    return quality
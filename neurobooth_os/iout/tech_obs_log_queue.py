@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+# License: BSD-3-Clause
+# Write the tech_obs_log rows of a session in the background
+
+"""Write-behind queue of the tech_obs_log rows of a session.
+
+The rows of the tasks of a session are inserted together before the first
+task, and their values are written by a background thread once each task
+is done, so STM does not wait on the database between tasks. Writes not
+yet committed are kept in a json spool, saved each time it changes and
+written at the next start if STM stops::
+
+    [{"op": "fill", "id": "...", "values": {"tech_obs_id": "...", ...}},
+     {"op": "insert", "id": "local_3f2a9c1e...", "subject_id": "..."},
+     {"op": "delete", "ids": ["..."]}]
+
+When the database can not be reached, new rows get a local id, "local_"
+followed by a random hex string, and are inserted with it when the database
+is back. Writes the database rejects are moved to the file ``*_failed.json``
+next to the spool.
+"""
+
+import os
+import json
+import time
+import uuid
+import threading
+import os.path as op
+
+import psycopg2
+
+from neurobooth_os.iout import metadator as meta
+
+
+class TechObsLogQueue():
+    def __init__(self, conn, spool_fname, retry_interval=5.):
+        """Write tech_obs_log rows in a background thread.
+
+        Parameters
+        ----------
+        conn : callable | instance of ConnectionPool
+            Connector to the database.
+        spool_fname : str
+            Path of the json spool of the writes not committed.
+        retry_interval : float
+            Seconds between two attempts to commit when the database can not
+            be reached, by default 5.
+        """
+        self.conn = conn
+        self.spool_fname = spool_fname
+        self.retry_interval = retry_interval
+        self.db_ok = True
+        self.n_committed = 0
+        self.failed_fname = op.splitext(spool_fname)[0] + "_failed.json"
+        self.failed = []
+        if op.exists(self.failed_fname):
+            with open(self.failed_fname) as f:
+                self.failed = json.load(f)
+        self._ids = []
+        self._subject_id = None
+        self._n_wanted = 0
+        self._pending = []
+        if op.exists(spool_fname):
+            with open(spool_fname) as f:
+                self._pending = json.load(f)
+            print(f"{len(self._pending)} tech_obs_log writes of a previous session to commit")
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def _save(self):
+        # Must hold self._lock
+        with open(self.spool_fname + ".tmp", "w") as f:
+            json.dump(self._pending, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.spool_fname + ".tmp", self.spool_fname)
+
+    def _enqueue(self, write):
+        with self._lock:
+            self._pending.append(write)
+            self._save()
+        self._wake.set()
+
+    def _change_subject(self, subject_id):
+        # Must hold self._lock, rows of another subject are deleted
+        if subject_id == self._subject_id:
+            return
+        if self._ids:
+            self._pending.append({"op": "delete", "ids": self._ids})
+            self._save()
+        self._ids, self._n_wanted, self._subject_id = [], 0, subject_id
+
+    def reserve(self, subject_id, n_rows):
+        """Insert the rows of the next tasks in the background.
+
+        Parameters
+        ----------
+        subject_id : str
+            The subject of the session.
+        n_rows : int
+            Number of tasks that will call new_row.
+        """
+        with self._lock:
+            self._change_subject(subject_id)
+            self._n_wanted = n_rows
+        self._wake.set()
+
+    def new_row(self, subject_id):
+        """Id of a tech_obs_log row for a task, reserved if available.
+
+        Parameters
+        ----------
+        subject_id : str
+            The subject of the task.
+
+        Returns
+        -------
+        tech_obs_log_id : str
+            The id of the row, fill it with fill_row.
+        """
+        with self._lock:
+            self._change_subject(subject_id)
+            self._n_wanted = max(self._n_wanted - 1, 0)
+            if self._ids:
+                return self._ids.pop(0)
+            db_ok = self.db_ok
+
+        if db_ok:
+            # Not reserved, insert it now as _make_new_tech_obs_row did
+            try:
+                with meta.checkout(self.conn) as conn:
+                    row_id, = meta._allocate_tech_obs_rows(subject_id, 1, conn)
+                return row_id
+            except meta.DB_ERRORS as e:
+                print(f"Database unreachable, tech_obs_log row spooled: {e}")
+                self.db_ok = False
+        row_id = f"local_{uuid.uuid4().hex}"
+        self._enqueue({"op": "insert", "id": row_id, "subject_id": subject_id})
+        return row_id
+
+    def fill_row(self, tech_obs_log_id, values):
+        """Queue the values of a row, as _fill_tech_obs_row writes them.
+
+        Parameters
+        ----------
+        tech_obs_log_id : str
+            The id of the row, from new_row.
+        values : dict
+            The values by column, copied.
+        """
+        self._enqueue({"op": "fill", "id": tech_obs_log_id, "values": dict(values)})
+
+    def _commit(self):
+        with self._lock:
+            ops = list(self._pending)
+        if not ops:
+            return
+        failed = []
+        with meta.checkout(self.conn) as conn:
+            try:
+                meta._write_tech_obs_ops(ops, conn)
+            except meta.DB_ERRORS:
+                raise
+            except psycopg2.Error:
+                # A write the database rejects must not block the others
+                for write in ops:
+                    try:
+                        meta._write_tech_obs_ops([write], conn)
+                    except meta.DB_ERRORS:
+                        raise
+                    except psycopg2.Error as e:
+                        print(f"tech_obs_log write rejected, saved to {self.failed_fname}: {e}")
+                        failed.append(dict(write, error=str(e)))
+        with self._lock:
+            del self._pending[:len(ops)]
+            self._save()
+            if failed:
+                self.failed.extend(failed)
+                with open(self.failed_fname, "w") as f:
+                    json.dump(self.failed, f, indent=1)
+        self.n_committed += len(ops) - len(failed)
+
+    def _reserve(self):
+        with self._lock:
+            subject_id, n_rows = self._subject_id, self._n_wanted - len(self._ids)
+        if n_rows <= 0:
+            return
+        with meta.checkout(self.conn) as conn:
+            ids = meta._allocate_tech_obs_rows(subject_id, n_rows, conn)
+        with self._lock:
+            if subject_id == self._subject_id:
+                self._ids.extend(ids)
+                return
+        self._enqueue({"op": "delete", "ids": ids})
+
+    def _run(self):
+        while True:
+            self._wake.wait(None if self.db_ok else self.retry_interval)
+            self._wake.clear()
+            stopping = self._stop_event.is_set()
+            try:
+                self._commit()
+                if not stopping:
+                    self._reserve()
+            except meta.DB_ERRORS as e:
+                if self.db_ok:
+                    print(f"Database unreachable, tech_obs_log writes spooled to "
+                          f"{self.spool_fname}: {e}")
+                self.db_ok = False
+            else:
+                if not self.db_ok:
+                    print("Database reachable, tech_obs_log writes committed")
+                self.db_ok = True
+            if stopping:
+                return
+
+    def start(self):
+        """Start the background thread, committing the spooled writes."""
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self._wake.set()
+
+    def flush(self, timeout=None):
+        """Wait until the queued writes are committed.
+
+        Returns
+        -------
+        committed : bool
+            False if writes are still pending after timeout seconds.
+        """
+        t_end = None if timeout is None else time.time() + timeout
+        self._wake.set()
+        while self.n_pending:
+            if t_end is not None and time.time() > t_end:
+                return False
+            time.sleep(.01)
+        return True
+
+    def stop(self, timeout=None):
+        """Delete the rows reserved and not used, commit and stop the thread.
+
+        Parameters
+        ----------
+        timeout : float | None
+            Seconds to wait for the last commit, by default None
+
+        Returns
+        -------
+        n_pending : int
+            Writes left in the spool, committed at the next start.
+        """
+        with self._lock:
+            ids, self._ids, self._n_wanted = self._ids, [], 0
+        if ids:
+            self._enqueue({"op": "delete", "ids": ids})
+        self._stop_event.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        return self.n_pending
+
+    @property
+    def n_pending(self):
+        """Number of writes not committed."""
+        with self._lock:
+            return len(self._pending)
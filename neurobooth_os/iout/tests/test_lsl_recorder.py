@@ -0,0 +1,61 @@
+import time
+
+import numpy as np
+import pylsl
+import pytest
+
+from neurobooth_os.iout.lsl_recorder import LslRecorder
+from neurobooth_os.iout.sensor_file import read_sensor_file, SensorFile
+
+
+def _outlet(name, n_channels, srate, channel_format, device_id=None):
+    info = pylsl.StreamInfo(name, "test", n_channels, srate, channel_format, f"{name}_id")
+    if device_id is not None:
+        info.desc().append_child_value("device_id", device_id)
+        info.desc().append_child_value("sensor_ids", f"['{device_id}_sens']")
+    return pylsl.StreamOutlet(info)
+
+
+def test_lsl_recorder(tmp_path):
+    outlets = {"dev_stream": _outlet("dev_stream", 3, 100, "float32", "dev_1"),
+               "Marker": _outlet("Marker", 1, 0, "string"),
+               "no_device": _outlet("no_device", 1, 10, "float32")}
+    inlets = {}
+    for name in outlets:
+        info, = pylsl.resolve_byprop("source_id", f"{name}_id", timeout=5)
+        inlets[name] = pylsl.StreamInlet(info)
+
+    recorder = LslRecorder(inlets, str(tmp_path), buffer_size=1000, poll_interval=.01,
+                           clock_interval=.2, compression="gzip", chunk_size=1e3)
+    recorder.start("subj_task")
+    time.sleep(.5)
+
+    rng = np.random.RandomState(0)
+    data = rng.randn(300, 3).astype("f4")
+    t0 = pylsl.local_clock()
+    time_stamps = t0 + np.arange(300) / 100.
+    outlets["Marker"].push_sample(["Task_start"], time_stamps[0])
+    for start in range(0, 300, 30):
+        outlets["dev_stream"].push_chunk(data[start:start + 30].tolist(),
+                                         list(time_stamps[start:start + 30]))
+        time.sleep(.02)
+    outlets["Marker"].push_sample(["Task_end"], time_stamps[-1])
+    time.sleep(.5)
+
+    files, report = recorder.stop(return_report=True)
+    assert files == [str(tmp_path / "subj_task-dev_1-dev_1_sens.hdf5")]
+    assert report["n_samples"] == 300
+
+    recorded = read_sensor_file(files[0])
+    np.testing.assert_array_equal(recorded["device_data"]["time_series"], data)
+    # Synchronized with the clock offsets of the same computer, and dejittered
+    np.testing.assert_allclose(recorded["device_data"]["time_stamps"], time_stamps, atol=1e-3)
+    assert recorded["marker"]["time_series"] == [["Task_start"], ["Task_end"]]
+    with SensorFile(files[0]) as f:
+        assert f.attrs["device_id"] == "dev_1"
+        assert f.attrs["effective_srate"] == pytest.approx(100, rel=1e-3)
+
+    # Streams without samples still get their file
+    recorder.start("subj_task_2")
+    recorder.stop()
+    assert (tmp_path / "subj_task_2-dev_1-dev_1_sens.hdf5").exists()
@@ -1,4 +1,5 @@
-
+import pytest
+import psycopg2
 
 from neurobooth_os.iout import metadator as meta
 
@@ -23,3 +24,267 @@ def test_tech_obs_addition():
     
 
 
+class _Cursor():
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, query, params=None):
+        self.conn.queries.append(query)
+        if query.startswith("SELECT row_to_json(t) FROM"):
+            self.rows = [(row,) for row in self.conn.table_rows(query.split()[3])]
+            return
+        ids, = params
+        if "FROM collection" in query:
+            self.rows = [(task, self.conn.stimuli[task["stimulus_id"]], None)
+                         for task in self.conn.tasks]
+        elif "FROM tech_obs_data" in query:
+            self.rows = [(task, None) for task in self.conn.tasks if task["tech_obs_id"] in ids]
+        elif "FROM device" in query:
+            self.rows = [({"device_id": dev_id, "device_sn": f"SN_{dev_id}"},) for dev_id in ids]
+        else:
+            self.rows = [({"sensor_id": sens_id, "temporal_res": 30, "spatial_res_x": 640,
+                           "spatial_res_y": 480},) for sens_id in ids]
+
+    def fetchall(self):
+        return self.rows
+
+
+class _Conn():
+    def __init__(self, n_tasks):
+        """Database returning n_tasks tasks with the same 3 devices."""
+        self.dsn = "dbname=fake"
+        self.queries = []
+        self.tasks = [{"tech_obs_id": f"obs_{i}", "stimulus_id": f"stim_{i}",
+                       "instruction_id": None,
+                       "device_id_array": ["Intel_D455_1", "FLIR_blackfly_1", "Mouse"],
+                       "sensor_id_array": [["Intel_D455_rgb_1", "Intel_D455_depth_1"],
+                                           ["FLIR_rgb_1"], ["mouse"]]}
+                      for i in range(n_tasks)]
+        self.stimuli = {task["stimulus_id"]: {"stimulus_id": task["stimulus_id"],
+                                              "stimulus_file": "task.py", "duration": 10,
+                                              "num_iterations": 1, "parameters": None,
+                                              "parameters_file": None}
+                        for task in self.tasks}
+        self.lost = False
+
+    def cursor(self):
+        if self.lost:
+            raise psycopg2.OperationalError("could not connect to server")
+        return _Cursor(self)
+
+    def rollback(self):
+        pass
+
+    def table_rows(self, table):
+        # Rows of the tables of the snapshot
+        if table == "study":
+            return [{"study_id": "mock_study", "collection_ids": ["mock_collection"]}]
+        if table == "collection":
+            return [{"collection_id": "mock_collection",
+                     "tech_obs_array": [task["tech_obs_id"] for task in self.tasks]}]
+        if table == "tech_obs_data":
+            return self.tasks
+        if table == "stimulus":
+            return list(self.stimuli.values())
+        if table == "instruction":
+            return []
+        cursor = _Cursor(self)
+        dev_ids = sorted({dev_id for task in self.tasks for dev_id in task["device_id_array"]})
+        sens_ids = sorted({sens_id for task in self.tasks for ids in task["sensor_id_array"]
+                           for sens_id in ids})
+        cursor.execute(f"FROM {table}", (dev_ids if table == "device" else sens_ids,))
+        return [row for row, in cursor.fetchall()]
+
+
+def test_load_collection(monkeypatch):
+    monkeypatch.setattr(meta, "_snapshot_fname", None)
+    meta.invalidate_collection_cache()
+    conn = _Conn(20)
+    kwargs = meta._get_coll_dev_kwarg_tasks("mock_collection", conn)
+    assert len(conn.queries) == 3
+    assert list(kwargs) == [f"stim_{i}" for i in range(20)]
+    assert kwargs["stim_3"]["Intel_D455_1"]["camindex"] == [1, "SN_Intel_D455_1"]
+    assert kwargs["stim_3"]["Intel_D455_1"]["size_depth"] == (640, 480)
+    assert kwargs["stim_3"]["FLIR_blackfly_1"]["fps"] == 30
+    assert kwargs["stim_3"]["Mouse"] == {"device_id": "Mouse", "sensor_ids": ["mouse"]}
+
+    # Cached until invalidated
+    collection = meta.load_collection("mock_collection", conn)
+    assert len(conn.queries) == 3
+    assert meta._stim_kwargs(collection["tasks"]["obs_0"]["stimulus"]) == \
+        ("task.py", {"duration": 10, "num_iterations": 1})
+    meta.invalidate_collection_cache("mock_collection")
+    meta.load_collection("mock_collection", conn)
+    assert len(conn.queries) == 6
+
+
+class _PoolConn():
+    def __init__(self):
+        self.closed = 0
+        self.lost = False
+
+    def cursor(self):
+        if self.lost:
+            raise psycopg2.OperationalError("server closed the connection")
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, query):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class _Pool():
+    def __init__(self, minconn, maxconn, **kwargs):
+        """ThreadedConnectionPool reusing the connections given back."""
+        self.closed = False
+        self.free = []
+        self.opened = 0
+
+    def getconn(self):
+        if self.free:
+            return self.free.pop()
+        self.opened += 1
+        return _PoolConn()
+
+    def putconn(self, conn, close=False):
+        if close:
+            conn.closed = 1
+        else:
+            self.free.append(conn)
+
+    def closeall(self):
+        self.closed = True
+
+
+def test_connection_pool(monkeypatch):
+    monkeypatch.setattr(meta, "ThreadedConnectionPool", _Pool)
+    monkeypatch.setattr(meta, "_connect_kwargs", lambda remote, database: {})
+    pool = meta.ConnectionPool(maxconn=2, health_interval=0)
+
+    # Threads wait for a connection when all are used
+    conn_1, conn_2 = pool.getconn(), pool.getconn()
+    with pytest.raises(TimeoutError):
+        pool.getconn(timeout=.1)
+    pool.putconn(conn_2)
+    assert pool.getconn(timeout=.1) is conn_2
+    pool.putconn(conn_1)
+    pool.putconn(conn_2)
+
+    # Connections lost are replaced when taken
+    conn_2.lost = True
+    with pool.connection() as conn:
+        assert conn is conn_1
+    assert conn_2.closed and pool._pool.opened == 2
+
+    # Connections failing while used are closed
+    with pytest.raises(psycopg2.OperationalError):
+        with pool.connection() as conn:
+            conn.lost = True
+            conn.cursor()
+    assert conn.closed
+
+    with meta.checkout(pool) as conn:
+        assert isinstance(conn, _PoolConn)
+    with meta.checkout(conn_1) as conn:
+        assert conn is conn_1
+    pool.closeall()
+    assert pool._pool.closed
+
+
+def test_config_snapshot(tmp_path, monkeypatch):
+    fname = str(tmp_path / "snapshot.sqlite")
+    conn = _Conn(5)
+    info = meta.export_snapshot(conn, fname)
+    assert info["n_tech_obs_data"] == 5 and info["n_device"] == 3 and info["n_sensor"] == 4
+    snapshot = meta.ConfigSnapshot.load(fname)
+    assert snapshot.info["stamp"] == info["stamp"]
+    assert meta.ConfigSnapshot.load(fname, max_age=-1) is None
+
+    monkeypatch.setattr(meta, "_snapshot_fname", None)
+    meta.invalidate_collection_cache()
+    collection = meta.load_collection("mock_collection", conn)
+    n_queries = len(conn.queries)
+
+    # Read from the fresh snapshot without the database
+    monkeypatch.setattr(meta, "_snapshot_fname", fname)
+    conn.lost = True
+    meta.invalidate_collection_cache()
+    assert meta.load_collection("mock_collection", conn) == collection
+    assert meta.get_collection_ids("mock_study", conn) == ["mock_collection"]
+    assert meta._get_task_param("obs_2", conn) == (
+        "stim_2", ["Intel_D455_1", "FLIR_blackfly_1", "Mouse"],
+        [["Intel_D455_rgb_1", "Intel_D455_depth_1"], ["FLIR_rgb_1"], ["mouse"]], {})
+
+    # Stale snapshots are only read when the database is unreachable
+    monkeypatch.setattr(meta, "_snapshot_max_age", -1)
+    meta.invalidate_collection_cache()
+    assert meta.load_collection("mock_collection", conn) == collection
+    conn.lost = False
+    meta.invalidate_collection_cache()
+    meta.load_collection("mock_collection", conn)
+    assert len(conn.queries) == n_queries + 3
+    snapshot = meta.refresh_snapshot(conn)
+    assert snapshot.info["created_ts"] > info["created_ts"]
+    assert snapshot.info["stamp"] == info["stamp"]
+
+
+def test_reload_collection(tmp_path, monkeypatch):
+    # A task added to the collection after the snapshot was exported
+    fname = str(tmp_path / "snapshot.sqlite")
+    stamp = meta.export_snapshot(_Conn(5), fname)["stamp"]
+    monkeypatch.setattr(meta, "_snapshot_fname", fname)
+    assert meta.snapshot_stamp() == stamp
+    conn = _Conn(6)
+    meta.invalidate_collection_cache()
+
+    # Read from the snapshot CTR listed the collection from
+    collection = meta.reload_collection("mock_collection", conn, stamp)
+    assert len(collection["tasks"]) == 5
+    assert conn.queries == []
+
+    # Else from the database, the later lookups hit the cache
+    collection = meta.reload_collection("mock_collection", conn, "other")
+    assert list(collection["tasks"]) == [f"obs_{i}" for i in range(6)]
+    n_queries = len(conn.queries)
+    assert meta.load_collection("mock_collection", conn) is collection
+    assert "stim_5" in meta._get_coll_dev_kwarg_tasks("mock_collection", conn)
+    assert len(conn.queries) == n_queries
+
+    # The snapshot when the database can not be reached
+    conn.lost = True
+    collection = meta.reload_collection("mock_collection", conn)
+    assert len(collection["tasks"]) == 5
+    meta.invalidate_collection_cache()
+
+
+def test_batched_lookups(monkeypatch):
+    monkeypatch.setattr(meta, "_snapshot_fname", None)
+    meta.invalidate_collection_cache()
+    conn = _Conn(5)
+    params = meta.get_task_params(["obs_1", "obs_3", "obs_9"], conn)
+    assert list(params) == ["obs_1", "obs_3"]
+    assert params["obs_3"] == meta._get_task_param("obs_3", conn)
+    assert meta.get_dev_sns(["Mouse", "Intel_D455_1"], conn) == \
+        {"Mouse": "SN_Mouse", "Intel_D455_1": "SN_Intel_D455_1"}
+    assert meta.get_sens_params(["FLIR_rgb_1", "mouse"], conn)["mouse"]["temporal_res"] == 30
+    n_queries = len(conn.queries)
+
+    # One query per table for all the devices and sensors of the task
+    kwargs = meta.get_kwarg_task("obs_0", conn)
+    assert len(conn.queries) == n_queries + 3
+    assert kwargs == meta._get_coll_dev_kwarg_tasks("mock_collection", conn)["stim_0"]
+    assert all("%s" in query for query in conn.queries)
@@ -0,0 +1,41 @@
+import os
+import json
+
+from neurobooth_os.iout.resplit import main, resplit, MANIFEST_FNAME
+from neurobooth_os.iout.tests.test_split_xdf import _write_xdf
+
+
+def test_resplit(tmp_path):
+    os.makedirs(tmp_path / "subj_1")
+    fnames = [str(tmp_path / "subj_1" / "task_R001.xdf"), str(tmp_path / "task_R002.xdf")]
+    for fname in fnames:
+        _write_xdf(fname)
+
+    summary = resplit(str(tmp_path), dry_run=True)
+    assert summary["n_split"] == 2
+    assert [job["reason"] for job in summary["jobs"]] == ["missing", "missing"]
+    assert not (tmp_path / MANIFEST_FNAME).exists()
+
+    out = str(tmp_path / "summary.json")
+    assert main(["--folder", str(tmp_path), "--n-jobs", "2", "--out", out]) == 0
+    with open(out) as f:
+        summary = json.load(f)
+    assert summary["n_split"] == 2
+    assert summary["mb_per_s"] > 0
+    assert summary["jobs"][0]["report"]["n_streams"] == 2
+    assert (tmp_path / "subj_1" / "task_R001-dev_1-dev_1_sens.hdf5").exists()
+
+    # Same content with a new modification time is not split again
+    os.utime(fnames[0], (0, 0))
+    summary = resplit(str(tmp_path))
+    assert summary["n_split"] == 0
+    assert [job["reason"] for job in summary["jobs"]] == ["unchanged", "unchanged"]
+
+    # Changed content or deleted outputs are split again
+    with open(fnames[1], "ab") as f:
+        f.write(b"\x00")
+    os.remove(tmp_path / "subj_1" / "task_R001-marker.hdf5")
+    summary = resplit(str(tmp_path))
+    assert [job["reason"] for job in summary["jobs"]] == ["missing", "changed"]
+    assert summary["n_split"] == 2
+    assert resplit(str(tmp_path), force=True, dry_run=True)["n_split"] == 2
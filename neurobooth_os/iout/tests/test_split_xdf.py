@@ -0,0 +1,233 @@
+import time
+import struct
+
+import numpy as np
+import pytest
+import pyxdf
+
+from neurobooth_os.iout.split_xdf import split_sens_files, _split_stream
+from neurobooth_os.iout.sensor_file import read_sensor_file, SensorFile
+from neurobooth_os.iout.split_queue import SplitQueue
+from neurobooth_os.iout.xdf_reader import XdfIndex
+
+
+def _chunk(tag, content):
+    content = struct.pack("<H", tag) + content
+    return bytes([8]) + struct.pack("<Q", len(content)) + content
+
+
+def _stream_header(stream_id, name, n_channels, srate, channel_format, device_id=None):
+    desc = ""
+    if device_id is not None:
+        desc = (f"<desc><device_id>{device_id}</device_id>"
+                f"<sensor_ids>['{device_id}_sens']</sensor_ids></desc>")
+    xml = (f"<?xml version='1.0'?><info><name>{name}</name><type>test</type>"
+           f"<channel_count>{n_channels}</channel_count><nominal_srate>{srate}</nominal_srate>"
+           f"<channel_format>{channel_format}</channel_format>{desc}</info>")
+    return _chunk(2, struct.pack("<I", stream_id) + xml.encode())
+
+
+def _samples(stream_id, time_stamps, values):
+    content = struct.pack("<I", stream_id) + bytes([4]) + struct.pack("<I", len(time_stamps))
+    for ts, sample in zip(time_stamps, values):
+        # Omit some time stamps, deduced from the nominal rate by the readers
+        content += bytes([0]) if ts is None else bytes([8]) + struct.pack("<d", ts)
+        if isinstance(sample[0], str):
+            for value in sample:
+                content += bytes([1, len(value)]) + value.encode()
+        else:
+            content += np.asarray(sample, "<f4").tobytes()
+    return _chunk(3, content)
+
+
+def _write_xdf(fname):
+    rng = np.random.RandomState(0)
+    srate, n_samples = 100., 2000
+    time_stamps = 10 + np.arange(n_samples) / srate + rng.uniform(0, 1e-3, n_samples)
+    # Gap starting a new dejitter segment
+    time_stamps[1200:] += 5
+    data = rng.randn(n_samples, 3)
+
+    content = b"XDF:" + _chunk(1, b"<?xml version='1.0'?><info><version>1.0</version></info>")
+    content += _stream_header(1, "dev_stream", 3, srate, "float32", "dev_1")
+    content += _stream_header(2, "Marker", 1, 0, "string")
+    content += _stream_header(3, "dev_stream_2", 3, srate, "float32", "dev_2")
+    for start in range(0, n_samples, 150):
+        stop = min(start + 150, n_samples)
+        ts = list(time_stamps[start:stop])
+        ts[1] = None
+        content += _samples(1, ts, data[start:stop])
+        name = "Trial-start" if start % 300 == 0 else "Trial-end"
+        content += _samples(2, [time_stamps[start]], [[f"{name}_{1623456789 + start / 100}"]])
+        content += _samples(3, ts, -data[start:stop])
+        content += _chunk(4, struct.pack("<Idd", 1, time_stamps[start], .5 + 1e-4 * start / 150))
+        content += _chunk(4, struct.pack("<Idd", 2, time_stamps[start], .5 + 1e-4 * start / 150))
+    with open(fname, "wb") as f:
+        f.write(content)
+
+
+@pytest.mark.parametrize("n_jobs", [1, 2])
+def test_split_sens_files(tmp_path, n_jobs):
+    fname = str(tmp_path / "task.xdf")
+    _write_xdf(fname)
+
+    files, report = split_sens_files(fname, buffer_size=10000, n_jobs=n_jobs,
+                                     return_report=True)
+    assert report["n_streams"] == 2
+    assert report["n_samples"] == 4000
+    assert report["db_s"] == 0
+    assert files == [str(tmp_path / "task-dev_1-dev_1_sens.hdf5"),
+                     str(tmp_path / "task-dev_2-dev_2_sens.hdf5")]
+    assert (tmp_path / "task-marker.hdf5").exists()
+    # Indexed by the split, later reads seek to the chunks of a stream
+    assert XdfIndex.load(fname) is not None
+
+    # A stream without header chunk
+    fname = str(tmp_path / "no_header.xdf")
+    _write_xdf(fname)
+    with pytest.raises(ValueError, match="no header for stream 99"):
+        _split_stream(fname, 99, str(tmp_path / "no_header.hdf5"), "dev_99", [])
+
+    streams, _ = pyxdf.load_xdf(fname)
+    expected = {s["info"]["name"][0]: s for s in streams}
+    for file, name in zip(files, ["dev_stream", "dev_stream_2"]):
+        data = read_sensor_file(file)
+        device, marker = data["device_data"], data["marker"]
+        assert device["info"]["name"] == [name]
+        np.testing.assert_array_equal(device["time_series"], expected[name]["time_series"])
+        np.testing.assert_allclose(device["time_stamps"], expected[name]["time_stamps"],
+                                   atol=1e-6)
+        assert marker["time_series"] == expected["Marker"]["time_series"]
+        np.testing.assert_allclose(marker["time_stamps"], expected["Marker"]["time_stamps"],
+                                   atol=1e-6)
+
+
+@pytest.mark.parametrize("compression, chunk_size", [("gzip", 1e3), (None, None)])
+def test_sensor_file(tmp_path, compression, chunk_size):
+    fname = str(tmp_path / "task.xdf")
+    _write_xdf(fname)
+    files = split_sens_files(fname, compression=compression, chunk_size=chunk_size)
+    expected = read_sensor_file(files[0])["device_data"]
+
+    with SensorFile(files[0]) as f:
+        assert f.attrs["device_id"] == "dev_1"
+        assert f.attrs["nominal_srate"] == 100
+        assert len(f) == 2000
+        assert f.time_series.compression == compression
+        # The 5 s gap, 500 samples missing at 100 Hz
+        assert f.quality["n_gaps"] == 1
+        assert f.quality["n_dropouts"] == 500
+        assert f.quality["max_gap"] == pytest.approx(5.01, abs=1e-3)
+        assert f.quality["jitter_p99"] < 1e-3
+        assert f.quality["n_non_monotonic"] == 0
+
+        tmin, tmax = expected["time_stamps"][[100, 1500]]
+        time_stamps, time_series = f.window(tmin, tmax)
+        np.testing.assert_array_equal(time_stamps, expected["time_stamps"][100:1501])
+        np.testing.assert_array_equal(time_series, expected["time_series"][100:1501])
+        assert len(f.window(tmax + 100)[0]) == 0
+
+        if chunk_size is None:
+            np.testing.assert_array_equal(f.memmap(), expected["time_series"])
+        else:
+            with pytest.raises(ValueError, match="not contiguous"):
+                f.memmap()
+
+    with SensorFile(files[0]) as f, f.markers() as markers:
+        assert markers.marker_file is None
+        assert markers.window(tmin, tmax)[1][0, 0] == "Trial-end_1623456790.5"
+        assert markers.names == ["Trial-start", "Trial-end"]
+        assert markers.ranges["Trial-start"][2] == 7
+        marker_time_stamps = markers.time_stamps[()]
+        np.testing.assert_array_equal(markers.events("Trial-end"), marker_time_stamps[1::2])
+
+        # Event locked window of the device data
+        first, last = marker_time_stamps[[1, -1]]
+        assert markers.range("Trial-end") == (first, last)
+        start, stop = np.searchsorted(expected["time_stamps"], [first, last], "left")
+        time_stamps, _ = f.window(first, last)
+        np.testing.assert_array_equal(time_stamps, expected["time_stamps"][start:stop])
+
+
+def test_xdf_index(tmp_path):
+    fname = str(tmp_path / "task.xdf")
+    _write_xdf(fname)
+    assert XdfIndex.load(fname) is None
+    index = XdfIndex.build(fname)
+    assert XdfIndex.load(fname).streams == index.streams
+
+    raw = {s["info"]["name"][0]: s for s in pyxdf.load_xdf(
+        fname, synchronize_clocks=False, dejitter_timestamps=False)[0]}
+    synced = {s["info"]["name"][0]: s for s in pyxdf.load_xdf(
+        fname, dejitter_timestamps=False)[0]}
+    stream_id, = index.find_streams(name="dev_stream")
+    assert index.streams[stream_id]["n_samples"] == 2000
+    assert len(index.streams[stream_id]["chunks"]) == 14
+
+    stream = index.read_stream(stream_id)
+    np.testing.assert_array_equal(stream["time_stamps"], raw["dev_stream"]["time_stamps"])
+    np.testing.assert_array_equal(stream["time_series"], raw["dev_stream"]["time_series"])
+
+    # Only the chunks in the window are read
+    expected = synced["dev_stream"]["time_stamps"]
+    tmin, tmax = expected[[320, 1250]]
+    chunks = list(index.iter_chunks(stream_id, tmin - .5, tmax - .5))
+    assert [chunk.content[0][0] for chunk in chunks if chunk.tag == 3] == \
+        list(raw["dev_stream"]["time_stamps"][300:1350:150])
+    marker, device = index.read_window(tmin, tmax, index.find_streams(type="test")[1:],
+                                       synchronize=True)[:2]
+    # dev_stream_2 has no clock offsets
+    expected = synced["dev_stream_2"]["time_stamps"]
+    start = np.searchsorted(expected, tmin, "left")
+    stop = np.searchsorted(expected, tmax, "right")
+    np.testing.assert_allclose(device["time_stamps"], expected[start:stop], atol=1e-6)
+    np.testing.assert_array_equal(device["time_series"],
+                                  synced["dev_stream_2"]["time_series"][start:stop])
+    assert device["info"]["name"] == ["dev_stream_2"]
+    assert marker["time_series"] == [[m] for m, in synced["Marker"]["time_series"]
+                                     if "Trial" in m][3:9]
+
+    # split_sens_files reads the chunks of the streams from the index
+    files = split_sens_files(fname)
+    data = read_sensor_file(files[0])
+    np.testing.assert_allclose(data["device_data"]["time_stamps"],
+                               pyxdf.load_xdf(fname)[0][0]["time_stamps"], atol=1e-6)
+    assert data["marker"]["time_series"] == synced["Marker"]["time_series"]
+
+    # The index of a modified file is stale
+    with open(fname, "ab") as f:
+        f.write(b"\x00")
+    assert XdfIndex.load(fname) is None
+
+
+def test_split_queue(tmp_path):
+    fname = str(tmp_path / "task.xdf")
+    _write_xdf(fname)
+    journal = str(tmp_path / "split_jobs.json")
+
+    updates = []
+    split_queue = SplitQueue(journal, max_retries=1, retry_delay=0, on_update=updates.append)
+    # Queued before the workers start, resumed from the journal after a restart
+    job_id = split_queue.submit(fname)
+    failed_id = split_queue.submit(str(tmp_path / "missing.xdf"))
+    del split_queue
+
+    split_queue = SplitQueue(journal, max_retries=1, retry_delay=0, on_update=updates.append)
+    split_queue.start()
+    for _ in range(100):
+        if all(job["status"] in ["done", "failed"] for job in split_queue.status()):
+            break
+        time.sleep(.1)
+    split_queue.stop()
+
+    jobs = {job["id"]: job for job in split_queue.status()}
+    assert jobs[job_id]["status"] == "done"
+    assert jobs[job_id]["progress"] == [2, 2]
+    assert len(jobs[job_id]["files"]) == 2
+    assert jobs[job_id]["report"]["n_streams"] == 2
+    assert jobs[failed_id]["status"] == "failed"
+    assert jobs[failed_id]["attempts"] == 2
+    assert "running" in [u["status"] for u in updates]
+
+    # Done jobs are dropped from the journal at the next start
+    assert list(SplitQueue(journal).jobs) == [failed_id]
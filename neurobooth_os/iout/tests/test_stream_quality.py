@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+from neurobooth_os.iout.stream_quality import timestamp_quality
+
+
+def test_timestamp_quality():
+    rng = np.random.RandomState(0)
+    time_stamps = np.arange(1000) / 30. + rng.uniform(0, 1e-3, 1000)
+    frame_counter = np.arange(1000)
+    # 3 frames dropped, a duplicated time stamp and one out of order
+    time_stamps, frame_counter = np.delete(time_stamps, [100, 101, 102]), np.delete(
+        frame_counter, [100, 101, 102])
+    time_stamps[500] = time_stamps[499]
+    time_stamps[800] = time_stamps[799] - 1e-4
+    frame_counter[900:] -= 1
+
+    quality = timestamp_quality(time_stamps, 0, frame_counter, gap_factor=2.5)
+    assert quality["n_samples"] == 997
+    assert quality["effective_srate"] == pytest.approx(30 * 996 / 999, rel=1e-3)
+    assert quality["median_interval"] == pytest.approx(1 / 30., abs=1e-3)
+    assert quality["n_gaps"] == 1
+    assert quality["n_dropouts"] == 3
+    assert quality["max_gap"] == pytest.approx(4 / 30., abs=1e-3)
+    assert quality["n_duplicates"] == 1
+    assert quality["n_non_monotonic"] == 1
+    assert quality["jitter_p50"] < 1e-3
+    assert quality["n_frame_jumps"] == 2
+    assert quality["n_dropped_frames"] == 3
+    assert quality["n_repeated_frames"] == 1
+
+    quality = timestamp_quality(time_stamps[:1], 30)
+    assert quality["n_samples"] == 1
+    assert quality["effective_srate"] is None
+    assert "n_frame_jumps" not in quality
@@ -0,0 +1,113 @@
+import json
+import time
+import threading
+
+import psycopg2
+
+from neurobooth_os.iout import metadator as meta
+from neurobooth_os.iout.tech_obs_log_queue import TechObsLogQueue
+
+
+class _Cursor():
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, query, params):
+        self.db.queries.append(threading.current_thread().name)
+        if not isinstance(query, str):
+            *values, row_id = params
+            if row_id not in self.db.rows:
+                raise psycopg2.DataError(f"no row {row_id}")
+            self.db.rows[row_id]["values"] = values
+        elif "RETURNING" in query:
+            subject_id, n_rows = params
+            self.rows = []
+            for _ in range(n_rows):
+                self.db.n_ids += 1
+                row_id = f"obs_log_{self.db.n_ids}"
+                self.db.rows[row_id] = {"subject_id": subject_id}
+                self.rows.append((row_id,))
+        elif query.startswith("INSERT"):
+            row_id, subject_id = params
+            self.db.rows[row_id] = {"subject_id": subject_id}
+        else:
+            for row_id in params[0]:
+                del self.db.rows[row_id]
+
+    def fetchall(self):
+        return self.rows
+
+
+class _Db():
+    def __init__(self):
+        """tech_obs_log table, updates store their values in a list."""
+        self.rows = {}
+        self.n_ids = 0
+        self.queries = []
+        self.lost = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def cursor(self):
+        if self.lost:
+            raise psycopg2.OperationalError("could not connect to server")
+        return _Cursor(self)
+
+
+def test_tech_obs_log_queue(tmp_path):
+    db = _Db()
+    spool_fname = str(tmp_path / "spool.json")
+    obs_log = TechObsLogQueue(db, spool_fname, retry_interval=.05)
+    obs_log.start()
+
+    # Rows of the tasks inserted with one query in background
+    obs_log.reserve("subj", 3)
+    t_end = time.time() + 5
+    while len(obs_log._ids) < 3 and time.time() < t_end:
+        time.sleep(.01)
+    assert len(db.queries) == 1
+    row_id = obs_log.new_row("subj")
+    obs_log.fill_row(row_id, {"tech_obs_id": "obs_1", "event_array": "event:datestamp"})
+    assert obs_log.flush(timeout=5)
+    assert db.rows[row_id] == {"subject_id": "subj", "values": ["obs_1", "event:datestamp"]}
+    assert "MainThread" not in db.queries
+
+    # Writes spooled while the database is unreachable
+    db.lost = True
+    row_id_2 = obs_log.new_row("subj")
+    obs_log.fill_row(row_id_2, {"tech_obs_id": "obs_2"})
+    obs_log.stop(timeout=1)
+    with open(spool_fname) as f:
+        spool = json.load(f)
+    assert [write["op"] for write in spool] == ["fill", "delete"]
+
+    # Committed at the next start, rows reserved and not used are deleted
+    db.lost = False
+    obs_log = TechObsLogQueue(db, spool_fname, retry_interval=.05)
+    obs_log.start()
+    assert obs_log.flush(timeout=5)
+    assert obs_log.n_committed == 2
+    assert sorted(db.rows) == sorted([row_id, row_id_2])
+
+    # Local ids when no row is reserved and the database is unreachable
+    db.lost = True
+    obs_log.db_ok = False
+    row_id_3 = obs_log.new_row("subj")
+    assert row_id_3.startswith("local_")
+    obs_log.fill_row(row_id_3, {"tech_obs_id": "obs_3"})
+    obs_log.fill_row("missing", {"tech_obs_id": "obs_4"})
+    db.lost = False
+    assert obs_log.flush(timeout=5)
+    assert obs_log.stop() == 0
+    assert db.rows[row_id_3]["subject_id"] == "subj"
+    assert [write["id"] for write in obs_log.failed] == ["missing"]
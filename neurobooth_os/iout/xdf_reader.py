@@ -0,0 +1,596 @@
+# -*- coding: utf-8 -*-
+# License: BSD-3-Clause
+# Read xdf files chunk by chunk
+
+"""Read XDF files chunk by chunk without loading them in memory.
+
+An XDF file is the magic string "XDF:" followed by chunks, each made of a
+variable length size, a tag and the content. Tags are 1 FileHeader,
+2 StreamHeader, 3 Samples, 4 ClockOffset, 5 Boundary and 6 StreamFooter,
+see https://github.com/sccn/xdf/wiki/Specifications
+
+XdfIndex saves the position of the chunks of each stream next to the file,
+to read one stream or one time window without reading the whole file::
+
+    index = XdfIndex.open(fname)
+    stream_id, = index.find_streams(name="Marker")
+    marker = index.read_stream(stream_id, synchronize=True)
+"""
+
+import os
+import json
+import gzip
+import struct
+from collections import namedtuple, defaultdict
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+FILE_HEADER = 1
+STREAM_HEADER = 2
+SAMPLES = 3
+CLOCK_OFFSET = 4
+BOUNDARY = 5
+STREAM_FOOTER = 6
+
+# Chunks of a stream after its header, skipped if the stream is not selected
+_STREAM_CHUNKS = (SAMPLES, CLOCK_OFFSET, STREAM_FOOTER)
+
+# numpy dtype of the LSL channel formats, strings are read as lists of str
+CHANNEL_FORMATS = {"int8": np.dtype("<i1"),
+                   "int16": np.dtype("<i2"),
+                   "int32": np.dtype("<i4"),
+                   "int64": np.dtype("<i8"),
+                   "float32": np.dtype("<f4"),
+                   "double64": np.dtype("<f8"),
+                   "string": None}
+
+# offset is the position of the chunk in the file
+XdfChunk = namedtuple("XdfChunk", ["tag", "stream_id", "content", "offset"], defaults=(None,))
+
+
+def fit_clock_offsets(clock_offsets):
+    """Linear fit of the clock offsets of a stream, as pyxdf does.
+
+    Time stamps are synchronized with ``ts + a + b * ts``.
+
+    Parameters
+    ----------
+    clock_offsets : list of tuple
+        The (collection_time, offset) ClockOffset chunks of the stream.
+
+    Returns
+    -------
+    a, b : float
+        Intercept and slope of the offsets.
+    """
+    if not clock_offsets:
+        return 0., 0.
+    times, offsets = np.array(clock_offsets).T
+    if len(times) < 2 or np.ptp(times) == 0:
+        return float(np.mean(offsets)), 0.
+    b, a = np.polyfit(times, offsets, 1)
+    return a, b
+
+
+def _xml2dict(element):
+    # Same layout as pyxdf: every child is a list of dicts or strings
+    children = defaultdict(list)
+    for child in map(_xml2dict, list(element)):
+        for key, value in child.items():
+            children[key].append(value)
+    return {element.tag: dict(children) or element.text}
+
+
+def _parse_xml(content):
+    return _xml2dict(ET.fromstring(content.decode("utf-8")))["info"]
+
+
+def _read_varlen_int(buf, pos):
+    n_bytes = buf[pos]
+    if n_bytes == 1:
+        return buf[pos + 1], pos + 2
+    elif n_bytes == 4:
+        return struct.unpack_from("<I", buf, pos + 1)[0], pos + 5
+    elif n_bytes == 8:
+        return struct.unpack_from("<Q", buf, pos + 1)[0], pos + 9
+    raise ValueError(f"Invalid variable length integer of {n_bytes} bytes")
+
+
+class XdfStreamInfo():
+    def __init__(self, stream_id, info):
+        """Format of a stream needed to read its samples.
+
+        Parameters
+        ----------
+        stream_id : int
+            Id of the stream in the file.
+        info : dict
+            Stream header, as returned by pyxdf in stream["info"].
+        """
+        self.stream_id = stream_id
+        self.info = info
+        self.name = info["name"][0]
+        self.n_channels = int(info["channel_count"][0])
+        self.channel_format = info["channel_format"][0]
+        self.dtype = CHANNEL_FORMATS[self.channel_format]
+        self.srate = float(info["nominal_srate"][0])
+        self.tdiff = 1 / self.srate if self.srate > 0 else 0.
+        self.last_time_stamp = 0.
+
+
+class XdfReader():
+    def __init__(self, fname, select=None):
+        """Iterate over the chunks of an XDF file.
+
+        Only one chunk is held in memory at a time. Missing sample time
+        stamps are deduced from the previous one and the nominal rate, as
+        pyxdf does.
+
+        Parameters
+        ----------
+        fname : str
+            Path of the .xdf or gzip compressed .xdfz file.
+        select : callable | None
+            Called with the XdfStreamInfo of each stream header, the samples,
+            clock offsets and footer of the streams for which it returns
+            False are skipped without being parsed. None reads all streams,
+            by default None
+
+        Attributes
+        ----------
+        streams : dict
+            XdfStreamInfo of the streams whose header was read, by stream id.
+        header : dict | None
+            The file header.
+        """
+        self.fname = str(fname)
+        self.select = select
+        self.streams = {}
+        self.selected = set()
+        self.header = None
+
+    def _open(self):
+        if self.fname.endswith("z"):
+            return gzip.open(self.fname, "rb")
+        return open(self.fname, "rb")
+
+    def __iter__(self):
+        with self._open() as f:
+            if f.read(4) != b"XDF:":
+                raise IOError(f"{self.fname} is not a valid XDF file")
+            while True:
+                chunk = self._read_chunk(f)
+                if chunk is None:
+                    return
+                yield chunk
+
+    def _read_length(self, f):
+        n_bytes = f.read(1)
+        if not n_bytes:
+            return None
+        n_bytes = n_bytes[0]
+        if n_bytes not in (1, 4, 8):
+            print(f"Corrupted chunk in {self.fname}, stopping at byte {f.tell()}")
+            return None
+        return int.from_bytes(f.read(n_bytes), "little")
+
+    def sample_counts(self):
+        """Count the samples of each stream, reading only the chunk headers.
+
+        Returns
+        -------
+        counts : dict
+            Number of samples by stream id.
+        """
+        counts = defaultdict(int)
+        with self._open() as f:
+            if f.read(4) != b"XDF:":
+                raise IOError(f"{self.fname} is not a valid XDF file")
+            size = None if self.fname.endswith("z") else os.fstat(f.fileno()).st_size
+            while True:
+                length = self._read_length(f)
+                if length is None or (size is not None and f.tell() + length > size):
+                    break
+                # Tag, stream id and up to 9 bytes of sample count
+                start = f.read(min(length, 15))
+                if len(start) > 6 and struct.unpack_from("<H", start)[0] == SAMPLES:
+                    stream_id, = struct.unpack_from("<I", start, 2)
+                    counts[stream_id] += _read_varlen_int(start, 6)[0]
+                f.seek(length - len(start), 1)
+        return dict(counts)
+
+    def _read_chunk(self, f):
+        while True:
+            offset = f.tell()
+            length = self._read_length(f)
+            if length is None:
+                return None
+
+            # Skip the chunks of the streams not selected without reading them
+            start = f.read(min(length, 6))
+            if len(start) == 6 and struct.unpack_from("<H", start)[0] in _STREAM_CHUNKS:
+                stream_id, = struct.unpack_from("<I", start, 2)
+                if stream_id in self.streams and stream_id not in self.selected:
+                    f.seek(length - 6, 1)
+                    continue
+
+            content = start + f.read(length - len(start))
+            if len(content) < length:
+                print(f"{self.fname} is truncated, stopping at byte {f.tell()}")
+                return None
+            return self._parse_chunk(content)._replace(offset=offset)
+
+    def _parse_chunk(self, content):
+        tag, = struct.unpack_from("<H", content)
+        if tag == FILE_HEADER:
+            self.header = _parse_xml(content[2:])
+            return XdfChunk(tag, None, self.header)
+
+        if tag == BOUNDARY:
+            return XdfChunk(tag, None, None)
+
+        stream_id, = struct.unpack_from("<I", content, 2)
+        if tag == STREAM_HEADER:
+            info = _parse_xml(content[6:])
+            self.streams[stream_id] = XdfStreamInfo(stream_id, info)
+            if self.select is None or self.select(self.streams[stream_id]):
+                self.selected.add(stream_id)
+            return XdfChunk(tag, stream_id, info)
+        elif tag == STREAM_FOOTER:
+            return XdfChunk(tag, stream_id, _parse_xml(content[6:]))
+        elif tag == CLOCK_OFFSET:
+            collection_time, offset = struct.unpack_from("<dd", content, 6)
+            return XdfChunk(tag, stream_id, (collection_time, offset))
+        elif tag == SAMPLES:
+            stream = self.streams.get(stream_id)
+            if stream is None:
+                print(f"Samples of stream {stream_id} before its header, skipping")
+                return XdfChunk(tag, stream_id, None)
+            return XdfChunk(tag, stream_id, self._parse_samples(stream, content, 6))
+        return XdfChunk(tag, stream_id, content[6:])
+
+    def _parse_samples(self, stream, buf, pos):
+        """Parse a Samples chunk.
+
+        Returns
+        -------
+        time_stamps : ndarray, shape (n_samples,)
+            The time stamps of the samples.
+        values : ndarray, shape (n_samples, n_channels) | list of list of str
+            The samples.
+        """
+        n_samples, pos = _read_varlen_int(buf, pos)
+        n_ch = stream.n_channels
+
+        if stream.dtype is not None:
+            # Fast path, every sample has a time stamp
+            record = np.dtype([("flag", "u1"), ("ts", "<f8"), ("val", stream.dtype, (n_ch,))])
+            if len(buf) - pos == n_samples * record.itemsize:
+                samples = np.frombuffer(buf, record, n_samples, pos)
+                if (samples["flag"] == 8).all():
+                    time_stamps = samples["ts"].copy()
+                    if n_samples:
+                        stream.last_time_stamp = time_stamps[-1]
+                    return time_stamps, samples["val"].copy()
+
+        time_stamps = np.empty(n_samples)
+        if stream.dtype is not None:
+            values = np.empty((n_samples, n_ch), stream.dtype)
+            sample_size = stream.dtype.itemsize * n_ch
+        else:
+            values = []
+
+        for i in range(n_samples):
+            if buf[pos] == 8:
+                stream.last_time_stamp, = struct.unpack_from("<d", buf, pos + 1)
+                pos += 9
+            else:
+                stream.last_time_stamp += stream.tdiff
+                pos += 1
+            time_stamps[i] = stream.last_time_stamp
+
+            if stream.dtype is not None:
+                values[i] = np.frombuffer(buf, stream.dtype, n_ch, pos)
+                pos += sample_size
+            else:
+                sample = []
+                for _ in range(n_ch):
+                    length, pos = _read_varlen_int(buf, pos)
+                    sample.append(bytes(buf[pos:pos + length]).decode("utf-8"))
+                    pos += length
+                values.append(sample)
+        return time_stamps, values
+
+
+class XdfIndex():
+    def __init__(self, fname, streams, header=None, size=None, mtime=None):
+        """Position of the chunks of an XDF file, to read streams by seeking.
+
+        The index is built by reading the file once and saved next to it in
+        ``fname + ".idx.json"``::
+
+            {"version": 1, "size": ..., "mtime": ..., "header": {...},
+             "streams": {"1": {"info": {...}, "footer": {...},
+                               "header_offset": 27, "footer_offset": ...,
+                               "n_samples": 2000, "first_time_stamp": ...,
+                               "last_time_stamp": ...,
+                               "chunks": [{"offset": ..., "n_samples": 150,
+                                           "first": ..., "last": ...,
+                                           "previous": ...}],
+                               "clock_offsets": [[time, offset], ...]}}}
+
+        Time stamps are those of the file, before synchronization. previous
+        is the time stamp of the sample before the chunk, from which the
+        missing time stamps of the chunk are deduced.
+
+        Parameters
+        ----------
+        fname : str
+            Path of the xdf file.
+        streams : dict
+            Index of each stream by stream id, see the layout above.
+        header : dict | None
+            The file header, by default None
+        size : int | None
+            Size of the xdf file when it was indexed, by default None
+        mtime : float | None
+            Modification time of the xdf file when it was indexed, by
+            default None
+        """
+        self.fname = str(fname)
+        self.streams = streams
+        self.header = header
+        self.size = size
+        self.mtime = mtime
+
+    @staticmethod
+    def index_fname(fname):
+        """Path of the index of an xdf file."""
+        return str(fname) + ".idx.json"
+
+    @classmethod
+    def build(cls, fname, save=True):
+        """Read an xdf file once and index its chunks.
+
+        Parameters
+        ----------
+        fname : str
+            Path of the xdf file.
+        save : bool
+            If True, save the index next to the file, by default True
+
+        Returns
+        -------
+        index : instance of XdfIndex
+            The index.
+        """
+        stat = os.stat(fname)
+        reader = XdfReader(fname)
+        streams = {}
+        for chunk in reader:
+            if chunk.stream_id is None:
+                continue
+            if chunk.tag == STREAM_HEADER:
+                streams[chunk.stream_id] = {
+                    "info": chunk.content, "footer": None, "header_offset": chunk.offset,
+                    "footer_offset": None, "n_samples": 0, "first_time_stamp": None,
+                    "last_time_stamp": None, "chunks": [], "clock_offsets": []}
+                continue
+            stream = streams.get(chunk.stream_id)
+            if stream is None:
+                continue
+            if chunk.tag == SAMPLES and chunk.content is not None:
+                time_stamps, _ = chunk.content
+                if not len(time_stamps):
+                    continue
+                stream["chunks"].append({
+                    "offset": chunk.offset, "n_samples": len(time_stamps),
+                    "first": float(time_stamps[0]), "last": float(time_stamps[-1]),
+                    "previous": stream["last_time_stamp"] or 0.})
+                stream["n_samples"] += len(time_stamps)
+                if stream["first_time_stamp"] is None:
+                    stream["first_time_stamp"] = float(time_stamps[0])
+                stream["last_time_stamp"] = float(time_stamps[-1])
+            elif chunk.tag == CLOCK_OFFSET:
+                stream["clock_offsets"].append(list(chunk.content))
+            elif chunk.tag == STREAM_FOOTER:
+                stream["footer"] = chunk.content
+                stream["footer_offset"] = chunk.offset
+
+        index = cls(fname, streams, reader.header, stat.st_size, stat.st_mtime)
+        if save:
+            index.save()
+        return index
+
+    def save(self):
+        """Save the index next to the xdf file."""
+        index = {"version": 1, "size": self.size, "mtime": self.mtime, "header": self.header,
+                 "streams": {str(stream_id): stream for stream_id, stream in self.streams.items()}}
+        index_fname = self.index_fname(self.fname)
+        with open(index_fname + ".tmp", "w") as f:
+            json.dump(index, f)
+        os.replace(index_fname + ".tmp", index_fname)
+
+    @classmethod
+    def load(cls, fname):
+        """Load the index of an xdf file.
+
+        Parameters
+        ----------
+        fname : str
+            Path of the xdf file.
+
+        Returns
+        -------
+        index : instance of XdfIndex | None
+            The index, None if there is none or the file changed since it
+            was indexed.
+        """
+        index_fname = cls.index_fname(fname)
+        if not os.path.exists(index_fname) or not os.path.exists(fname):
+            return None
+        with open(index_fname) as f:
+            index = json.load(f)
+        stat = os.stat(fname)
+        if (index.get("version") != 1 or index["size"] != stat.st_size
+                or index["mtime"] != stat.st_mtime):
+            return None
+        streams = {int(stream_id): stream for stream_id, stream in index["streams"].items()}
+        return cls(fname, streams, index["header"], index["size"], index["mtime"])
+
+    @classmethod
+    def open(cls, fname):
+        """Load the index of an xdf file, building it if needed."""
+        index = cls.load(fname)
+        if index is None:
+            index = cls.build(fname)
+        return index
+
+    def find_streams(self, name=None, type=None):
+        """Ids of the streams with the given name and type.
+
+        Parameters
+        ----------
+        name : str | None
+            Name of the streams, None matches all names, by default None
+        type : str | None
+            Type of the streams, None matches all types, by default None
+
+        Returns
+        -------
+        stream_ids : list of int
+            The stream ids, in order of their headers.
+        """
+        stream_ids = []
+        for stream_id, stream in self.streams.items():
+            info = stream["info"]
+            if name is not None and info.get("name", [None])[0] != name:
+                continue
+            if type is not None and info.get("type", [None])[0] != type:
+                continue
+            stream_ids.append(stream_id)
+        return stream_ids
+
+    def _raw_time(self, stream_id, time, synchronize):
+        # Time stamp in the file of a synchronized time, the fit is monotonic
+        if time is None or not synchronize:
+            return time
+        a, b = fit_clock_offsets(self.streams[stream_id]["clock_offsets"])
+        return (time - a) / (1 + b)
+
+    def iter_chunks(self, stream_id, tmin=None, tmax=None):
+        """Read the chunks of a stream by seeking to them.
+
+        Parameters
+        ----------
+        stream_id : int
+            Id of the stream.
+        tmin, tmax : float | None
+            Only the Samples chunks with time stamps between tmin and tmax,
+            in the time of the file, are read. None does not bound the
+            chunks, by default None
+
+        Yields
+        ------
+        chunk : instance of XdfChunk
+            The stream header, the Samples chunks, the clock offsets and the
+            footer of the stream.
+        """
+        index = self.streams[stream_id]
+        stream = XdfStreamInfo(stream_id, index["info"])
+        yield XdfChunk(STREAM_HEADER, stream_id, index["info"], index["header_offset"])
+
+        reader = XdfReader(self.fname)
+        reader.streams[stream_id] = stream
+        reader.selected.add(stream_id)
+        chunks = [chunk for chunk in index["chunks"]
+                  if (tmin is None or chunk["last"] >= tmin)
+                  and (tmax is None or chunk["first"] <= tmax)]
+        if chunks:
+            with reader._open() as f:
+                for chunk in chunks:
+                    f.seek(chunk["offset"])
+                    stream.last_time_stamp = chunk["previous"]
+                    yield reader._read_chunk(f)
+
+        for clock_offset in index["clock_offsets"]:
+            yield XdfChunk(CLOCK_OFFSET, stream_id, tuple(clock_offset))
+        if index["footer"] is not None:
+            yield XdfChunk(STREAM_FOOTER, stream_id, index["footer"], index["footer_offset"])
+
+    def read_stream(self, stream_id, tmin=None, tmax=None, synchronize=False):
+        """Read a stream, or the samples of a stream in a time window.
+
+        Time stamps are not dejittered, split_sens_files does it.
+
+        Parameters
+        ----------
+        stream_id : int
+            Id of the stream.
+        tmin, tmax : float | None
+            Time of the first and last samples included, None reads from
+            the start or to the end of the stream, by default None
+        synchronize : bool
+            If True, time stamps are synchronized with the clock offsets of
+            the stream and tmin and tmax are synchronized times, by default
+            False
+
+        Returns
+        -------
+        stream : dict
+            "info", "footer", "time_series" and "time_stamps", as returned by
+            pyxdf.load_xdf.
+        """
+        index = self.streams[stream_id]
+        dtype = CHANNEL_FORMATS[index["info"]["channel_format"][0]]
+        n_channels = int(index["info"]["channel_count"][0])
+        a, b = fit_clock_offsets(index["clock_offsets"]) if synchronize else (0., 0.)
+
+        time_stamps, time_series = [np.zeros(0)], []
+        chunks = self.iter_chunks(stream_id, self._raw_time(stream_id, tmin, synchronize),
+                                  self._raw_time(stream_id, tmax, synchronize))
+        for chunk in chunks:
+            if chunk.tag != SAMPLES or chunk.content is None:
+                continue
+            chunk_time_stamps, values = chunk.content
+            chunk_time_stamps = chunk_time_stamps + a + b * chunk_time_stamps
+            mask = np.ones(len(chunk_time_stamps), bool)
+            if tmin is not None:
+                mask &= chunk_time_stamps >= tmin
+            if tmax is not None:
+                mask &= chunk_time_stamps <= tmax
+            time_stamps.append(chunk_time_stamps[mask])
+            if dtype is None:
+                time_series.extend(value for value, keep in zip(values, mask) if keep)
+            else:
+                time_series.append(values[mask])
+
+        if dtype is not None:
+            time_series = (np.concatenate(time_series) if time_series
+                           else np.zeros((0, n_channels), dtype))
+        return {"info": index["info"], "footer": index["footer"], "time_series": time_series,
+                "time_stamps": np.concatenate(time_stamps)}
+
+    def read_window(self, tmin, tmax, stream_ids=None, synchronize=False):
+        """Read the samples of several streams in a time window.
+
+        Parameters
+        ----------
+        tmin, tmax : float | None
+            Time of the first and last samples included, see read_stream.
+        stream_ids : list of int | None
+            Ids of the streams, None reads all the streams, by default None
+        synchronize : bool
+            If True, time stamps are synchronized, see read_stream. By
+            default False
+
+        Returns
+        -------
+        streams : list of dict
+            The streams, see read_stream.
+        """
+        if stream_ids is None:
+            stream_ids = list(self.streams)
+        return [self.read_stream(stream_id, tmin, tmax, synchronize)
+                for stream_id in stream_ids]
@@ -12,6 +12,8 @@ from pylsl import StreamInfo, StreamOutlet
 import cv2
 import time
 
+from neurobooth_os.netcomm import send_event
+
 
 class VidRec_Ximea():
     def __init__(self, fourcc=cv2.VideoWriter_fourcc(*'MJPG'),
@@ -61,7 +63,7 @@ class VidRec_Ximea():
         info.desc().append_child_value("serial_number", self.serial_num)
         info.desc().append_child_value("fps_rgb", str(self.fps))
         info.desc().append_child_value("device_model_id", self.cam.get_device_name().decode())
-        print(f"-OUTLETID-:{streamName}:{self.oulet_id}")
+        send_event("outlet_id", name=streamName, outlet_id=self.oulet_id)
         return StreamOutlet(info)
 
     def start(self, name="temp_video"):
@@ -182,7 +182,11 @@ def _main_layout(sess_info, remote=False, frame_sz=(320, 240)):
                    [sg.Text('', k="task_running", justification='left', size=(20, 1))],
                    [_space()], [_space()], [_space()], [_space()],
                    [sg.Text('Inlet streams')],
-                   [sg.Multiline(size=(35, 10), key='inlet_State', do_not_clear=False, no_scrollbar=True)]
+                   [sg.Multiline(size=(35, 10), key='inlet_State', do_not_clear=False, no_scrollbar=True)],
+                   [sg.Text('Node health')],
+                   [sg.Multiline(size=(35, 2), key='node_health', do_not_clear=False, no_scrollbar=True)],
+                   [sg.Text('Split jobs')],
+                   [sg.Multiline(size=(35, 5), key='split_jobs', do_not_clear=False, no_scrollbar=True)]
                    ]
 
     layout = [[sg.Column(layout_col1, pad=(0, 0)), sg.Column(
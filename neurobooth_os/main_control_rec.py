@@ -10,20 +10,65 @@ import os
 import socket
 import time
 import psutil
-
-import numpy as np
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 
 from neurobooth_os import config
-from neurobooth_os.netcomm import socket_message, socket_time, start_server, kill_pid_txt
+from neurobooth_os.netcomm import (socket_message, start_server, kill_pid_txt,
+                                   encode_message, collect_samples, estimate_offset)
 
 
 def _get_nodes(nodes):
     if isinstance(nodes, str):
-        nodes = (nodes)
+        nodes = (nodes,)
     return nodes
 
 
-def start_servers(nodes=("acquisition", "presentation"), remote=False, conn=None):
+def _fan_out(func, nodes, timeout=None):
+    """Run func(node) for all nodes concurrently.
+
+    Parameters
+    ----------
+    func : callable
+        Function called with the node name.
+    nodes : tuple of str
+        The node names.
+    timeout : float | None
+        Seconds each node has to finish, None waits forever, by default None
+
+    Returns
+    -------
+    results : dict
+        Return value of func for each node that succeeded.
+    errors : dict
+        Exception of each node that failed or timed out.
+    """
+    nodes = _get_nodes(nodes)
+    results, errors = {}, {}
+    if not len(nodes):
+        return results, errors
+
+    executor = ThreadPoolExecutor(max_workers=len(nodes))
+    futures = {node: executor.submit(func, node) for node in nodes}
+    # All nodes start together, they share the same deadline
+    deadline = None if timeout is None else time.monotonic() + timeout
+    for node, future in futures.items():
+        remaining = None if deadline is None else max(0, deadline - time.monotonic())
+        try:
+            results[node] = future.result(remaining)
+        except FutureTimeoutError:
+            errors[node] = TimeoutError(f"{node} did not finish within {timeout} s")
+        except Exception as e:
+            errors[node] = e
+    # Do not wait for nodes past their deadline
+    executor.shutdown(wait=False)
+
+    for node, error in errors.items():
+        print(f"{func.__name__} failed for {node}: {error!r}")
+    return results, errors
+
+
+def start_servers(nodes=("acquisition", "presentation"), remote=False, conn=None,
+                  timeout=60):
     """Start servers
 
     Parameters
@@ -34,95 +79,135 @@ def start_servers(nodes=("acquisition", "presentation"), remote=False, conn=None
         If True, start fake servers, by default False
     conn : callable, mandatory if remote True
         Connector to the database, used if remote True
+    timeout : float, optional
+        Seconds each node has to start, by default 60
+
+    Returns
+    -------
+    results : dict
+        Python PIDs started in each node, empty if remote.
+    errors : dict
+        Exception of each node that failed to start.
     """
     if remote:
         from neurobooth_os.mock import mock_server_stm, mock_server_acq
         _ = mock_server_acq(conn)
         _ = mock_server_stm(conn)
-    else:
-        kill_pid_txt()
-        nodes = _get_nodes(nodes)
-        for node in nodes:
-            start_server(node)
+        return {}, {}
 
+    kill_pid_txt()
+    return _fan_out(start_server, nodes, timeout)
 
-def prepare_feedback(nodes=("acquisition", "presentation")):
-    nodes = _get_nodes(nodes)
-    for node in nodes:
+
+def prepare_feedback(nodes=("acquisition", "presentation"), timeout=10):
+    # starts the low feed camera in ACQ and the screen mirroring in STM
+    def feedback(node):
         if node.startswith("acq"):
-            msg = "vis_stream"
+            msg_type = "vis_stream"
         elif node.startswith("pres"):
-            msg = "scr_stream"
+            msg_type = "scr_stream"
         else:
             return
-    socket_message(msg, node)
-    
+        socket_message(encode_message(msg_type), node)
 
-def prepare_devices(collection_id="mvp_025", nodes=("acquisition", "presentation")):
-    # prepares devices, collection_id can be just colletion name but also
-    # "collection_id:str(tech_obs_log)"
-    nodes = _get_nodes(nodes)
-    for node in nodes:
-        socket_message(f"prepare:{collection_id}", node)
+    return _fan_out(feedback, nodes, timeout)
+
+
+def prepare_devices(collection_id="mvp_025", nodes=("acquisition", "presentation"),
+                    tech_obs_log=None, timeout=10, snapshot_stamp=None):
+    # prepares devices, tech_obs_log is the dict of the session log used by STM,
+    # snapshot_stamp the stamp of the configuration snapshot the collection was read from
+    msg = encode_message("prepare", collection_id=collection_id, tech_obs_log=tech_obs_log,
+                         snapshot_stamp=snapshot_stamp)
 
+    def prepare(node):
+        socket_message(msg, node)
 
-def task_presentation(task_name, filename, node):
-    # task_name can be list of task1-task2-task3
-    socket_message(f"present:{task_name}:{filename}", node)
+    return _fan_out(prepare, nodes, timeout)
 
 
-def message_presentation(msg, nodes=("presentation",)):
+def task_presentation(task_names, subj_id, node):
+    # task_names is the list of tasks to present in order
+    socket_message(encode_message("present", tasks=list(task_names), subj_id=subj_id), node)
+
+
+def message_presentation(msg_type, nodes=("presentation",)):
     """Send message to presentation, either node presentation or mock_stm
 
     Parameters
     ----------
-    msg : str
-    String to send via socket connection to node
+    msg_type : str
+    Type of the message to send via socket connection to node, e.g. "pause_tasks"
     nodes : tuple, optional
         Name of the servers, by default ("presentation",)
     """
     nodes = _get_nodes(nodes)
     for node in nodes:
         if "acq" not in node:
-            socket_message(msg, node)
+            socket_message(encode_message(msg_type), node)
 
     
-def shut_all(nodes=("acquisition", "presentation")):
+def shut_all(nodes=("acquisition", "presentation"), timeout=10):
     """Shut all nodes
 
     Parameters
     ----------
     nodes : tuple | str
         The node names
+    timeout : float, optional
+        Seconds each node has to receive the message, by default 10
+
+    Returns
+    -------
+    results : dict
+        None for each node that received the message.
+    errors : dict
+        Exception of each node that failed.
     """
-    nodes = _get_nodes(nodes)
-    for node in nodes:
-        socket_message("shutdown", node)
+    def shutdown(node):
+        socket_message(encode_message("shutdown"), node)
+
+    results, errors = _fan_out(shutdown, nodes, timeout)
     kill_pid_txt()  # TODO only if error
+    return results, errors
 
 
 def test_lan_delay(n=100, nodes=("acquisition", "presentation")):
     """Test LAN delay
 
+    Probes each node n times over its persistent connection and prints the
+    round trip percentiles and clock offsets, see netcomm.clock_sync.
+
     Parameters
     ----------
     n : int
         The number of iterations
     nodes : tuple | str
         The node names
+
+    Returns
+    -------
+    times_2w : list of list
+        Round trip times of each node.
+    times_1w : list of list
+        Times from sending to the node receiving, includes the clock offset.
     """
     nodes = _get_nodes(nodes)
     times_1w, times_2w = [], []
 
     for node in nodes:
-        tmp = []
-        for i in range(n):
-            tmp.append(socket_time(node, 0))
-        times_1w.append([t[1] for t in tmp])
-        times_2w.append([t[0] for t in tmp])
-
-    _ = [print(f"{n} socket connexion time average:\n\t receive: {np.mean(times_2w[i])}\n\t send:\t  {np.mean(times_1w[i])} ")
-         for i, n in enumerate(nodes)]
+        samples = collect_samples(node, n)
+        times_1w.append([s.t1 - s.t0 for s in samples])
+        times_2w.append([s.t3 - s.t0 for s in samples])
+        if not len(samples):
+            print(f"{node}: no reply to {n} clock probes")
+            continue
+        est = estimate_offset(samples)
+        print(f"{node} {len(samples)}/{n} probes, round trip:\n"
+              f"\t p50: {est['rtt_p50'] * 1000:.3f} ms\n"
+              f"\t p99: {est['rtt_p99'] * 1000:.3f} ms\n"
+              f"\t offset: {est['offset'] * 1000:.3f} ms, "
+              f"lsl offset: {est['lsl_offset'] * 1000:.3f} ms")
 
     return times_2w, times_1w
 
@@ -141,8 +226,7 @@ def initiate_labRec():
 if 0:
     pid = start_server('acquisition')
 
-    socket_message("connect_mbient", "acquisition")
-    socket_message("shutdown", "acquisition")
+    socket_message(encode_message("shutdown"), "acquisition")
 
     t2w, t1w = test_lan_delay(100)
 
@@ -151,4 +235,4 @@ if 0:
     prepare_devices()
 
     task_name = "timing_task"
-    task_presentation(task_name, "filename")
+    task_presentation([task_name], "filename", "presentation")
@@ -16,6 +16,8 @@ import numpy as np
 import pylsl
 from pylsl import StreamInfo, StreamOutlet
 
+from neurobooth_os.netcomm import send_event
+
 
 class MockLSLDevice(object):
     """Mock Device that Streams LSL samples.
@@ -84,7 +86,7 @@ class MockLSLDevice(object):
 
     def stream_outlet_info(self):
         self.outlet = StreamOutlet(self.info, chunk_size=0, max_buffered=10)
-        print(f"-OUTLETID-:{self.name}:{self.oulet_id}")
+        send_event("outlet_id", name=self.name, outlet_id=self.oulet_id)
 
     def start(self):
         """Start mock LSL stream."""
@@ -220,7 +222,8 @@ class MockCamera(MockLSLDevice):
     def prepare(self, name="temp_video"):
         """ Creates stream with child info and sets video filename."""
         self.video_filename = "{}_flir_{}.bag".format(name, time.time())
-        print(f"-new_filename-:{self.name}:{op.split(self.video_filename)[-1]}")
+        send_event("new_filename", stream_name=self.name,
+                   filename=op.split(self.video_filename)[-1])
 
     def start(self, name="temp_video"):
         """Start camera mock LSL stream."""
@@ -12,7 +12,8 @@ import sys
 
 from neurobooth_os import config
 from neurobooth_os.iout.lsl_streamer import start_lsl_threads, close_streams, reconnect_streams
-from neurobooth_os.netcomm import socket_message, node_info, get_client_messages, get_fprint
+from neurobooth_os.netcomm import (socket_message, node_info, get_client_messages, get_fprint,
+                                   send_event, reply, reply_error, HeartbeatSender)
 from neurobooth_os.tasks.task_importer import get_task_funcs
 from neurobooth_os.iout import metadator as meta
 
@@ -31,57 +32,67 @@ def mock_acq_routine(host, port, conn):
     """
 
     streams = {}
+    heartbeat = HeartbeatSender("ACQ", target_node="dummy_ctr")
+    heartbeat.start()
     s1 = socket.socket(socket.AF_INET, socket.SOCK_STREAM)    
-    for data, connx in get_client_messages(s1, port=port, host=host):
+    for msg, connx in get_client_messages(s1, port=port, host=host):
 
-        if "prepare" in data:
-            # data = "prepare:collection_id:str(tech_obs_log_dict)"
+        if msg.type == "prepare":
+            # msg.data = {"collection_id": str, "tech_obs_log": dict, "snapshot_stamp": str}
 
-            collection_id = data.split(":")[1]
+            collection_id = msg.data["collection_id"]
+            # Read the collection once for this prepare, from the snapshot CTR
+            # listed it from if this node has it, the lookups below hit the cache
+            meta.reload_collection(collection_id, conn, msg.data.get("snapshot_stamp"))
             task_devs_kw = meta._get_coll_dev_kwarg_tasks(collection_id, conn)
             if len(streams):
                 print("Checking prepared devices")
                 streams = reconnect_streams(streams)
             else:
                 streams = start_lsl_threads("dummy_acq", collection_id, conn=conn)
+            heartbeat.set_streams(streams)
 
-            print("UPDATOR:-Connect-")
+            send_event("update_button", key="-Connect-")
 
-        elif "dev_param_update" in data:
+        elif msg.type == "dev_param_update":
             pass
 
-        elif "record_start" in data:  
-        # -> "record_start::FILENAME" FILENAME = {subj_id}_{task}
+        elif msg.type == "record_start":
+        # msg.data = {"fname": FILENAME, "task": task} FILENAME = {subj_id}_{task}
 
             print("Starting recording")
-            filename, task = data.split("::")[1:]
+            filename, task = msg.data["fname"], msg.data["task"]
             fname = config.paths['data_out'] + filename
-            for k in streams.keys():
-                if any([i in k for i in ["hiFeed", "Intel", "FLIR"]]):
-                    if task_devs_kw[task].get(k):
-                        streams[k].start(fname)
-            msg = "ACQ_devices_ready"
-            connx.send(msg.encode("ascii"))
-
-        elif "record_stop" in data:
+            try:
+                for k in streams.keys():
+                    if any([i in k for i in ["hiFeed", "Intel", "FLIR"]]):
+                        if task_devs_kw[task].get(k):
+                            streams[k].start(fname)
+            except Exception as e:
+                print(f"Starting recording failed: {e}")
+                reply_error(connx, msg, e, node="ACQ")
+                continue
+            reply(connx, msg, "devices_ready", node="ACQ")
+
+        elif msg.type == "record_stop":
             print("Closing recording")
             for k in streams.keys():
                 if any([i in k for i in ["hiFeed", "Intel", "FLIR"]]):
                     streams[k].stop()
 
-        elif data in ["close", "shutdown"]:
+        elif msg.type in ["close", "shutdown"]:
             print("Closing devices")
             streams = close_streams(streams)
+            heartbeat.set_streams(streams)
 
-            if "shutdown" in data:               
+            if msg.type == "shutdown":               
                 print("Closing RTD cam")
                 break
 
-        elif "time_test" in data:
-            msg = f"ping_{time.time()}"
-            connx.send(msg.encode("ascii"))
+        elif msg.type == "time_test":
+            reply(connx, msg, "time_reply", time=time.time())
 
         else:
-            print(data)
-
+            print(f"Unknown message: {msg}")
 
+    heartbeat.stop()
@@ -5,6 +5,7 @@ Created on Tue Sep 14 15:33:40 2021
 @author: adona
 """
 
+import os.path as op
 import time
 from time import sleep
 import socket
@@ -14,9 +15,12 @@ from datetime import datetime
 
 from neurobooth_os import config
 from neurobooth_os.iout.lsl_streamer import start_lsl_threads, close_streams, reconnect_streams
-from neurobooth_os.netcomm import socket_message, get_client_messages, get_data_timeout
+from neurobooth_os.netcomm import (socket_message, get_client_messages, get_data_timeout,
+                                   send_event, encode_message, call_async, reply,
+                                   RpcError, HeartbeatSender)
 from neurobooth_os.tasks.task_importer import get_task_funcs
 from neurobooth_os.iout import metadator as meta
+from neurobooth_os.iout.tech_obs_log_queue import TechObsLogQueue
 
 
 
@@ -34,14 +38,21 @@ def mock_stm_routine(host, port, conn):
     """
     
     streams = {}
+    heartbeat = HeartbeatSender("STM", target_node="dummy_ctr")
+    heartbeat.start()
+    obs_log = TechObsLogQueue(conn, op.join(config.paths["data_out"], "tech_obs_log_spool.json"))
+    obs_log.start()
     s1 = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    for data, connx in get_client_messages(s1, port=port, host=host):
+    for msg, connx in get_client_messages(s1, port=port, host=host):
 
-        if "prepare" in data:
-            # data = "prepare:collection_id:str(tech_obs_log_dict)"
+        if msg.type == "prepare":
+            # msg.data = {"collection_id": str, "tech_obs_log": dict, "snapshot_stamp": str}
 
-            collection_id = data.split(":")[1]
-            tech_obs_log = eval(data.replace(f"prepare:{collection_id}:", ""))
+            collection_id = msg.data["collection_id"]
+            # Read the collection once for this prepare, from the snapshot CTR
+            # listed it from if this node has it, the lookups below hit the cache
+            meta.reload_collection(collection_id, conn, msg.data.get("snapshot_stamp"))
+            tech_obs_log = msg.data["tech_obs_log"]
             study_id_date = tech_obs_log["study_id-date"]
 
             # delete subj_date as not present in DB
@@ -56,19 +67,21 @@ def mock_stm_routine(host, port, conn):
             else:
                 streams = start_lsl_threads("dummy_stm", collection_id, conn=conn)
                 print("Preparing devices")
+            heartbeat.set_streams(streams)
 
-            print("UPDATOR:-Connect-")
+            send_event("update_button", key="-Connect-")
 
-        elif "present" in data:   
-            #-> "present:TASKNAME:subj_id"
-            # task_name can be list of task1-task2-task3
-            tasks, subj_id = data.split(":")[1:]
+        elif msg.type == "present":
+            # msg.data = {"tasks": [task1, task2, ...], "subj_id": str}
+            tasks, subj_id = msg.data["tasks"], msg.data["subj_id"]
+            obs_log.reserve(subj_id, sum(task in task_func_dict and 'calibration_task' not in task
+                                         and "intro_" not in task for task in tasks))
             task_karg ={"path": config.paths['data_out'],
                         "subj_id": study_id_date,
                         "marker_outlet": streams['marker'],
                         }
             
-            for task in tasks.split("-"):                
+            for task in tasks:                
                 if task not in task_func_dict.keys():
                     print(f"Task {task} not implemented")
                     continue
@@ -84,58 +97,64 @@ def mock_stm_routine(host, port, conn):
                       continue                    
                 
                 t_obs_id = task_func_dict[task]['t_obs_id']
-                tech_obs_log_id = meta._make_new_tech_obs_row(conn, subj_id)
+                tech_obs_log_id = obs_log.new_row(subj_id)
                 tech_obs_log["date_times"] = '{'+ datetime.now().strftime("%Y-%m-%d %H:%M:%S") + '}'
                 tsk_strt_time = datetime.now().strftime("%Hh-%Mm-%Ss")
 
                 # Signal CTR to start LSL rec
-                print(f"Initiating task:{task}:{t_obs_id}:{tech_obs_log_id}:{tsk_strt_time}")
+                send_event("task_initiated", task_id=task, t_obs_id=t_obs_id,
+                           tech_obs_log_id=tech_obs_log_id, tsk_strt_time=tsk_strt_time)
                 sleep(1)
 
                  # Start/Stop rec in ACQ and run task
-                resp = socket_message(f"record_start::{config.paths['data_out']}{study_id_date}_{tsk_strt_time}_{task}::{task}",
-                                     "dummy_acq", wait_data=3)
-                print(resp)
+                rec_fname = f"{config.paths['data_out']}{study_id_date}_{tsk_strt_time}_{task}"
+                acq_rec = call_async("dummy_acq", "record_start", fname=rec_fname, task=task)
+                try:
+                    resp = acq_rec.result(timeout=3)
+                    print(f"{resp.node}: {resp.type}")
+                except RpcError as e:
+                    print(f"ACQ recording not confirmed: {e}")
                 sleep(.5)
                 events = None
                 res = tsk_fun(**this_task_kwargs)
                 if hasattr(res, 'run'):  events = res.run(**this_task_kwargs)
-                socket_message("record_stop", "dummy_acq")
+                socket_message(encode_message("record_stop"), "dummy_acq")
 
-                print(f"Finished task:{task}")
+                send_event("task_finished", task_id=task)
                 
                 # Log tech_obs to database
                 tech_obs_log["tech_obs_id"] = t_obs_id
                 tech_obs_log['event_array'] = str(events) if events is not None else "event:datestamp"
-                meta._fill_tech_obs_row(tech_obs_log_id, tech_obs_log, conn)
+                obs_log.fill_row(tech_obs_log_id, tech_obs_log)
                 
                 # Check if pause requested, unpause or stop
-                data = get_data_timeout(s1, .1)
-                if data == "pause tasks":
+                msg = get_data_timeout(s1, .1)
+                if msg is not None and msg.type == "pause_tasks":
                     print("Session Paused")
                     
-                    conn, _ = s1.accept()
-                    data = conn.recv(1024)
-                    data = data.decode("utf-8")
+                    msg = get_data_timeout(s1, None)
                     
-                    if data == "unpause tasks":
+                    if msg.type == "unpause_tasks":
                         continue                    
-                    elif data == "stop tasks":
+                    elif msg.type == "stop_tasks":
                         break
                     else:
                         print("While paused received another message")
 
-        elif data in ["close", "shutdown"]:
+        elif msg.type in ["close", "shutdown"]:
             streams = close_streams(streams)
+            heartbeat.set_streams(streams)
             print("Closing devices")
 
-            if "shutdown" in data:                
+            if msg.type == "shutdown":                
                 print("Closing Stim server")
                 break
 
-        elif "time_test" in data:
-            msg = f"ping_{time.time()}"
-            connx.send(msg.encode("ascii"))
+        elif msg.type == "time_test":
+            reply(connx, msg, "time_reply", time=time.time())
 
         else:
-            print(data)
+            print(f"Unknown message: {msg}")
+
+    obs_log.stop(timeout=10)
+    heartbeat.stop()
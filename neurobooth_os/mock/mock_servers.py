@@ -31,7 +31,7 @@ def mock_server_ctr(callback, callback_args):
     
     host, port = node_info("dummy_ctr")
     server_thread = threading.Thread(target=get_messages_to_ctr,
-                                     args=(callback, host, port, callback_args,),
+                                     args=(callback, True, host, port, callback_args,),
                                      daemon=True)
     server_thread.start()
     return server_thread
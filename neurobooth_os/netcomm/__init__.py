@@ -1,3 +1,9 @@
+from .protocol import encode_message, decode_message, Message, ProtocolError
 from .client import start_server, kill_pid_txt, socket_time, node_info, socket_message
-from .server import get_client_messages, get_fprint, get_messages_to_ctr, NewStdout, get_data_timeout
-
+from .server import (get_client_messages, get_fprint, get_messages_to_ctr, NewStdout,
+                     get_data_timeout, send_event)
+from .clock_sync import ClockSync, probe_clock, collect_samples, estimate_offset
+from .rpc import (call, call_async, reply, reply_error, RpcError, RpcTimeout, RemoteError,
+                  ConnectionLost)
+from .heartbeat import HeartbeatSender, HealthMonitor
+from .dispatch import MessageDispatcher
@@ -0,0 +1,231 @@
+"""Throughput and latency benchmarks of netcomm on the loopback dummy nodes.
+
+Messages are sent to a mock CTR server on the dummy_ctr port and requests
+to a mock ACQ server on the dummy_acq port. Run with::
+
+    python -m neurobooth_os.netcomm.benchmark --out netcomm_bench.json
+
+and compare to a previous run with ``--baseline netcomm_bench.json``.
+CPU is the time of the whole process, which runs both the clients and the
+servers of the benchmark.
+"""
+
+import sys
+import json
+import time
+import platform
+import argparse
+import threading
+from datetime import datetime
+
+import numpy as np
+
+from neurobooth_os.netcomm import socket_message, NewStdout, encode_message, node_info, call
+from neurobooth_os.netcomm.pool import NodeConnection
+from neurobooth_os.mock import mock_server_ctr, mock_server_acq
+
+
+class _Collector():
+    def __init__(self):
+        """Count messages received by the mock CTR and their latencies."""
+        self.latencies = []
+        self.n_expected = 0
+        self.done = threading.Event()
+
+    def reset(self, n_expected):
+        self.latencies = []
+        self.n_expected = n_expected
+        self.done.clear()
+
+    def callback(self, msg, _):
+        if msg.type == "log":
+            # Benchmark messages end with their perf_counter send time
+            sent = float(msg.data["text"].rsplit(" ", 1)[-1])
+            self.latencies.append(time.perf_counter() - sent)
+            if len(self.latencies) >= self.n_expected:
+                self.done.set()
+
+
+def _summary(n_messages, elapsed, cpu, latencies):
+    lat = np.asarray(latencies) * 1000
+    return {"n_messages": n_messages,
+            "elapsed_s": round(elapsed, 4),
+            "msgs_per_sec": round(n_messages / elapsed, 1),
+            "latency_p50_ms": round(float(np.percentile(lat, 50)), 4) if len(lat) else None,
+            "latency_p99_ms": round(float(np.percentile(lat, 99)), 4) if len(lat) else None,
+            "cpu_percent": round(100 * cpu / elapsed, 1)}
+
+
+def _run(send, collector, n_messages, timeout=60):
+    collector.reset(n_messages)
+    t0, cpu0 = time.perf_counter(), time.process_time()
+    send()
+    if not collector.done.wait(timeout):
+        raise RuntimeError(f"Received {len(collector.latencies)} of {n_messages} messages")
+    elapsed, cpu = time.perf_counter() - t0, time.process_time() - cpu0
+    return _summary(len(collector.latencies), elapsed, cpu, collector.latencies)
+
+
+def bench_socket_message(collector, n_messages):
+    """Messages sent one by one with socket_message to dummy_ctr."""
+    def send():
+        for i in range(n_messages):
+            socket_message(encode_message("log", node="bench", text=f"{i} {time.perf_counter()!r}"),
+                           "dummy_ctr")
+    return _run(send, collector, n_messages)
+
+
+def bench_stdout_burst(collector, n_messages):
+    """Burst of prints shipped in batches by a background NewStdout."""
+    stdout = NewStdout("bench", target_node="dummy_ctr", background=True)
+
+    def send():
+        for i in range(n_messages):
+            stdout.write(f"{i} {time.perf_counter()!r}")
+        stdout.flush()
+
+    try:
+        result = _run(send, collector, n_messages)
+    finally:
+        stdout.close()
+    result["dropped"] = stdout.shipper.stats()["dropped"]
+    return result
+
+
+def bench_ctr_callbacks(collector, n_messages, n_clients=4, batch_size=100):
+    """Concurrent clients flooding get_messages_to_ctr, measures callbacks/sec."""
+    host, port = node_info("dummy_ctr")
+    per_client = n_messages // n_clients
+
+    def client():
+        connection = NodeConnection(host, port)
+        for start in range(0, per_client, batch_size):
+            stop = min(start + batch_size, per_client)
+            connection.send_many([encode_message("log", node="bench",
+                                                 text=f"{i} {time.perf_counter()!r}")
+                                  for i in range(start, stop)])
+        connection.close()
+
+    def send():
+        threads = [threading.Thread(target=client) for _ in range(n_clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    result = _run(send, collector, per_client * n_clients)
+    result["n_clients"] = n_clients
+    return result
+
+
+def bench_rpc(n_messages):
+    """Round trips of time_test requests answered by the mock ACQ."""
+    latencies = []
+    t0, cpu0 = time.perf_counter(), time.process_time()
+    for _ in range(n_messages):
+        t_send = time.perf_counter()
+        call("dummy_acq", "time_test", timeout=2)
+        latencies.append(time.perf_counter() - t_send)
+    elapsed, cpu = time.perf_counter() - t0, time.process_time() - cpu0
+    return _summary(n_messages, elapsed, cpu, latencies)
+
+
+def run_benchmarks(n_messages=20000, n_requests=2000):
+    """Run all benchmarks against mock servers on the dummy ports.
+
+    Parameters
+    ----------
+    n_messages : int
+        Number of messages of the one-way benchmarks, by default 20000
+    n_requests : int
+        Number of requests of the round trip benchmark, by default 2000
+
+    Returns
+    -------
+    report : dict
+        "meta" with the run settings and "results" with msgs_per_sec,
+        latency_p50_ms, latency_p99_ms and cpu_percent of each benchmark.
+    """
+    collector = _Collector()
+    ctr_thread = mock_server_ctr(collector.callback, None)
+    acq_thread = mock_server_acq(None)
+    time.sleep(.5)
+
+    results = {}
+    try:
+        results["socket_message"] = bench_socket_message(collector, n_messages)
+        results["stdout_burst"] = bench_stdout_burst(collector, n_messages)
+        results["ctr_callbacks"] = bench_ctr_callbacks(collector, n_messages)
+        results["rpc_round_trip"] = bench_rpc(n_requests)
+    finally:
+        socket_message(encode_message("close"), "dummy_ctr")
+        socket_message(encode_message("shutdown"), "dummy_acq")
+        ctr_thread.join(2)
+        acq_thread.join(2)
+
+    meta = {"date": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "n_messages": n_messages,
+            "n_requests": n_requests}
+    return {"meta": meta, "results": results}
+
+
+def compare(report, baseline, tolerance=.2):
+    """Find benchmarks slower than in a baseline report.
+
+    Parameters
+    ----------
+    report : dict
+        Report of run_benchmarks.
+    baseline : dict
+        Previous report of run_benchmarks.
+    tolerance : float
+        Relative change allowed before a regression is reported, by default .2
+
+    Returns
+    -------
+    regressions : list of str
+        Description of each regression.
+    """
+    regressions = []
+    for name, res in report["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            continue
+        if res["msgs_per_sec"] < base["msgs_per_sec"] * (1 - tolerance):
+            regressions.append(f"{name}: {res['msgs_per_sec']} msgs/sec, "
+                               f"baseline {base['msgs_per_sec']}")
+        if base["latency_p50_ms"] and res["latency_p50_ms"] > base["latency_p50_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p50 {res['latency_p50_ms']} ms, "
+                               f"baseline {base['latency_p50_ms']}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--n-messages", type=int, default=20000)
+    parser.add_argument("--n-requests", type=int, default=2000)
+    parser.add_argument("--out", help="Path of the json report")
+    parser.add_argument("--baseline", help="Report of a previous run to compare to")
+    parser.add_argument("--tolerance", type=float, default=.2)
+    args = parser.parse_args(argv)
+
+    report = run_benchmarks(args.n_messages, args.n_requests)
+    print(json.dumps(report, indent=1))
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"Regression {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
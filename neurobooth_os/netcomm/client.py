@@ -1,18 +1,38 @@
-# Import socket module
-import socket
-import select
 from time import time, sleep
 import re
 import os
+import threading
 import pandas as pd
 from io import StringIO
 
 from neurobooth_os.secrets_info import secrets
+from neurobooth_os.netcomm.pool import ConnectionPool
 
+_pool = None
+# start_server runs concurrently for several nodes, guards server_pids.txt
+_pid_file_lock = threading.Lock()
 
-def socket_message(message, node_name, wait_data=False):
+
+def get_pool():
+    """Get the connection pool shared by all messages sent from this process.
+
+    Returns
+    -------
+    pool : instance of ConnectionPool
+        Pool with one persistent connection per node.
+    """
+    global _pool
+    if _pool is None:
+        _pool = ConnectionPool(node_info)
+    return _pool
+
+
+def socket_message(message, node_name, wait_data=False, timeout=None):
     """ Send a string message though socket connection to `node_name`.
 
+    The message is framed and sent through a persistent connection of the
+    pool, the connection is reopened if the server closed it.
+
     Parameters
     ----------
     message : str
@@ -20,28 +40,26 @@ def socket_message(message, node_name, wait_data=False):
     node_name : str
         The node to send the socket message to
     wait_data : bool
-        If True, wait for the data.
+        If True, wait for the data. Requests expecting a reply should use
+        netcomm.rpc, which correlates replies and raises typed errors.
+    timeout : float | None
+        Seconds to wait for the data, None waits forever. Default None
 
     Returns
     -------
-    data : str
-        Returns the data from the node_name.
+    data : str | None
+        Returns the data from the node_name, None if not waited or timed out.
     """
-    def connect():
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-        # connect to server on local computer
-        s.connect((host, port))
-        s.send(message.encode('ascii'))
+    connection = get_pool().get(node_name)
 
-        data = None
-        if wait_data:
-            data = wait_socket_data(s)
-
-        s.close()
-        return data
-
-    host, port = node_info(node_name)
+    def connect():
+        data = connection.send(message, wait_reply=bool(wait_data), timeout=timeout)
+        if not wait_data:
+            return None
+        if data is None:
+            print("Socket timed out")
+            return None
+        return data.decode("utf-8")
 
     try:
         data = connect()
@@ -71,31 +89,17 @@ def socket_time(node_name, print_flag=1, time_out=3):
         taken time to server and time to server and back
     """
 
-    host, port = node_info(node_name)
+    from neurobooth_os.netcomm.rpc import call, RpcError
 
-    message = "time_test"
     t0 = time()
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.settimeout(time_out)
-
     try:
-        # connect to server on local computer
-        s.connect((host, port))
-    except BaseException:
-        print(f"{node_name} socket connexion timed out, trying to restart server")
-        start_server(node_name)
-        t0 = time()
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.settimeout(time_out * 2)
-        s.connect((host, port))
-
-    s.send(message.encode('ascii'))
-    # message received from server
-    data = wait_socket_data(s, 2)
-    s.close()
+        reply = call(node_name, "time_test", timeout=time_out)
+        time_send = reply.data["time"]
+    except RpcError as e:
+        print(e)
+        time_send = -999
 
     t1 = time()
-    time_send = float(data.split("_")[-1])
     time_1way = time_send - t0
     time_2way = t1 - t0
 
@@ -139,21 +143,6 @@ def node_info(node_name):
     return host, port
 
 
-def wait_socket_data(s, wait_time=None):
-
-    tic = time()
-    while True:
-        r, _, _ = select.select([s], [], [s], 1)
-        if r:
-            data = s.recv(1024)
-            return data.decode("utf-8")
-
-        if wait_time is not None:
-            if time() - tic > wait_time:
-                print("Socket timed out")
-                return "TIMED-OUT_-999"
-
-
 def start_server(node_name, save_pid_txt=True):
     """ Makes a network call to run script serv_{node_name}.bat
 
@@ -220,8 +209,9 @@ def start_server(node_name, save_pid_txt=True):
     print(f"{node_name.upper()} server initiated with pid {pid}")
 
     if save_pid_txt:
-        with open("server_pids.txt", "a") as f:
-            f.write(f"{pid}|{node_name}|{time()}\n")
+        with _pid_file_lock:
+            with open("server_pids.txt", "a") as f:
+                f.write(f"{pid}|{node_name}|{time()}\n")
     return pid
 
 
@@ -259,26 +249,30 @@ def kill_remote_pid(pids, node_name):
 
 def kill_pid_txt(txt_name="server_pids.txt", node_name=None):
 
-    if not os.path.exists(txt_name):
-        return
-
-    with open(txt_name, "r+") as f:
-        Lines = f.readlines()
-
-        if len(Lines):
-            print(f"Closing {len(Lines)} remote processes")
-
-        new_lines = []
-        for line in Lines:
-            pid, node, tsmp = line.split("|")
-            if node_name is not None and node_name != node:
-                new_lines.append(line)
-                continue
-            kill_remote_pid(eval(pid), node)
-
-        f.seek(0)
-        if len(new_lines):
-            f.writelines(new_lines)
-        else:
-            f.write("")
-        f.truncate()
+    with _pid_file_lock:
+        if not os.path.exists(txt_name):
+            return
+
+        with open(txt_name, "r+") as f:
+            Lines = f.readlines()
+
+            if len(Lines):
+                print(f"Closing {len(Lines)} remote processes")
+
+            new_lines, to_kill = [], []
+            for line in Lines:
+                pid, node, tsmp = line.split("|")
+                if node_name is not None and node_name != node:
+                    new_lines.append(line)
+                    continue
+                to_kill.append((pid, node))
+
+            f.seek(0)
+            if len(new_lines):
+                f.writelines(new_lines)
+            else:
+                f.write("")
+            f.truncate()
+
+    for pid, node in to_kill:
+        kill_remote_pid(eval(pid), node)
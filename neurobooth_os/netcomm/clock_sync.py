@@ -0,0 +1,305 @@
+"""NTP-style clock synchronization between CTR and the STM and ACQ nodes.
+
+Each probe records four timestamps: t0 when CTR sends it, t1 when the node
+receives it, t2 when the node replies and t3 when CTR receives the reply.
+They are taken with both time.time and pylsl.local_clock. The offset of
+the node clock relative to CTR and the network round trip are::
+
+    offset = ((t1 - t0) + (t2 - t3)) / 2
+    rtt = (t3 - t0) - (t2 - t1)
+
+Probes with the smallest round trip are the least affected by queuing
+delays, offsets are estimated from those only. A node timestamp is
+converted to CTR time with ``t_ctr = t_node - offset``.
+"""
+
+import json
+import threading
+from time import time, sleep
+from collections import namedtuple
+
+import numpy as np
+from pylsl import local_clock
+
+from neurobooth_os.netcomm.client import get_pool
+from neurobooth_os.netcomm.protocol import encode_message, decode_message, PROTOCOL_VERSION
+
+# Start of encoded clock_probe messages, answered by NodeServer without queuing
+PROBE_PREFIX = f'{{"v":{PROTOCOL_VERSION},"type":"clock_probe",'.encode("utf-8")
+
+ClockSample = namedtuple("ClockSample", ["t0", "t1", "t2", "t3",
+                                         "lsl_t0", "lsl_t1", "lsl_t2", "lsl_t3"])
+
+
+def answer_probe(payload):
+    """Reply to a clock probe with the node receive and send times.
+
+    Parameters
+    ----------
+    payload : bytes
+        The received clock_probe message.
+
+    Returns
+    -------
+    reply : str
+        The encoded clock_reply message.
+    """
+    t1, lsl_t1 = time(), local_clock()
+    probe = decode_message(payload)
+    return encode_message("clock_reply", seq=probe.data.get("seq"), t1=t1, lsl_t1=lsl_t1,
+                          t2=time(), lsl_t2=local_clock())
+
+
+def probe_clock(node_name, seq=0, timeout=1):
+    """Send one timestamped probe to node_name.
+
+    Parameters
+    ----------
+    node_name : str
+        The node to probe.
+    seq : int
+        Sequence number matched against the reply, by default 0
+    timeout : float
+        Seconds to wait for the reply, by default 1
+
+    Returns
+    -------
+    sample : instance of ClockSample | None
+        The timestamps of the probe, None if the reply was lost.
+    """
+    connection = get_pool().get(node_name)
+    probe = encode_message("clock_probe", seq=seq)
+
+    lsl_t0, t0 = local_clock(), time()
+    reply = connection.send(probe, wait_reply=True, timeout=timeout)
+    t3, lsl_t3 = time(), local_clock()
+
+    if reply is None:
+        return None
+    data = decode_message(reply).data
+    if data.get("seq") != seq:
+        return None
+    return ClockSample(t0, data["t1"], data["t2"], t3,
+                       lsl_t0, data["lsl_t1"], data["lsl_t2"], lsl_t3)
+
+
+def collect_samples(node_name, n_probes=50, interval=.005, timeout=1):
+    """Probe node_name several times.
+
+    Parameters
+    ----------
+    node_name : str
+        The node to probe.
+    n_probes : int
+        Number of probes, by default 50
+    interval : float
+        Seconds between probes, by default .005
+    timeout : float
+        Seconds to wait for each reply, by default 1
+
+    Returns
+    -------
+    samples : list of ClockSample
+        The probes that got a reply.
+    """
+    samples = []
+    for seq in range(n_probes):
+        sample = probe_clock(node_name, seq, timeout)
+        if sample is not None:
+            samples.append(sample)
+        sleep(interval)
+    return samples
+
+
+def estimate_offset(samples, keep=.25):
+    """Estimate the clock offsets from the probes with the smallest round trip.
+
+    Parameters
+    ----------
+    samples : list of ClockSample
+        The probes of one node.
+    keep : float
+        Fraction of the probes with the smallest round trip used to estimate
+        the offsets, by default .25
+
+    Returns
+    -------
+    estimate : dict
+        Offsets of time.time ("offset") and pylsl.local_clock ("lsl_offset")
+        in seconds, round trip percentiles "rtt_min", "rtt_p50" and "rtt_p99",
+        the number of probes "n_probes" and the CTR times "time" and
+        "lsl_time" of the estimate.
+    """
+    if not len(samples):
+        raise ValueError("No clock samples to estimate the offset from")
+
+    s = np.array(samples, dtype=float)
+    t0, t1, t2, t3 = s[:, 0], s[:, 1], s[:, 2], s[:, 3]
+    lsl_t0, lsl_t1, lsl_t2, lsl_t3 = s[:, 4], s[:, 5], s[:, 6], s[:, 7]
+
+    rtt = (t3 - t0) - (t2 - t1)
+    offsets = ((t1 - t0) + (t2 - t3)) / 2
+    lsl_offsets = ((lsl_t1 - lsl_t0) + (lsl_t2 - lsl_t3)) / 2
+
+    n_keep = max(1, int(round(len(samples) * keep)))
+    best = np.argsort(rtt)[:n_keep]
+
+    return {"time": float(np.median(t0[best])),
+            "lsl_time": float(np.median(lsl_t0[best])),
+            "offset": float(np.median(offsets[best])),
+            "lsl_offset": float(np.median(lsl_offsets[best])),
+            "rtt_min": float(rtt.min()),
+            "rtt_p50": float(np.percentile(rtt, 50)),
+            "rtt_p99": float(np.percentile(rtt, 99)),
+            "n_probes": len(samples)}
+
+
+def estimate_drift(series, clock="time"):
+    """Estimate the drift of a node clock from its offset series.
+
+    Parameters
+    ----------
+    series : list of dict
+        Estimates returned by estimate_offset over the session.
+    clock : str
+        "time" for time.time or "lsl_time" for pylsl.local_clock, by default "time"
+
+    Returns
+    -------
+    drift : float | None
+        Change of the offset in seconds per second, None with less than two
+        estimates.
+    """
+    if len(series) < 2:
+        return None
+    key = "offset" if clock == "time" else "lsl_offset"
+    times = np.array([est[clock] for est in series])
+    offsets = np.array([est[key] for est in series])
+    if np.ptp(times) == 0:
+        return None
+    slope, _ = np.polyfit(times - times[0], offsets, 1)
+    return float(slope)
+
+
+class ClockSync():
+    def __init__(self, nodes, n_probes=50, probe_interval=.005, keep=.25):
+        """Track the clock offsets of the nodes during a session.
+
+        Parameters
+        ----------
+        nodes : list of str
+            The nodes to synchronize with.
+        n_probes : int
+            Number of probes per measurement, by default 50
+        probe_interval : float
+            Seconds between probes, by default .005
+        keep : float
+            Fraction of the probes with the smallest round trip used to
+            estimate the offsets, by default .25
+        """
+        self.nodes = list(nodes)
+        self.n_probes = n_probes
+        self.probe_interval = probe_interval
+        self.keep = keep
+        self.series = {node: [] for node in self.nodes}
+        self.lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def measure(self, node_name):
+        """Measure and store the clock offset of node_name.
+
+        Parameters
+        ----------
+        node_name : str
+            The node to measure.
+
+        Returns
+        -------
+        estimate : dict | None
+            See estimate_offset, None if no probe got a reply.
+        """
+        samples = collect_samples(node_name, self.n_probes, self.probe_interval)
+        if not len(samples):
+            print(f"Clock sync: no reply from {node_name}")
+            return None
+        estimate = estimate_offset(samples, self.keep)
+        with self.lock:
+            self.series.setdefault(node_name, []).append(estimate)
+        return estimate
+
+    def measure_all(self):
+        """Measure the clock offset of all nodes.
+
+        Returns
+        -------
+        estimates : dict
+            Estimate of each node, None for nodes that did not reply.
+        """
+        estimates = {}
+        for node in self.nodes:
+            try:
+                estimates[node] = self.measure(node)
+            except OSError as e:
+                print(f"Clock sync with {node} failed: {e}")
+                estimates[node] = None
+        return estimates
+
+    def drift(self, node_name, clock="time"):
+        """Drift of node_name in seconds per second, see estimate_drift."""
+        with self.lock:
+            return estimate_drift(list(self.series[node_name]), clock)
+
+    def start(self, interval=60):
+        """Measure all nodes now and every interval seconds in a background thread.
+
+        Parameters
+        ----------
+        interval : float
+            Seconds between measurements, by default 60
+        """
+        if self._thread is not None:
+            return
+        self._stop_event.clear()
+
+        def run():
+            while not self._stop_event.is_set():
+                self.measure_all()
+                self._stop_event.wait(interval)
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background measurements."""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def summary(self):
+        """Offset series and drifts of all nodes.
+
+        Returns
+        -------
+        summary : dict
+            For each node, its "series" of estimates and its "drift" and
+            "lsl_drift" in seconds per second.
+        """
+        with self.lock:
+            series = {node: list(ests) for node, ests in self.series.items()}
+        return {node: {"series": ests,
+                       "drift": estimate_drift(ests, "time"),
+                       "lsl_drift": estimate_drift(ests, "lsl_time")}
+                for node, ests in series.items()}
+
+    def save(self, fname):
+        """Save the offset series of the session to a json file.
+
+        Parameters
+        ----------
+        fname : str
+            Path of the json file.
+        """
+        with open(fname, "w") as f:
+            json.dump(self.summary(), f, indent=1)
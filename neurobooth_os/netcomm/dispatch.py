@@ -0,0 +1,98 @@
+"""Dispatch received messages to handlers registered by message type."""
+
+import threading
+from time import perf_counter
+from collections import defaultdict
+
+
+class MessageDispatcher():
+    def __init__(self, default=None):
+        """Call the handler registered for the type of each message.
+
+        Counts the messages handled per type and the time spent in their
+        handler.
+
+        Parameters
+        ----------
+        default : callable | None
+            Handler of the messages without registered handler, None ignores
+            them, by default None
+        """
+        self.handlers = {}
+        self.default = default
+        self.counts = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.time_spent = defaultdict(float)
+        self.max_time = defaultdict(float)
+        self.lock = threading.Lock()
+
+    def register(self, msg_type, handler=None):
+        """Register the handler of msg_type, usable as a decorator.
+
+        Parameters
+        ----------
+        msg_type : str
+            Type of the messages, e.g. "task_initiated".
+        handler : callable | None
+            Function called with the message and the dispatch args. If None,
+            returns a decorator registering the decorated function.
+
+        Returns
+        -------
+        handler : callable
+            The registered handler, or the decorator if handler is None.
+        """
+        if handler is None:
+            return lambda func: self.register(msg_type, func)
+        self.handlers[msg_type] = handler
+        return handler
+
+    def dispatch(self, msg, *args):
+        """Call the handler of msg, errors are printed and counted.
+
+        Parameters
+        ----------
+        msg : instance of Message
+            The received message.
+        *args : list
+            Extra arguments passed to the handler.
+        """
+        handler = self.handlers.get(msg.type, self.default)
+        if handler is None:
+            with self.lock:
+                self.counts[msg.type] += 1
+            return
+
+        t0 = perf_counter()
+        failed = False
+        try:
+            handler(msg, *args)
+        except Exception as e:
+            failed = True
+            print(f"Handler of {msg.type} from {msg.node} failed: {e!r}")
+        elapsed = perf_counter() - t0
+
+        with self.lock:
+            self.counts[msg.type] += 1
+            self.errors[msg.type] += failed
+            self.time_spent[msg.type] += elapsed
+            self.max_time[msg.type] = max(self.max_time[msg.type], elapsed)
+
+    __call__ = dispatch
+
+    def stats(self):
+        """Counters of the handled messages.
+
+        Returns
+        -------
+        stats : dict
+            For each message type, the number of messages "count", of handler
+            "errors", and the "total_ms", "mean_ms" and "max_ms" handler times.
+        """
+        with self.lock:
+            return {msg_type: {"count": count,
+                               "errors": self.errors[msg_type],
+                               "total_ms": self.time_spent[msg_type] * 1000,
+                               "mean_ms": self.time_spent[msg_type] * 1000 / count,
+                               "max_ms": self.max_time[msg_type] * 1000}
+                    for msg_type, count in self.counts.items()}
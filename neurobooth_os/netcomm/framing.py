@@ -0,0 +1,74 @@
+"""Length-prefixed framing of socket messages."""
+
+import struct
+
+# Each frame is a 4-byte big-endian payload length followed by the payload
+HEADER = struct.Struct("!I")
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+
+def pack_frame(payload):
+    """Prefix payload with its length.
+
+    Parameters
+    ----------
+    payload : bytes | str
+        The message to frame, str is utf-8 encoded.
+
+    Returns
+    -------
+    frame : bytes
+        Header and payload ready to be sent.
+    """
+    if isinstance(payload, str):
+        payload = payload.encode("utf-8")
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame of {len(payload)} bytes exceeds {MAX_FRAME_SIZE}")
+    return HEADER.pack(len(payload)) + payload
+
+
+def send_frame(sock, payload):
+    """Send one framed message through a connected socket.
+
+    Parameters
+    ----------
+    sock : instance of socket.socket
+        Connected socket.
+    payload : bytes | str
+        The message to send.
+    """
+    sock.sendall(pack_frame(payload))
+
+
+def _recv_exactly(sock, n_bytes):
+    buf = bytearray()
+    while len(buf) < n_bytes:
+        chunk = sock.recv(n_bytes - len(buf))
+        if not chunk:
+            return None
+        buf.extend(chunk)
+    return bytes(buf)
+
+
+def recv_frame(sock):
+    """Receive one framed message from a connected socket.
+
+    Parameters
+    ----------
+    sock : instance of socket.socket
+        Connected socket.
+
+    Returns
+    -------
+    payload : bytes | None
+        The message, None if the peer closed the connection.
+    """
+    header = _recv_exactly(sock, HEADER.size)
+    if header is None:
+        return None
+    size, = HEADER.unpack(header)
+    if size > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame of {size} bytes exceeds {MAX_FRAME_SIZE}")
+    if size == 0:
+        return b""
+    return _recv_exactly(sock, size)
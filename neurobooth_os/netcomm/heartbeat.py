@@ -0,0 +1,183 @@
+"""Liveness and load beats sent by STM and ACQ and tracked by CTR.
+
+Nodes send a heartbeat message every interval::
+
+    {"type": "heartbeat", "node": "STM",
+     "data": {"seq": 12, "time": ..., "cpu_percent": 12.5,
+              "mem_percent": 40.1, "rss_mb": 250.3, "streams": ["Eyelink", "marker"]}}
+
+CTR marks a node unhealthy when no beat arrived within the window.
+"""
+
+import threading
+from time import time, monotonic
+
+import psutil
+
+from neurobooth_os.netcomm.client import get_pool
+from neurobooth_os.netcomm.protocol import encode_message
+
+
+class HeartbeatSender():
+    def __init__(self, current_node, target_node="control", interval=1.):
+        """Send periodic heartbeats from a background thread.
+
+        Parameters
+        ----------
+        current_node : str
+            Name of the node sending the beats, e.g. STM or ACQ
+        target_node : str
+            PC node name receiving the beats, by default "control"
+        interval : float
+            Seconds between beats, by default 1.
+        """
+        self.current_node = current_node
+        self.target_node = target_node
+        self.interval = interval
+        self.streams = []
+        self.seq = 0
+        self.process = psutil.Process()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def set_streams(self, streams):
+        """Set the names of the active streams reported in the beats."""
+        self.streams = list(streams)
+
+    def beat(self):
+        """Encode the current load of the node.
+
+        Returns
+        -------
+        payload : str
+            The encoded heartbeat message.
+        """
+        self.seq += 1
+        return encode_message("heartbeat", node=self.current_node, seq=self.seq, time=time(),
+                              cpu_percent=psutil.cpu_percent(),
+                              mem_percent=psutil.virtual_memory().percent,
+                              rss_mb=self.process.memory_info().rss / 1e6,
+                              streams=self.streams)
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                # Not socket_message, a missing CTR must not restart servers nor print
+                get_pool().get(self.target_node).send(self.beat())
+            except Exception:
+                # CTR is down, it notices the missing beats once back
+                pass
+            self._stop_event.wait(self.interval)
+
+    def start(self):
+        """Start sending beats."""
+        if self._thread is not None:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop sending beats."""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+class HealthMonitor():
+    def __init__(self, nodes, window=3., on_change=None):
+        """Track the heartbeats of the nodes and detect missing ones.
+
+        Parameters
+        ----------
+        nodes : list of str
+            Names of the nodes as sent in their beats, e.g. ["STM", "ACQ"]
+        window : float
+            Seconds without beat after which a node is unhealthy, by default 3.
+        on_change : callable | None
+            Called with (node, healthy, beat) when a node becomes healthy or
+            unhealthy, beat is the data of the last beat or None, by default None
+        """
+        self.nodes = list(nodes)
+        self.window = window
+        self.on_change = on_change
+        self.last_seen = {}
+        self.beats = {}
+        self.healthy = {node: False for node in self.nodes}
+        self.lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def update(self, msg):
+        """Record a heartbeat message.
+
+        Parameters
+        ----------
+        msg : instance of Message
+            The received heartbeat.
+        """
+        with self.lock:
+            self.last_seen[msg.node] = monotonic()
+            self.beats[msg.node] = msg.data
+        self.check()
+
+    def status(self, node):
+        """Health of node.
+
+        Parameters
+        ----------
+        node : str
+            Name of the node.
+
+        Returns
+        -------
+        healthy : bool
+            True if a beat arrived within the window.
+        beat : dict | None
+            Data of the last beat, None if never received.
+        """
+        with self.lock:
+            last = self.last_seen.get(node)
+            healthy = last is not None and monotonic() - last <= self.window
+            return healthy, self.beats.get(node)
+
+    def unhealthy(self):
+        """Names of the nodes without beat within the window."""
+        return [node for node in self.nodes if not self.status(node)[0]]
+
+    def check(self):
+        """Update the health of all nodes and call on_change on transitions."""
+        changes = []
+        with self.lock:
+            now = monotonic()
+            for node in set(self.nodes) | set(self.last_seen):
+                last = self.last_seen.get(node)
+                healthy = last is not None and now - last <= self.window
+                if healthy != self.healthy.get(node, False):
+                    self.healthy[node] = healthy
+                    changes.append((node, healthy, self.beats.get(node)))
+        if self.on_change is not None:
+            for change in changes:
+                self.on_change(*change)
+        return changes
+
+    def start(self):
+        """Check the nodes in a background thread, several times per window."""
+        if self._thread is not None:
+            return
+        self._stop_event.clear()
+
+        def run():
+            while not self._stop_event.wait(self.window / 4):
+                self.check()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop checking the nodes."""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
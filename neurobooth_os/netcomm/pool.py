@@ -0,0 +1,165 @@
+"""Persistent per-node socket connections used to send messages."""
+
+import socket
+import select
+import threading
+
+from neurobooth_os.netcomm.framing import pack_frame, recv_frame
+
+
+class NodeConnection():
+    def __init__(self, host, port, connect_timeout=3):
+        """Long-lived framed connection to a node server that reconnects when broken.
+
+        Parameters
+        ----------
+        host : str
+            Host name of the node server.
+        port : int
+            Port of the node server.
+        connect_timeout : float, optional
+            Seconds to wait while connecting, by default 3
+        """
+        self.host = host
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.sock = None
+        self.n_connects = 0
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        try:
+            sock = socket.create_connection((self.host, self.port),
+                                            timeout=self.connect_timeout)
+        except socket.timeout:
+            # socket.timeout is not a TimeoutError before python 3.10
+            raise TimeoutError(f"Connecting to {self.host}:{self.port} timed out")
+        sock.settimeout(None)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = sock
+        self.n_connects += 1
+
+    def _is_stale(self):
+        # The server never sends unsolicited data, a readable idle socket was
+        # closed by the server or holds a late reply
+        readable, _, _ = select.select([self.sock], [], [], 0)
+        return bool(readable)
+
+    def _reset(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+
+    def _sendall(self, data):
+        # Must hold self.lock
+        if self.sock is not None and self._is_stale():
+            self._reset()
+        for attempt in range(2):
+            if self.sock is None:
+                self._connect()
+            try:
+                self.sock.sendall(data)
+                return
+            except OSError:
+                self._reset()
+                if attempt:
+                    raise
+
+    def send(self, payload, wait_reply=False, timeout=None):
+        """Send a framed message, reconnecting once if the connection broke.
+
+        Parameters
+        ----------
+        payload : bytes | str
+            The message to send.
+        wait_reply : bool, optional
+            If True, wait for the reply of the server, by default False
+        timeout : float | None, optional
+            Seconds to wait for the reply, None waits forever, by default None
+
+        Returns
+        -------
+        reply : bytes | None
+            The reply if wait_reply, None if not waited or timed out.
+        """
+        with self.lock:
+            self._sendall(pack_frame(payload))
+
+            if not wait_reply:
+                return None
+
+            self.sock.settimeout(timeout)
+            try:
+                reply = recv_frame(self.sock)
+            except socket.timeout:
+                # Partially read frames leave the stream unusable
+                self._reset()
+                return None
+            if reply is None:
+                self._reset()
+            else:
+                self.sock.settimeout(None)
+            return reply
+
+    def send_many(self, payloads):
+        """Send several framed messages with a single write.
+
+        Parameters
+        ----------
+        payloads : list of bytes | str
+            The messages to send, in order.
+        """
+        data = b"".join(pack_frame(p) for p in payloads)
+        with self.lock:
+            self._sendall(data)
+
+    def close(self):
+        """Close the connection, it is reopened on the next send."""
+        with self.lock:
+            self._reset()
+
+
+class ConnectionPool():
+    def __init__(self, resolver):
+        """Keep one persistent connection per node.
+
+        Parameters
+        ----------
+        resolver : callable
+            Function returning (host, port) from a node name.
+        """
+        self.resolver = resolver
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    def get(self, node_name):
+        """Get the connection to node_name, created on first use.
+
+        Parameters
+        ----------
+        node_name : str
+            Name of the node.
+
+        Returns
+        -------
+        connection : instance of NodeConnection
+            The connection to the node.
+        """
+        with self.lock:
+            connection = self.connections.get(node_name)
+            if connection is None:
+                host, port = self.resolver(node_name)
+                connection = NodeConnection(host, port)
+                self.connections[node_name] = connection
+            return connection
+
+    def close(self, node_name=None):
+        """Close connection to node_name, all connections if None."""
+        with self.lock:
+            names = list(self.connections) if node_name is None else [node_name]
+            connections = [self.connections.pop(n) for n in names if n in self.connections]
+        for connection in connections:
+            connection.close()
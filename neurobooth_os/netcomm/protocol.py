@@ -0,0 +1,92 @@
+"""Typed messages exchanged between CTR, STM and ACQ.
+
+Messages are compact JSON envelopes::
+
+    {"v": 1, "type": "prepare", "node": "CTR", "data": {"collection_id": ...}}
+
+Requests sent with netcomm.rpc also carry an "id" that the reply copies.
+
+Control messages sent to STM and ACQ:
+    prepare, present, record_start, record_stop, scr_stream, vis_stream,
+    dev_param_update, pause_tasks, unpause_tasks, stop_tasks, close,
+    shutdown, time_test, clock_probe
+
+Replies:
+    devices_ready, time_reply, clock_reply, error
+
+Events sent to CTR:
+    log, outlet_id, update_button, task_initiated, task_finished,
+    new_filename, heartbeat
+"""
+
+import json
+from collections import namedtuple
+
+PROTOCOL_VERSION = 1
+
+Message = namedtuple("Message", ["type", "data", "node", "id"], defaults=(None,))
+
+
+class ProtocolError(ValueError):
+    """Raised when a message can not be decoded."""
+
+
+def encode_message(msg_type, node=None, request_id=None, **data):
+    """Encode a typed message.
+
+    Parameters
+    ----------
+    msg_type : str
+        Type of the message, e.g. "prepare".
+    node : str | None
+        Name of the sending node, by default None
+    request_id : int | None
+        Id correlating a request and its reply, by default None
+    **data : dict
+        JSON serializable fields of the message.
+
+    Returns
+    -------
+    payload : str
+        The encoded message.
+    """
+    envelope = {"v": PROTOCOL_VERSION, "type": msg_type, "node": node, "data": data}
+    if request_id is not None:
+        envelope["id"] = request_id
+    return json.dumps(envelope, separators=(",", ":"), default=str)
+
+
+def decode_message(payload):
+    """Decode a message encoded with encode_message.
+
+    Payloads that are not envelopes, e.g. from older nodes, are returned
+    as a "text" message.
+
+    Parameters
+    ----------
+    payload : str | bytes
+        The received message.
+
+    Returns
+    -------
+    msg : instance of Message
+        Named tuple with type, data, node and id fields.
+    """
+    if isinstance(payload, bytes):
+        try:
+            payload = payload.decode("utf-8")
+        except UnicodeDecodeError as e:
+            raise ProtocolError(f"Can not decode message {payload[:100]}: {e}")
+    if not payload.startswith("{"):
+        return Message("text", {"text": payload}, None)
+
+    try:
+        envelope = json.loads(payload)
+        version = envelope["v"]
+        msg_type = envelope["type"]
+    except (ValueError, KeyError, TypeError) as e:
+        raise ProtocolError(f"Can not decode message {payload[:100]}: {e}")
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f"Message version {version} is not {PROTOCOL_VERSION}")
+    return Message(msg_type, envelope.get("data") or {}, envelope.get("node"),
+                   envelope.get("id"))
@@ -0,0 +1,346 @@
+"""Request/response calls to node servers.
+
+Each request carries an id that the node copies into its reply. Many
+requests can be outstanding at once, on one connection or across several
+nodes. A background thread per connection reads the replies and wakes the
+waiting caller as soon as its reply arrives.
+
+Nodes answer requests yielded by get_client_messages with `reply` or
+`reply_error`::
+
+    for msg, connx in get_client_messages(s1):
+        if msg.type == "record_start":
+            ...
+            reply(connx, msg, "devices_ready", node="ACQ")
+"""
+
+import socket
+import threading
+import itertools
+from time import monotonic
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+from neurobooth_os.netcomm.client import node_info
+from neurobooth_os.netcomm.framing import pack_frame, recv_frame
+from neurobooth_os.netcomm.protocol import encode_message, decode_message, ProtocolError
+
+
+class RpcError(Exception):
+    """Base class of the errors raised by calls."""
+
+
+class RpcTimeout(RpcError, TimeoutError):
+    """Raised when the reply did not arrive before the deadline."""
+
+
+class RemoteError(RpcError):
+    """Raised when the node failed to handle the request.
+
+    Attributes
+    ----------
+    error_type : str
+        Name of the exception raised in the node.
+    """
+    def __init__(self, message, error_type=None):
+        super().__init__(message)
+        self.error_type = error_type
+
+
+class ConnectionLost(RpcError, ConnectionError):
+    """Raised when the node can not be reached or closed the connection."""
+
+
+class PendingCall():
+    def __init__(self, client, request_id, msg_type, deadline=None):
+        """A request waiting for its reply.
+
+        Parameters
+        ----------
+        client : instance of RpcClient
+            The client that sent the request.
+        request_id : int
+            Id of the request.
+        msg_type : str
+            Type of the request.
+        deadline : float | None
+            time.monotonic time after which the call times out, None waits
+            forever, by default None
+        """
+        self.client = client
+        self.request_id = request_id
+        self.msg_type = msg_type
+        self.deadline = deadline
+        self.future = Future()
+        self._sock = None
+
+    def done(self):
+        """Return True if the reply or an error arrived."""
+        return self.future.done()
+
+    def result(self, timeout=None):
+        """Wait for the reply.
+
+        Parameters
+        ----------
+        timeout : float | None
+            Seconds to wait, never past the deadline of the call. None waits
+            until the deadline, by default None
+
+        Returns
+        -------
+        reply : instance of Message
+            The reply of the node.
+
+        Raises
+        ------
+        RpcTimeout
+            If no reply arrived in time.
+        RemoteError
+            If the node failed to handle the request.
+        ConnectionLost
+            If the connection closed before the reply arrived.
+        """
+        wait = timeout
+        if self.deadline is not None:
+            remaining = max(0, self.deadline - monotonic())
+            wait = remaining if wait is None else min(wait, remaining)
+        try:
+            return self.future.result(wait)
+        except FutureTimeoutError:
+            # Kept pending until its deadline, result can wait again
+            if self.deadline is not None and monotonic() >= self.deadline:
+                self.client._forget(self.request_id)
+            raise RpcTimeout(f"{self.msg_type} to {self.client.name} timed out "
+                             f"after {wait} s")
+
+
+class RpcClient():
+    def __init__(self, host, port, name=None, connect_timeout=3):
+        """Connection to a node server multiplexing concurrent requests.
+
+        Parameters
+        ----------
+        host : str
+            Host name of the node server.
+        port : int
+            Port of the node server.
+        name : str | None
+            Name of the node, used in errors, by default None
+        connect_timeout : float, optional
+            Seconds to wait while connecting, by default 3
+        """
+        self.host = host
+        self.port = port
+        self.name = name or f"{host}:{port}"
+        self.connect_timeout = connect_timeout
+        self.sock = None
+        self.pending = {}
+        self.lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    def _connect(self):
+        # Must hold self.lock
+        try:
+            sock = socket.create_connection((self.host, self.port),
+                                            timeout=self.connect_timeout)
+        except OSError as e:
+            raise ConnectionLost(f"Can not connect to {self.name}: {e}") from e
+        sock.settimeout(None)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = sock
+        reader = threading.Thread(target=self._read, args=(sock,), daemon=True)
+        reader.start()
+
+    def _read(self, sock):
+        try:
+            while True:
+                payload = recv_frame(sock)
+                if payload is None:
+                    break
+                try:
+                    msg = decode_message(payload)
+                except ProtocolError as e:
+                    print(e)
+                    continue
+                with self.lock:
+                    call = self.pending.pop(msg.id, None)
+                if call is None:
+                    # Late reply of a timed out call
+                    continue
+                if msg.type == "error":
+                    call.future.set_exception(RemoteError(msg.data.get("message"),
+                                                          msg.data.get("error_type")))
+                else:
+                    call.future.set_result(msg)
+        except (OSError, ValueError):
+            pass
+        finally:
+            with self.lock:
+                if self.sock is sock:
+                    self.sock = None
+                lost = [c for c in self.pending.values() if c._sock is sock]
+                for call in lost:
+                    del self.pending[call.request_id]
+            sock.close()
+            for call in lost:
+                call.future.set_exception(
+                    ConnectionLost(f"Connection to {self.name} closed before "
+                                   f"the reply to {call.msg_type}"))
+
+    def _forget(self, request_id):
+        with self.lock:
+            self.pending.pop(request_id, None)
+
+    def call_async(self, msg_type, timeout=None, node=None, **data):
+        """Send a request without waiting for its reply.
+
+        Parameters
+        ----------
+        msg_type : str
+            Type of the request, e.g. "record_start".
+        timeout : float | None
+            Seconds from now until the deadline of the call, None waits
+            forever, by default None
+        node : str | None
+            Name of the sending node, by default None
+        **data : dict
+            JSON serializable fields of the request.
+
+        Returns
+        -------
+        call : instance of PendingCall
+            Call to wait on for the reply, errors are raised by its result.
+        """
+        request_id = next(self._ids)
+        deadline = None if timeout is None else monotonic() + timeout
+        call = PendingCall(self, request_id, msg_type, deadline)
+        frame = pack_frame(encode_message(msg_type, node=node, request_id=request_id, **data))
+
+        with self.lock:
+            try:
+                if self.sock is None:
+                    self._connect()
+            except ConnectionLost as e:
+                call.future.set_exception(e)
+                return call
+            call._sock = self.sock
+            self.pending[request_id] = call
+            try:
+                self.sock.sendall(frame)
+            except OSError as e:
+                del self.pending[request_id]
+                # The reader fails the other pending calls of this socket
+                try:
+                    self.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                self.sock = None
+                call.future.set_exception(
+                    ConnectionLost(f"Sending {msg_type} to {self.name} failed: {e}"))
+        return call
+
+    def call(self, msg_type, timeout=None, node=None, **data):
+        """Send a request and wait for its reply, see call_async and PendingCall.result."""
+        return self.call_async(msg_type, timeout, node, **data).result()
+
+    def close(self):
+        """Close the connection, pending calls fail with ConnectionLost."""
+        with self.lock:
+            sock, self.sock = self.sock, None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(node_name):
+    """Get the RPC client of node_name, created on first use.
+
+    Parameters
+    ----------
+    node_name : str
+        Name of the node.
+
+    Returns
+    -------
+    client : instance of RpcClient
+        The client of the node.
+    """
+    with _clients_lock:
+        client = _clients.get(node_name)
+        if client is None:
+            host, port = node_info(node_name)
+            client = RpcClient(host, port, name=node_name)
+            _clients[node_name] = client
+        return client
+
+
+def call_async(node_name, msg_type, timeout=None, node=None, **data):
+    """Send a request to node_name without waiting, see RpcClient.call_async."""
+    return get_client(node_name).call_async(msg_type, timeout, node, **data)
+
+
+def call(node_name, msg_type, timeout=None, node=None, **data):
+    """Send a request to node_name and wait for its reply, see RpcClient.call.
+
+    Parameters
+    ----------
+    node_name : str
+        The node to send the request to.
+    msg_type : str
+        Type of the request, e.g. "record_start".
+    timeout : float | None
+        Seconds to wait for the reply, None waits forever, by default None
+    node : str | None
+        Name of the sending node, by default None
+    **data : dict
+        JSON serializable fields of the request.
+
+    Returns
+    -------
+    reply : instance of Message
+        The reply of the node.
+    """
+    return get_client(node_name).call(msg_type, timeout, node, **data)
+
+
+def reply(connx, request, msg_type, node=None, **data):
+    """Reply to a request received with get_client_messages.
+
+    Parameters
+    ----------
+    connx : instance of ReplyChannel
+        Channel the request came from.
+    request : instance of Message
+        The request.
+    msg_type : str
+        Type of the reply, e.g. "devices_ready".
+    node : str | None
+        Name of the replying node, by default None
+    **data : dict
+        JSON serializable fields of the reply.
+    """
+    connx.send(encode_message(msg_type, node=node, request_id=request.id, **data))
+
+
+def reply_error(connx, request, error, node=None):
+    """Reply to a request with the error raised while handling it.
+
+    Parameters
+    ----------
+    connx : instance of ReplyChannel
+        Channel the request came from.
+    request : instance of Message
+        The request.
+    error : instance of Exception
+        The error, raised as RemoteError by the caller.
+    node : str | None
+        Name of the replying node, by default None
+    """
+    connx.send(encode_message("error", node=node, request_id=request.id,
+                              error_type=type(error).__name__, message=str(error)))
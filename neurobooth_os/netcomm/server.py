@@ -1,8 +1,21 @@
 import io
 import sys
+import time
 import socket
+import queue
+import threading
+import asyncio
+import atexit
+import collections
 
 from neurobooth_os.netcomm import socket_message
+from neurobooth_os.netcomm.client import get_pool
+from neurobooth_os.netcomm.protocol import encode_message, decode_message, ProtocolError
+from neurobooth_os.netcomm.framing import pack_frame, HEADER, MAX_FRAME_SIZE
+from neurobooth_os.netcomm.clock_sync import PROBE_PREFIX, answer_probe
+
+# Servers of the sockets passed to get_client_messages
+_servers = {}
 
 
 def get_fprint(current_node, target_node='control'):
@@ -36,7 +49,8 @@ def get_fprint(current_node, target_node='control'):
             msg = mystdout.getvalue()
             if msg == "":
                 return
-            socket_message(f"{current_node}: {msg} ", node_name=target_node)
+            socket_message(encode_message("log", node=current_node, text=msg),
+                           node_name=target_node)
             mystdout.truncate(0)
             mystdout.seek(0)
         except Exception as e:
@@ -45,24 +59,144 @@ def get_fprint(current_node, target_node='control'):
     return fprint_flush, old_stdout
 
 
+class LogShipper():
+    def __init__(self, target_node='control', max_queue=10000, batch_size=200,
+                 flush_interval=.05, drop_policy="oldest", terminal=None):
+        """Queue messages and send them to target_node in batches from a background thread.
+
+        Writers only append to a deque, they never wait on the network. The
+        background thread sends queued messages as soon as batch_size are
+        waiting or every flush_interval seconds.
+
+        Parameters
+        ----------
+        target_node : str, optional
+            name of the node to which send the messages, by default 'control'
+        max_queue : int, optional
+            Maximum number of queued messages, by default 10000
+        batch_size : int, optional
+            Number of queued messages that triggers a send, by default 200
+        flush_interval : float, optional
+            Maximum seconds a message waits in the queue, by default .05
+        drop_policy : str, optional
+            Which message to drop when the queue is full, "oldest" or "newest",
+            by default "oldest"
+        terminal : object | None, optional
+            Stream where to report messages that could not be sent, by default None
+        """
+        if drop_policy not in ("oldest", "newest"):
+            raise ValueError(f"drop_policy must be 'oldest' or 'newest', got {drop_policy}")
+
+        self.target_node = target_node
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.drop_policy = drop_policy
+        self.terminal = terminal
+
+        # deque append and popleft are thread-safe without locking
+        self.queue = collections.deque()
+        self.counts = {"sent": 0, "dropped": 0, "failed": 0, "batches": 0}
+        self.count_lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def put(self, message):
+        "queue a message, never blocks."
+        if len(self.queue) >= self.max_queue:
+            with self.count_lock:
+                self.counts["dropped"] += 1
+            if self.drop_policy == "newest":
+                return
+            try:
+                self.queue.popleft()
+            except IndexError:
+                pass
+        self.queue.append(message)
+        if len(self.queue) >= self.batch_size:
+            self.wakeup.set()
+
+    def _run(self):
+        while self.running:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """Send all queued messages, blocks until sent or failed."""
+        with self.flush_lock:
+            while self.queue:
+                batch = []
+                while self.queue and len(batch) < self.batch_size:
+                    batch.append(self.queue.popleft())
+                try:
+                    get_pool().get(self.target_node).send_many(batch)
+                except Exception as e:
+                    with self.count_lock:
+                        self.counts["failed"] += len(batch)
+                    if self.terminal is not None:
+                        self.terminal.write(f"{len(batch)} messages not sent to "
+                                            f"{self.target_node}: {e}\n")
+                    continue
+                with self.count_lock:
+                    self.counts["sent"] += len(batch)
+                    self.counts["batches"] += 1
+
+    def stats(self):
+        """Get the counters of sent, dropped and failed messages.
+
+        Returns
+        -------
+        stats : dict
+            Number of messages sent, dropped, failed, pending and batches sent.
+        """
+        with self.count_lock:
+            stats = dict(self.counts)
+        stats["pending"] = len(self.queue)
+        return stats
+
+    def close(self):
+        """Stop the background thread and send the remaining messages."""
+        if not self.running:
+            return
+        self.running = False
+        self.wakeup.set()
+        self.thread.join()
+        self.flush()
+        atexit.unregister(self.close)
+
+
 class NewStdout():
-    def __init__(self, current_node, target_node='control', terminal_print=False):
+    def __init__(self, current_node, target_node='control', terminal_print=False,
+                 background=False, **shipper_kwargs):
         """Class that substitutes stdout pipe, sends message to socket and can print to terminal.
 
         Parameters
         ----------
         current_node : str
-            Name of the current node, will be added in the message: {current_node}:::{msg}
+            Name of the current node, sent as the node of each log message
         target_node : str, optional
             name of the node to whick send socket message, by default 'control'
         terminal_print : bool, optional
             if True the message will be printed in the terminal, by default False
+        background : bool, optional
+            if True messages are queued and sent in batches by a LogShipper
+            thread so that writing never waits on the network, by default False
+        **shipper_kwargs : dict
+            Parameters passed to LogShipper if background is True.
         """
 
         self.terminal = sys.stdout
         self.current_node = current_node
         self.target_node = target_node
         self.terminal_print = terminal_print
+        self.shipper = None
+        if background:
+            self.shipper = LogShipper(target_node, terminal=self.terminal, **shipper_kwargs)
 
     def write(self, message):
         "write message to terminal and socket."
@@ -72,20 +206,189 @@ class NewStdout():
 
         # send to socket if message not empty
         if message not in ["\n", ""]:
-            try:
-                socket_message(f"{self.current_node}:::{message}", node_name=self.target_node)
-            except:
-                self.terminal.write(f"message {message} not sent to {self.target_node}")
+            self._send(encode_message("log", node=self.current_node, text=message))
+
+    def send_event(self, msg_type, **data):
+        "send a typed event to target_node, e.g. outlet_id."
+        if self.terminal_print:
+            self.terminal.write(f"{msg_type}: {data}\n")
+        self._send(encode_message(msg_type, node=self.current_node, **data))
+
+    def _send(self, payload):
+        if self.shipper is not None:
+            self.shipper.put(payload)
+            return
+        try:
+            socket_message(payload, node_name=self.target_node)
+        except:
+            self.terminal.write(f"message {payload} not sent to {self.target_node}")
 
     def flush(self):
-        # For compatibility, just pass
-        pass
+        # Messages are sent by the shipper thread, only wake it up
+        if self.shipper is not None:
+            self.shipper.wakeup.set()
+
+    def close(self):
+        """Send pending messages and stop the shipper thread."""
+        if self.shipper is not None:
+            self.shipper.close()
+
+
+def send_event(msg_type, **data):
+    """Send a typed event to CTR through the NewStdout of this node.
+
+    If stdout is not rerouted, e.g. when devices run standalone, the event
+    is printed.
+
+    Parameters
+    ----------
+    msg_type : str
+        Type of the event, e.g. "outlet_id".
+    **data : dict
+        JSON serializable fields of the event.
+    """
+    if isinstance(sys.stdout, NewStdout):
+        sys.stdout.send_event(msg_type, **data)
+    else:
+        print(f"{msg_type}: {data}")
+
+
+class ReplyChannel():
+    def __init__(self, writer, loop):
+        """Send framed replies through the connection a message came from.
+
+        Parameters
+        ----------
+        writer : instance of asyncio.StreamWriter
+            Writer of the client connection.
+        loop : instance of asyncio.AbstractEventLoop
+            Event loop serving the connection.
+        """
+        self.writer = writer
+        self.loop = loop
 
+    def send(self, data):
+        "send data as one frame, mimics socket.send, can be called from any thread."
+        self.loop.call_soon_threadsafe(self.writer.write, pack_frame(data))
+        return len(data)
+
+
+class NodeServer():
+    def __init__(self, sock):
+        """Asyncio server queuing framed messages from many concurrent clients.
+
+        The event loop runs in a background thread, messages are consumed
+        in order from any other thread with `get`. Clock probes are answered
+        directly by the event loop.
+
+        Parameters
+        ----------
+        sock : instance of socket.socket
+            Bound socket to serve.
+        """
+        self.sock = sock
+        self.messages = queue.Queue()
+        self.writers = set()
+        self.loop = None
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        """Start serving in a background thread, returns once listening."""
+        self.loop = asyncio.new_event_loop()
+        started = threading.Event()
+        error = []
+
+        def run():
+            asyncio.set_event_loop(self.loop)
+            try:
+                self.server = self.loop.run_until_complete(
+                    asyncio.start_server(self._handle_client, sock=self.sock))
+            except Exception as e:
+                error.append(e)
+                started.set()
+                return
+            started.set()
+            self.loop.run_forever()
+            self.loop.close()
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        started.wait()
+        if error:
+            raise error[0]
+
+    async def _handle_client(self, reader, writer):
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.writers.add(writer)
+        reply = ReplyChannel(writer, self.loop)
+        try:
+            while True:
+                header = await reader.readexactly(HEADER.size)
+                size, = HEADER.unpack(header)
+                if size > MAX_FRAME_SIZE:
+                    print(f"Dropping client sending a frame of {size} bytes")
+                    break
+                payload = await reader.readexactly(size)
+                if payload.startswith(PROBE_PREFIX):
+                    # Answer clock probes right away, queuing would add the node's delay
+                    writer.write(pack_frame(answer_probe(payload)))
+                    continue
+                # Decoded by the consumer, a bad frame raises ProtocolError there
+                self.messages.put((payload, reply))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+    def get(self, timeout=None):
+        """Get the next message and its reply channel.
+
+        Parameters
+        ----------
+        timeout : float | None
+            Seconds to wait, None waits forever.
+
+        Returns
+        -------
+        data : bytes | None
+            The message, to decode with decode_message, None if timed out.
+        reply : instance of ReplyChannel | None
+            Channel to send data back to the client.
+        """
+        try:
+            return self.messages.get(timeout=timeout)
+        except queue.Empty:
+            return None, None
+
+    async def _close(self):
+        self.server.close()
+        for writer in list(self.writers):
+            writer.close()
+        await self.server.wait_closed()
+
+    def stop(self):
+        """Stop serving and close all client connections."""
+        if self.thread is None or not self.thread.is_alive():
+            return
+        future = asyncio.run_coroutine_threadsafe(self._close(), self.loop)
+        try:
+            future.result(timeout=5)
+        except Exception as e:
+            print(f"Error closing server: {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
 
 
 def get_client_messages(s1, port=12347, host=''):
     """Create socket server and get messages from clients.
 
+    Clients are served concurrently by a NodeServer, this generator yields
+    their framed messages in the order they arrived.
+
     Parameters
     ----------
     s1 : instance of socket.Socket
@@ -97,9 +400,9 @@ def get_client_messages(s1, port=12347, host=''):
 
     Returns
     -------
-    data : str
-        Yields the data.
-    conn : callable
+    msg : instance of Message
+        Yields the decoded messages.
+    conn : instance of ReplyChannel
         Socket connector for sending back data.
     """
 
@@ -111,25 +414,26 @@ def get_client_messages(s1, port=12347, host=''):
     s1.listen(5)
     print("socket is listening")
 
-    # Signal event to change init_serv button to green
-    print("UPDATOR:-init_servs-")
-
-    # a forever loop until client wants to exit
-    while True:
+    server = NodeServer(s1)
+    _servers[s1] = server
+    server.start()
 
-        # establish connection with client
-        try:
-            conn, addr = s1.accept()
-            data = conn.recv(1024)
-        except BaseException:
-            continue
-
-        if not data:            
-            print("Connection fault, closing Stim server")
-            break
+    # Signal event to change init_serv button to green
+    send_event("update_button", key="-init_servs-")
 
-        data = data.decode("utf-8")
-        yield data, conn
+    try:
+        # a forever loop until client wants to exit
+        while True:
+            data, conn = server.get()
+            try:
+                msg = decode_message(data)
+            except ProtocolError as e:
+                print(e)
+                continue
+            yield msg, conn
+    finally:
+        del _servers[s1]
+        server.stop()
 
 
 def get_messages_to_ctr(callback=None, remote=False, host="", port=12347, *callback_args):
@@ -138,7 +442,7 @@ def get_messages_to_ctr(callback=None, remote=False, host="", port=12347, *callb
     Parameters
     ----------
     callback : callable
-        Function that processes received socket data, by default None
+        Function that processes each received Message, by default None
     host : str, optional
         IP adrress of the socket connexion
     port : int, optional
@@ -154,43 +458,53 @@ def get_messages_to_ctr(callback=None, remote=False, host="", port=12347, *callb
     s.listen(5)
     print("socket is listening")
 
+    server = NodeServer(s)
+    server.start()
+
     while True:
+        data, _ = server.get()
         try:
-            c, addr = s.accept()
-            data = c.recv(1024)
-        except BaseException:
-            # print("Connection fault on ctr server")
+            msg = decode_message(data)
+        except ProtocolError as e:
+            print(e)
             continue
 
-        data = data.decode("utf-8")
         if not remote:
-            print(data)
+            if msg.type in ("log", "text"):
+                print(f"{msg.node}: {msg.data['text']}")
+            elif msg.type != "heartbeat":
+                print(f"{msg.node}: {msg.type} {msg.data}")
         if callback is not None:
-            callback(data, *callback_args)
+            callback(msg, *callback_args)
 
-        if data == "close":
+        if msg.type == "close":
             break
-    s.close()
+    server.stop()
 
 
 def get_data_timeout(s1, timeout=.1):
-    """Change socket timeout, get data, and remove timeout.
+    """Get data received by the server of get_client_messages, with timeout.
 
     Parameters
     ----------
     s1 : callable
-        socket.socket instance
-    timeout: float
-        Time to wait for message
+        socket.socket instance passed to get_client_messages
+    timeout: float | None
+        Time to wait for message, None waits forever.
+
+    Returns
+    -------
+    msg : instance of Message | None
+        The decoded message, None if timed out. Malformed messages are
+        printed and skipped as in get_client_messages.
     """
-    s1.settimeout(timeout)
-    
-    try: 
-        conn, _ = s1.accept()
-        data = conn.recv(1024)
-        data = data.decode("utf-8")
-    except socket.timeout:
-        data = None
-        
-    s1.settimeout(None)
-    return data
\ No newline at end of file
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        remaining = None if deadline is None else max(0, deadline - time.monotonic())
+        data, _ = _servers[s1].get(remaining)
+        if data is None:
+            return None
+        try:
+            return decode_message(data)
+        except ProtocolError as e:
+            print(e)
@@ -7,8 +7,16 @@ Created on Tue Sep 14 15:33:40 2021
 import time
 import queue
 import sys
+import socket
+import threading
 
-from neurobooth_os.netcomm import socket_message, NewStdout
+import pytest
+
+from neurobooth_os.netcomm import (socket_message, NewStdout, node_info, encode_message,
+                                   decode_message, ClockSync, get_client_messages, call_async,
+                                   reply, reply_error, RpcTimeout, RemoteError, HeartbeatSender,
+                                   HealthMonitor, MessageDispatcher, ProtocolError)
+from neurobooth_os.netcomm.client import get_pool
 from neurobooth_os.mock import mock_server_ctr
 
 
@@ -19,16 +27,67 @@ def test_socket_message_to_ctr():
     def callback(data, data_queue):
         data_queue.put(data)
     server_thread = mock_server_ctr(callback, data_queue)
+    time.sleep(.5)
 
     # Test socket_message
-    message = "test:::test_test"
+    message = encode_message("log", node="test", text="test_test")
     socket_message(message=message, node_name="dummy_ctr")
     time.sleep(1.)
-    assert data_queue.get(timeout=2) == message
+    msg = data_queue.get(timeout=2)
+    assert msg.type == "log"
+    assert msg.node == "test"
+    assert msg.data["text"] == "test_test"
+
+    # kill the server_com thread
+    socket_message(message=encode_message("close"), node_name="dummy_ctr")
+    server_thread.join(2)
+
+
+def test_socket_message_reuses_connection():
+    """ Test long messages to dummy_ctr are not truncated and share a connection """
+
+    data_queue = queue.Queue()
+    def callback(data, data_queue):
+        data_queue.put(data)
+    server_thread = mock_server_ctr(callback, data_queue)
+    time.sleep(.5)
+
+    pool = get_pool()
+    pool.close("dummy_ctr")
+    text = "x" * 5000
+    for _ in range(10):
+        socket_message(message=encode_message("log", node="test", text=text),
+                       node_name="dummy_ctr")
+    for _ in range(10):
+        assert data_queue.get(timeout=2).data["text"] == text
+    assert pool.get("dummy_ctr").n_connects == 1
 
     # kill the server_com thread
-    message = "close"
+    socket_message(message=encode_message("close"), node_name="dummy_ctr")
+    server_thread.join(2)
+
+
+def test_slow_client_does_not_block():
+    """ Test a client stalled mid message does not block other clients """
+
+    data_queue = queue.Queue()
+    def callback(data, data_queue):
+        data_queue.put(data)
+    server_thread = mock_server_ctr(callback, data_queue)
+    time.sleep(.5)
+
+    # Send only part of the length prefix and keep the connection open
+    slow_client = socket.create_connection(node_info("dummy_ctr"))
+    slow_client.sendall(b"\x00\x00")
+
+    message = encode_message("log", node="test", text="not_blocked")
     socket_message(message=message, node_name="dummy_ctr")
+    assert data_queue.get(timeout=2).data["text"] == "not_blocked"
+    slow_client.close()
+
+    # kill the server_com thread
+    socket_message(message=encode_message("close"), node_name="dummy_ctr")
+    server_thread.join(2)
 
 
 def test_stdout_print_to_ctr():
@@ -38,14 +97,262 @@ def test_stdout_print_to_ctr():
     def callback(data, data_queue):
         data_queue.put(data)
     server_thread = mock_server_ctr(callback, data_queue)
+    time.sleep(.5)
 
     # Test message is received by dummy_ctr server
     sys.stdout = NewStdout("STM", target_node="dummy_ctr", terminal_print=False)
     message = "test_test2"
+    print(message)
     queue_msg = data_queue.get(timeout=1)
-    assert(queue_msg.split(":::")[1] == message)
+    assert(queue_msg.data["text"] == message)
     sys.stdout = sys.stdout.terminal
 
     # kill the server_thread thread
-    message = "close"
-    socket_message(message=message, node_name="dummy_ctr")
\ No newline at end of file
+    socket_message(message=encode_message("close"), node_name="dummy_ctr")
+    server_thread.join(2)
+
+
+def test_background_stdout_to_ctr():
+    """ Test batched stdout messages all reach dummy_ctr in order """
+
+    data_queue = queue.Queue()
+    def callback(data, data_queue):
+        data_queue.put(data)
+    server_thread = mock_server_ctr(callback, data_queue)
+    time.sleep(.5)
+
+    stdout = NewStdout("STM", target_node="dummy_ctr", terminal_print=False,
+                       background=True, batch_size=50)
+    for i in range(500):
+        stdout.write(f"test_{i}")
+    stdout.close()
+
+    for i in range(500):
+        msg = data_queue.get(timeout=2)
+        assert msg.node == "STM"
+        assert msg.data["text"] == f"test_{i}"
+    stats = stdout.shipper.stats()
+    assert stats["sent"] == 500
+    assert stats["dropped"] == 0
+    assert stats["pending"] == 0
+
+    # kill the server_com thread
+    socket_message(message=encode_message("close"), node_name="dummy_ctr")
+    server_thread.join(2)
+
+
+def test_message_roundtrip():
+    """ Test typed messages survive encoding and legacy text is wrapped """
+
+    payload = encode_message("present", node="CTR", tasks=["task_1", "task_2"],
+                             subj_id="test")
+    msg = decode_message(payload.encode("utf-8"))
+    assert msg.type == "present"
+    assert msg.node == "CTR"
+    assert msg.data == {"tasks": ["task_1", "task_2"], "subj_id": "test"}
+
+    msg = decode_message("plain text")
+    assert msg.type == "text"
+    assert msg.data["text"] == "plain text"
+
+    with pytest.raises(ProtocolError):
+        decode_message(b"\xff\xfe not utf-8")
+
+
+def test_dispatcher_counts():
+    """ Test messages reach the handler of their type and are counted """
+
+    dispatcher = MessageDispatcher()
+    received = []
+
+    @dispatcher.register("task_finished")
+    def task_finished(msg, out):
+        out.append(msg.data["task_id"])
+
+    def fail(msg, out):
+        raise ValueError("handler error")
+    dispatcher.register("outlet_id", fail)
+
+    for payload in [encode_message("task_finished", node="STM", task_id="task_1"),
+                    encode_message("outlet_id", node="ACQ", name="Mouse", outlet_id="1"),
+                    encode_message("unknown", node="STM")]:
+        dispatcher.dispatch(decode_message(payload), received)
+
+    assert received == ["task_1"]
+    stats = dispatcher.stats()
+    assert stats["task_finished"]["count"] == 1
+    assert stats["task_finished"]["errors"] == 0
+    assert stats["outlet_id"]["errors"] == 1
+    assert stats["unknown"]["count"] == 1
+    assert stats["task_finished"]["max_ms"] >= stats["task_finished"]["mean_ms"] >= 0
+
+
+def test_clock_sync_dummy_ctr():
+    """ Test clock probes are answered by dummy_ctr without reaching the callback """
+
+    data_queue = queue.Queue()
+    def callback(data, data_queue):
+        data_queue.put(data)
+    server_thread = mock_server_ctr(callback, data_queue)
+    time.sleep(.5)
+
+    clock_sync = ClockSync(["dummy_ctr"], n_probes=20, probe_interval=0)
+    for _ in range(2):
+        est = clock_sync.measure("dummy_ctr")
+        assert est["n_probes"] == 20
+        # Same machine, clocks agree up to the round trip
+        assert abs(est["offset"]) <= est["rtt_p99"] + 1e-3
+        assert abs(est["lsl_offset"]) <= est["rtt_p99"] + 1e-3
+        assert 0 <= est["rtt_min"] <= est["rtt_p50"] <= est["rtt_p99"]
+    assert len(clock_sync.series["dummy_ctr"]) == 2
+    assert clock_sync.drift("dummy_ctr") is not None
+    assert data_queue.empty()
+
+    # kill the server_com thread
+    socket_message(message=encode_message("close"), node_name="dummy_ctr")
+    server_thread.join(2)
+
+
+def test_rpc_concurrent_calls():
+    """ Test replies are matched to their requests, deadlines and remote errors """
+
+    def serve_dummy_acq():
+        s1 = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        host, port = node_info("dummy_acq")
+        held = []
+        for msg, connx in get_client_messages(s1, port, host):
+            if msg.type == "echo":
+                held.append((msg, connx))
+                # Reply to the pair in reverse order
+                if len(held) == 2:
+                    for m, c in held[::-1]:
+                        reply(c, m, "echo_reply", value=m.data["value"])
+                    held = []
+            elif msg.type == "fail":
+                reply_error(connx, msg, ValueError("bad request"))
+            elif msg.type == "close":
+                break
+        s1.close()
+
+    server_thread = threading.Thread(target=serve_dummy_acq, daemon=True)
+    server_thread.start()
+    time.sleep(.5)
+
+    first = call_async("dummy_acq", "echo", value=1)
+    second = call_async("dummy_acq", "echo", value=2)
+    assert second.result(timeout=2).data["value"] == 2
+    assert first.result(timeout=2).data["value"] == 1
+
+    # A shorter wait than the deadline keeps the call pending
+    held = call_async("dummy_acq", "echo", timeout=5, value=4)
+    with pytest.raises(RpcTimeout):
+        held.result(timeout=.05)
+    call_async("dummy_acq", "echo", value=5)
+    assert held.result(timeout=2).data["value"] == 4
+
+    silent = call_async("dummy_acq", "echo", timeout=.05, value=3)
+    t0 = time.time()
+    with pytest.raises(RpcTimeout):
+        silent.result()
+    assert time.time() - t0 < 1
+
+    with pytest.raises(RemoteError) as e:
+        call_async("dummy_acq", "fail").result(timeout=2)
+    assert e.value.error_type == "ValueError"
+
+    socket_message(message=encode_message("close"), node_name="dummy_acq")
+    server_thread.join(2)
+
+
+def test_heartbeat_health_monitor():
+    """ Test dummy_ctr marks a node unhealthy once its heartbeats stop """
+
+    changes = queue.Queue()
+    health = HealthMonitor(["STM"], window=.5,
+                           on_change=lambda *change: changes.put(change))
+    def callback(msg, health):
+        if msg.type == "heartbeat":
+            health.update(msg)
+    server_thread = mock_server_ctr(callback, health)
+    time.sleep(.5)
+    health.start()
+
+    heartbeat = HeartbeatSender("STM", target_node="dummy_ctr", interval=.1)
+    heartbeat.set_streams(["marker"])
+    heartbeat.start()
+    node, healthy, beat = changes.get(timeout=2)
+    assert (node, healthy) == ("STM", True)
+    assert beat["streams"] == ["marker"]
+    assert 0 <= beat["cpu_percent"] <= 100
+
+    heartbeat.stop()
+    t_stop = time.time()
+    node, healthy, _ = changes.get(timeout=2)
+    assert (node, healthy) == ("STM", False)
+    assert time.time() - t_stop < .5 + .5
+    assert health.unhealthy() == ["STM"]
+    health.stop()
+
+    # kill the server_com thread
+    socket_message(message=encode_message("close"), node_name="dummy_ctr")
+    server_thread.join(2)
+
+
+def test_benchmark_smoke():
+    """ Test the netcomm benchmarks run on the dummy nodes and report all metrics """
+    from neurobooth_os.netcomm.benchmark import run_benchmarks, compare
+
+    report = run_benchmarks(n_messages=400, n_requests=50)
+    for name in ["socket_message", "stdout_burst", "ctr_callbacks", "rpc_round_trip"]:
+        res = report["results"][name]
+        assert res["msgs_per_sec"] > 0
+        assert res["latency_p50_ms"] <= res["latency_p99_ms"]
+        assert "cpu_percent" in res
+    assert compare(report, report) == []
+
+
+def test_heartbeat_unreachable_target(monkeypatch, capsys):
+    """ Test beats to an unreachable CTR never restart servers nor print """
+    from neurobooth_os.netcomm import client, heartbeat as heartbeat_module
+
+    class _Connection():
+        def send(self, payload, wait_reply=False, timeout=None):
+            sent.append(payload)
+            raise TimeoutError("timed out")
+
+    class _Pool():
+        def get(self, node_name):
+            return _Connection()
+
+    sent, restarted = [], []
+    monkeypatch.setattr(client, "get_pool", lambda: _Pool())
+    monkeypatch.setattr(heartbeat_module, "get_pool", lambda: _Pool())
+    monkeypatch.setattr(client, "start_server", lambda node_name: restarted.append(node_name))
+    heartbeat = HeartbeatSender("STM", target_node="dummy_ctr", interval=.05)
+    heartbeat.start()
+    time.sleep(.3)
+    heartbeat.stop()
+    assert len(sent) > 1
+    assert restarted == []
+    assert capsys.readouterr().out == ""
+
+
+def test_get_data_timeout_skips_malformed(monkeypatch):
+    """ Test malformed messages are skipped while waiting for the next one """
+    from neurobooth_os.netcomm import server
+
+    class _Server():
+        def __init__(self, payloads):
+            self.payloads = payloads
+
+        def get(self, timeout=None):
+            if not self.payloads:
+                return None, None
+            return self.payloads.pop(0), None
+
+    s1 = object()
+    payloads = [b"\xff\xfe", b'{"v": 0, "type": "pause_tasks"}',
+                encode_message("unpause_tasks").encode("utf-8")]
+    monkeypatch.setitem(server._servers, s1, _Server(payloads))
+    assert server.get_data_timeout(s1, None).type == "unpause_tasks"
+    assert server.get_data_timeout(s1, .1) is None
@@ -5,7 +5,8 @@ from time import time, sleep
 
 import neurobooth_os
 from neurobooth_os import config
-from neurobooth_os.netcomm import NewStdout, get_client_messages
+from neurobooth_os.netcomm import (NewStdout, get_client_messages, send_event, reply,
+                                   reply_error, HeartbeatSender)
 from neurobooth_os.iout.camera_brio import VidRec_Brio
 from neurobooth_os.iout.lsl_streamer import (start_lsl_threads, close_streams,
                                              reconnect_streams, connect_mbient)
@@ -14,78 +15,96 @@ import neurobooth_os.iout.metadator as meta
 def Main():
     os.chdir(neurobooth_os.__path__[0])
 
-    sys.stdout = NewStdout("ACQ",  target_node="control", terminal_print=True)
-    conn = meta.get_conn()
+    # Prints are shipped to CTR in batches, device threads never wait on the network
+    stdout = NewStdout("ACQ",  target_node="control", terminal_print=True, background=True)
+    sys.stdout = stdout
+    # Liveness and load beats, CTR marks ACQ unhealthy when they stop
+    heartbeat = HeartbeatSender("ACQ", target_node="control")
+    heartbeat.start()
+    # Connections are opened when first needed, the configuration is read from
+    # the local snapshot when fresh so ACQ starts if the database is unreachable
+    conn = meta.get_pool()
+    meta.refresh_snapshot(conn)
     s1 = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
     streams = {}
     lowFeed_running = False
-    for data, connx in get_client_messages(s1):
+    for msg, connx in get_client_messages(s1):
 
-        if "vis_stream" in data:
+        if msg.type == "vis_stream":
             if not lowFeed_running:
                 lowFeed = VidRec_Brio(camindex=config.paths["cam_inx_lowfeed"],
                                       doPreview=True)
                 print("LowFeed running")
                 lowFeed_running = True
             else:
-                print(f"-OUTLETID-:Webcam:{lowFeed.preview_outlet_id}")
+                send_event("outlet_id", name="Webcam", outlet_id=lowFeed.preview_outlet_id)
                 print("Already running low feed video streaming")
 
-        elif "prepare" in data:
-            # data = "prepare:collection_id:str(tech_obs_log_dict)"
-            collection_id = data.split(":")[1]
+        elif msg.type == "prepare":
+            # msg.data = {"collection_id": str, "tech_obs_log": dict, "snapshot_stamp": str}
+            collection_id = msg.data["collection_id"]
+            # Read the collection once for this prepare, from the snapshot CTR
+            # listed it from if this node has it, the lookups below hit the cache
+            meta.reload_collection(collection_id, conn, msg.data.get("snapshot_stamp"))
             task_devs_kw = meta._get_coll_dev_kwarg_tasks(collection_id, conn)
             if len(streams):
                 print("Checking prepared devices")
                 streams = reconnect_streams(streams)
             else:
-                streams = start_lsl_threads("acquisition", collection_id)
+                streams = start_lsl_threads("acquisition", collection_id, conn=conn)
+            heartbeat.set_streams(streams)
 
             devs = list(streams.keys())
-            print("UPDATOR:-Connect-")
+            send_event("update_button", key="-Connect-")
 
-        elif "dev_param_update" in data:
+        elif msg.type == "dev_param_update":
             None
 
-        elif "record_start" in data:  
-            # "record_start:filename:task_id" FILENAME = {subj_id}_{obs_id}
+        elif msg.type == "record_start":
+            # msg.data = {"fname": {subj_id}_{obs_id}, "task": task_id}
             print("Starting recording")
-            fname, task = data.split("::")[1:]            
-            for k in streams.keys():
-                if k.split("_")[0] in ["hiFeed", "Intel", "FLIR"]: 
-                    if task_devs_kw[task].get(k):
-                        streams[k].start(fname)
-            msg = "ACQ_devices_ready"
-            connx.send(msg.encode("ascii"))
-
-        elif "record_stop" in data:
+            fname, task = msg.data["fname"], msg.data["task"]
+            try:
+                for k in streams.keys():
+                    if k.split("_")[0] in ["hiFeed", "Intel", "FLIR"]: 
+                        if task_devs_kw[task].get(k):
+                            streams[k].start(fname)
+            except Exception as e:
+                print(f"Starting recording failed: {e}")
+                reply_error(connx, msg, e, node="ACQ")
+                continue
+            reply(connx, msg, "devices_ready", node="ACQ")
+
+        elif msg.type == "record_stop":
             print("Closing recording")
             for k in streams.keys():
                 if k.split("_")[0] in ["hiFeed", "Intel", "FLIR"]:
                     streams[k].stop()
 
-        elif data in ["close", "shutdown"]:
+        elif msg.type in ["close", "shutdown"]:
             print("Closing devices")
             streams = close_streams(streams)
+            heartbeat.set_streams(streams)
 
-            if "shutdown" in data:
+            if msg.type == "shutdown":
                 if lowFeed_running:
                     lowFeed.close()
                     lowFeed_running = False
                     print("Closing RTD cam")
                 break
 
-        elif "time_test" in data:
-            msg = f"ping_{time()}"
-            connx.send(msg.encode("ascii"))
+        elif msg.type == "time_test":
+            reply(connx, msg, "time_reply", time=time())
 
         else:
-            print(data)
+            print(f"Unknown message: {msg}")
 
     sleep(.5)
     s1.close()
-    sys.stdout = sys.stdout.terminal
+    heartbeat.stop()
+    stdout.close()
+    sys.stdout = stdout.terminal
 
 
 Main()
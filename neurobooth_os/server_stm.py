@@ -10,8 +10,11 @@ from neurobooth_os import config
 from neurobooth_os.iout.screen_capture import ScreenMirror
 from neurobooth_os.iout.lsl_streamer import start_lsl_threads, close_streams, reconnect_streams
 from neurobooth_os.iout import metadator as meta
+from neurobooth_os.iout.tech_obs_log_queue import TechObsLogQueue
 
-from neurobooth_os.netcomm import socket_message, get_client_messages, NewStdout, get_data_timeout
+from neurobooth_os.netcomm import (socket_message, get_client_messages, NewStdout,
+                                   get_data_timeout, send_event, encode_message, call_async,
+                                   reply, RpcError, HeartbeatSender)
 
 from neurobooth_os.tasks.wellcome_finish_screens import welcome_screen, finish_screen
 import neurobooth_os.tasks.utils as utl
@@ -21,30 +24,45 @@ from neurobooth_os.tasks.task_importer import get_task_funcs
 def Main():
     os.chdir(neurobooth_os.__path__[0])
 
-    sys.stdout = NewStdout("STM",  target_node="control", terminal_print=True)
+    # Prints are shipped to CTR in batches, device threads never wait on the network
+    stdout = NewStdout("STM",  target_node="control", terminal_print=True, background=True)
+    sys.stdout = stdout
+    # Liveness and load beats, CTR marks STM unhealthy when they stop
+    heartbeat = HeartbeatSender("STM", target_node="control")
+    heartbeat.start()
     s1 = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     win = utl.make_win(full_screen=False)
-    conn = meta.get_conn()
+    # Connections are opened when first needed, the configuration is read from
+    # the local snapshot when fresh so STM starts if the database is unreachable
+    conn = meta.get_pool()
+    meta.refresh_snapshot(conn)
+    # tech_obs_log rows are written in background, tasks do not wait on the database
+    obs_log = TechObsLogQueue(conn, os.path.join(config.paths["data_out"],
+                                                 "tech_obs_log_spool.json"))
+    obs_log.start()
 
     streams, screen_running = {}, False
 
-    for data, connx in get_client_messages(s1):
+    for msg, connx in get_client_messages(s1):
 
-        if "scr_stream" in data:
+        if msg.type == "scr_stream":
             if not screen_running:
                 screen_feed = ScreenMirror()
                 screen_feed.start()
                 print("Stim screen feed running")
                 screen_running = True
             else:
-                print(f"-OUTLETID-:Screen:{screen_feed.outlet_id}")
+                send_event("outlet_id", name="Screen", outlet_id=screen_feed.outlet_id)
                 print("Already running screen feed")
 
-        elif "prepare" in data:
-            # data = "prepare:collection_id:str(tech_obs_log_dict)"
+        elif msg.type == "prepare":
+            # msg.data = {"collection_id": str, "tech_obs_log": dict, "snapshot_stamp": str}
 
-            collection_id = data.split(":")[1]
-            tech_obs_log = eval(data.replace(f"prepare:{collection_id}:", ""))
+            collection_id = msg.data["collection_id"]
+            # Read the collection once for this prepare, from the snapshot CTR
+            # listed it from if this node has it, the lookups below hit the cache
+            meta.reload_collection(collection_id, conn, msg.data.get("snapshot_stamp"))
+            tech_obs_log = msg.data["tech_obs_log"]
             study_id_date = tech_obs_log["study_id-date"]
 
             # delete subj_date as not present in DB
@@ -57,15 +75,19 @@ def Main():
                 print("Checking prepared devices")
                 streams = reconnect_streams(streams)
             else:
-                streams = start_lsl_threads("presentation", collection_id, win=win)               
+                streams = start_lsl_threads("presentation", collection_id, win=win, conn=conn)               
                 print("Preparing devices")  
+            heartbeat.set_streams(streams)
 
-            print("UPDATOR:-Connect-")
+            send_event("update_button", key="-Connect-")
 
-        elif "present" in data:  # -> "present:TASKNAME:subj_id"
-            # task_name can be list of task1-task2-task3
-            
-            tasks, subj_id = data.split(":")[1:]
+        elif msg.type == "present":
+            # msg.data = {"tasks": [task1, task2, ...], "subj_id": str}
+
+            tasks, subj_id = msg.data["tasks"], msg.data["subj_id"]
+            # Insert the rows of the recorded tasks while the media load
+            obs_log.reserve(subj_id, sum(task in task_func_dict and 'calibration_task' not in task
+                                         and "intro_" not in task for task in tasks))
             task_karg ={"win": win,
                         "path": config.paths['data_out'],
                         "subj_id": study_id_date,
@@ -83,9 +105,9 @@ def Main():
             win = welcome_screen(with_audio=False, win=win)
             # When win is created, stdout pipe is reset
             if not hasattr(sys.stdout, 'terminal'):
-                sys.stdout = NewStdout("STM",  target_node="control", terminal_print=True)
+                sys.stdout = stdout
             
-            for task in tasks.split("-"):
+            for task in tasks:
                 if task not in task_func_dict.keys():
                     print(f"Task {task} not implemented")
                     continue
@@ -100,14 +122,19 @@ def Main():
                       continue                    
                 
                 t_obs_id = task_func_dict[task]['t_obs_id']
-                tech_obs_log_id = meta._make_new_tech_obs_row(conn, subj_id)
+                tech_obs_log_id = obs_log.new_row(subj_id)
                 tech_obs_log["date_times"] = '{'+ datetime.now().strftime("%Y-%m-%d %H:%M:%S") + '}'
                 tsk_strt_time = datetime.now().strftime("%Hh-%Mm-%Ss")
 
                 # Signal CTR to start LSL rec
-                print(f"Initiating task:{task}:{t_obs_id}:{tech_obs_log_id}:{tsk_strt_time}")
+                send_event("task_initiated", task_id=task, t_obs_id=t_obs_id,
+                           tech_obs_log_id=tech_obs_log_id, tsk_strt_time=tsk_strt_time)
                 sleep(1)
 
+                # Start rec in ACQ, the eyetracker starts while ACQ starts its devices
+                rec_fname = f"{config.paths['data_out']}{study_id_date}_{tsk_strt_time}_{t_obs_id}"
+                acq_rec = call_async("acquisition", "record_start", fname=rec_fname, task=task)
+
                 # Start eyetracker if device in tech_obs 
                 if streams.get('Eyelink') and \
                             any('Eyelink' in d for d in list(task_devs_kw[task])):
@@ -116,48 +143,49 @@ def Main():
                     fname = f"{config.paths['data_out']}{study_id_date}_{tsk_strt_time}_{t_obs_id}.edf"
                     streams['Eyelink'].start(fname)
 
-                # Start rec in ACQ and run task
-                resp = socket_message(f"record_start::{config.paths['data_out']}{study_id_date}_{tsk_strt_time}_{t_obs_id}::{task}",
-                                     "acquisition", wait_data=3)
-                print(resp)
+                # Wait for ACQ devices and run task
+                try:
+                    resp = acq_rec.result(timeout=3)
+                    print(f"{resp.node}: {resp.type}")
+                except RpcError as e:
+                    print(f"ACQ recording not confirmed: {e}")
                 sleep(.5)
 
                 events = tsk_fun.run(**this_task_kwargs)
-                socket_message("record_stop", "acquisition")
-                print(f"Finished task:{task}")
+                socket_message(encode_message("record_stop"), "acquisition")
+                send_event("task_finished", task_id=task)
 
                 # Log tech_obs to database
                 tech_obs_log["tech_obs_id"] = t_obs_id
                 tech_obs_log['event_array'] = str(events).replace("'", '"') if events is not None else "event:datestamp"
-                meta._fill_tech_obs_row(tech_obs_log_id, tech_obs_log, conn)     
+                obs_log.fill_row(tech_obs_log_id, tech_obs_log)     
                 
                 if streams.get('Eyelink') and any('Eyelink' in d for d in list(task_devs_kw[task])):
                     streams['Eyelink'].stop()
                 
                 # Check if pause requested, unpause or stop
-                data = get_data_timeout(s1, .1)
-                if data == "pause tasks":
+                msg = get_data_timeout(s1, .1)
+                if msg is not None and msg.type == "pause_tasks":
                     pause_screen = utl.create_text_screen(win, text="Session Paused")
                     utl.present(win, pause_screen, waitKeys=False)
                     
-                    connx2, _ = s1.accept()
-                    data = connx2.recv(1024)
-                    data = data.decode("utf-8")
+                    msg = get_data_timeout(s1, None)
                     
-                    if data == "unpause tasks":
+                    if msg.type == "unpause_tasks":
                         continue                    
-                    elif data == "stop tasks":
+                    elif msg.type == "stop_tasks":
                         break
                     else:
                         print("While paused received another message")
                     
             finish_screen(win)
 
-        elif data in ["close", "shutdown"]:
+        elif msg.type in ["close", "shutdown"]:
             streams = close_streams(streams)
+            heartbeat.set_streams(streams)
             print("Closing devices")
 
-            if "shutdown" in data:
+            if msg.type == "shutdown":
                 if screen_running:
                     screen_feed.stop()
                     print("Closing screen mirroring")
@@ -165,15 +193,19 @@ def Main():
                 print("Closing Stim server")
                 break
 
-        elif "time_test" in data:
-            msg = f"ping_{time()}"
-            connx.send(msg.encode("ascii"))
+        elif msg.type == "time_test":
+            reply(connx, msg, "time_reply", time=time())
 
         else:
-            print(data)
+            print(f"Unknown message: {msg}")
 
     s1.close()
-    sys.stdout = sys.stdout.terminal
+    n_pending = obs_log.stop(timeout=10)
+    if n_pending:
+        print(f"{n_pending} tech_obs_log writes spooled, committed at the next start")
+    heartbeat.stop()
+    stdout.close()
+    sys.stdout = stdout.terminal
     win.close()
 
 
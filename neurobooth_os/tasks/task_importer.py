@@ -49,14 +49,15 @@ def get_task_funcs(collection_id, conn):
         dict containing key task name and value callable task
     """
 
-    tasks_obs = meta.get_tasks(collection_id, conn)
+    collection = meta.load_collection(collection_id, conn)
 
     task_func_dict = {}
-    for obs_id in tasks_obs:        
-        task_stim_id, task_dev, task_sens, instr_kwargs = meta._get_task_param(obs_id, conn)
+    for obs_id, task in collection["tasks"].items():
+        task_stim_id = task["stimulus_id"]
+        instr_kwargs = dict(task["instr_kwargs"])
         if instr_kwargs.get('instruction_file') is not None:
             instr_kwargs['instruction_file'] =  op.join(cfg.paths['video_tasks'], instr_kwargs['instruction_file'])
-        stim_file, stim_kwargs = meta._get_task_stim(task_stim_id, conn)
+        stim_file, stim_kwargs = meta._stim_kwargs(task["stimulus"])
         task_kwargs = {**stim_kwargs, **instr_kwargs}
 
         # Convert path to class to class inst.
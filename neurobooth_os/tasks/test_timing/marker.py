@@ -2,6 +2,8 @@ from pylsl import StreamInfo, StreamOutlet
 import time
 import uuid
 
+from neurobooth_os.netcomm import send_event
+
 
 def marker_stream():
     ''' Create marker stream to be pushed when needed with a string format:
@@ -16,7 +18,7 @@ def marker_stream():
     outlet_marker = StreamOutlet(stream_info_marker)
     outlet_marker.oulet_id = oulet_id
     outlet_marker.push_sample([f"Stream-created_0_{time.time()}"])
-    print(f"-OUTLETID-:Marker:{oulet_id}")
+    send_event("outlet_id", name="Marker", outlet_id=oulet_id)
     outlet_marker.stop = outlet_marker.__del__
     outlet_marker.streaming = True
 